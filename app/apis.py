@@ -1,8 +1,19 @@
 import requests
 
 import app.boto_utils
-from app.common import CacheConfig, AutoScalerConfig, Resizingpolicy, ReplacementPolicy
+from app.memcache.binary_protocol import BinaryProtocolClient
+from app.common import CacheConfig, AutoScalerConfig, Resizingpolicy, ReplacementPolicy, BINARY_VALUE_TYPES, \
+    encode_value_for_json, decode_value_from_json, DEFAULT_SCAN_COUNT, DEFAULT_HOT_KEY_COUNT
+import json
 import jsonpickle
+import threading
+import time
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+from urllib3.util.retry import Retry
+from app.metrics import REGISTRY, MetricFamily, record_outbound_request
 
 USE_LOCAL_IP = False
 LOCAL_HOST_IP = "127.0.0.1"
@@ -15,6 +26,164 @@ MANAGER_APP_URL = "http://" + DEFAULT_IP + ":5001/"
 AUTOSCALER_APP_URL = "http://" + DEFAULT_IP + ":5002/"
 STORAGE_APP_URL = "http://" + DEFAULT_IP + ":5003/"
 MEMCACHE_APP_PORT = "5004"
+MEMCACHE_BINARY_PORT = "5005"
+# Talk to memcache nodes over their binary protocol for key/value operations instead of HTTP
+USE_BINARY_PROTOCOL = False
+
+# Service called on each port, to label outbound request metrics
+TARGETS_BY_PORT = {5000: "frontend", 5001: "manager", 5002: "autoscaler", 5003: "storage",
+                   int(MEMCACHE_APP_PORT): "memcache"}
+# Max number of keep-alive connections open to each host. Requests beyond that wait for a connection to be released
+# instead of opening more, for up to POOL_TIMEOUT_SECONDS before failing with a ConnectionError.
+POOL_MAX_CONNECTIONS_PER_HOST = 16
+POOL_TIMEOUT_SECONDS = 5
+# (connect, read) timeouts in seconds of requests that don't set their own
+DEFAULT_TIMEOUT_SECONDS = (3.05, 30)
+# Requests are retried this many times on connection errors. Idempotent ones are also retried on read errors and
+# RETRIED_STATUSES responses. The nth retry waits RETRY_BACKOFF_SECONDS * 2^(n-1) first.
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.1
+RETRIED_STATUSES = frozenset({502, 503, 504})
+# Statuses not worth retrying for some targets. The manager answers 503 only after waiting LOCK_TIMEOUT_SECONDS for
+# its pool lock, so retrying it would hold a request for several lock timeouts in a row.
+NOT_RETRIED_STATUSES_BY_TARGET = {"manager": frozenset({503})}
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "DELETE"})
+
+OUTBOUND_POOL_WAIT = REGISTRY.histogram("outbound_pool_wait_seconds",
+                                        "Time an outbound request waited for a pooled connection to a host.",
+                                        ("target", "host"))
+
+
+class PoolWaitRecorder:
+    """ Connection pool mixin recording how long requests wait for one of the pool's connections, and bounding that
+    wait to POOL_TIMEOUT_SECONDS since requests never passes a pool timeout. """
+
+    def _get_conn(self, timeout=None):
+        if timeout is None:
+            timeout = POOL_TIMEOUT_SECONDS
+        start_time = time.perf_counter()
+        connection = super()._get_conn(timeout)
+        OUTBOUND_POOL_WAIT.observe(time.perf_counter() - start_time, TARGETS_BY_PORT.get(self.port, "external"),
+                                   self.host + ":" + str(self.port))
+        return connection
+
+
+class InstrumentedConnectionPool(PoolWaitRecorder, HTTPConnectionPool):
+    pass
+
+
+class InstrumentedHTTPSConnectionPool(PoolWaitRecorder, HTTPSConnectionPool):
+    pass
+
+
+class PooledAdapter(HTTPAdapter):
+    """ Adapter keeping a bounded pool of keep-alive connections per host, with instrumented pools.
+    Idempotent requests are retried on the given statuses. """
+
+    def __init__(self, retried_statuses=RETRIED_STATUSES):
+        super().__init__(pool_maxsize=POOL_MAX_CONNECTIONS_PER_HOST, pool_block=True,
+                         max_retries=Retry(total=MAX_RETRIES, backoff_factor=RETRY_BACKOFF_SECONDS,
+                                           allowed_methods=IDEMPOTENT_METHODS, status_forcelist=retried_statuses,
+                                           raise_on_status=False))
+
+    def send(self, request, *args, **kwargs):
+        try:
+            return super().send(request, *args, **kwargs)
+        except EmptyPoolError as e:
+            # Every connection to the host stayed busy for POOL_TIMEOUT_SECONDS
+            raise requests.ConnectionError(e, request=request)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": InstrumentedConnectionPool,
+                                                   "https": InstrumentedHTTPSConnectionPool}
+
+    def get_pools(self):
+        """ Get the connection pools opened so far, one per host. """
+        pools = self.poolmanager.pools
+        # A pool may be dropped between listing the keys and getting it
+        return [pool for pool in (pools.get(key) for key in pools.keys()) if pool is not None]
+
+
+class OutboundHttp:
+    """ Sends HTTP requests like the requests module does, recording the duration and status of each one in the
+    outbound request metrics. Calls to anything but our own services, like presigned S3 urls, are recorded under an
+    "external" target without their path, so per image urls don't each get their own series.
+    Each target gets its own session, so connections to a host are kept alive and reused across calls from every
+    thread, up to POOL_MAX_CONNECTIONS_PER_HOST of them. Waiting over POOL_TIMEOUT_SECONDS for one of them fails with
+    a ConnectionError. Requests get DEFAULT_TIMEOUT_SECONDS unless they pass a timeout, and are retried with backoff
+    as configured by MAX_RETRIES, except on the statuses NOT_RETRIED_STATUSES_BY_TARGET excludes for their target. """
+    sessions: dict
+
+    def __init__(self):
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+
+    @staticmethod
+    def get_target_and_path(url):
+        parts = urlsplit(url)
+        target = TARGETS_BY_PORT.get(parts.port)
+        if target is None:
+            return "external", ""
+        return target, "/" + parts.path.lstrip("/")
+
+    def get_session(self, target):
+        session = self.sessions.get(target)
+        if session is None:
+            with self.sessions_lock:
+                session = self.sessions.get(target)
+                if session is None:
+                    session = requests.Session()
+                    retried_statuses = RETRIED_STATUSES - NOT_RETRIED_STATUSES_BY_TARGET.get(target, frozenset())
+                    adapter = PooledAdapter(retried_statuses)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self.sessions[target] = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        target, path = self.get_target_and_path(url)
+        kwargs.setdefault('timeout', DEFAULT_TIMEOUT_SECONDS)
+        start_time = time.perf_counter()
+        try:
+            response = self.get_session(target).request(method, url, **kwargs)
+        except requests.RequestException as e:
+            record_outbound_request(target, path, type(e).__name__, time.perf_counter() - start_time)
+            raise
+        record_outbound_request(target, path, response.status_code, time.perf_counter() - start_time)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def collect_metrics(self):
+        """ Get the number of connections of each pool in use and their limit as metric families to scrape. """
+        in_use = MetricFamily("outbound_pool_connections_in_use", "gauge",
+                              "Pooled connections to a host currently checked out by a request.")
+        max_connections = MetricFamily("outbound_pool_max_connections", "gauge",
+                                       "Max number of pooled connections to a host.")
+        with self.sessions_lock:
+            sessions = list(self.sessions.items())
+        for (target, session) in sessions:
+            for pool in session.get_adapter("http://").get_pools():
+                if pool.pool is None:
+                    # Closed
+                    continue
+                labels = {"target": target, "host": pool.host + ":" + str(pool.port)}
+                # The pool queue holds the connections, or placeholders for them, not checked out
+                in_use.add_sample(labels, pool.pool.maxsize - pool.pool.qsize())
+                max_connections.add_sample(labels, pool.pool.maxsize)
+        return [in_use, max_connections]
+
+
+outbound = OutboundHttp()
+REGISTRY.register(outbound.collect_metrics)
 
 # THIS CLASS DEFINES THE API ENDPOINTS OF ALL THE FLASK APPS
 # APP API SHOULD BE PROGRAMMED TO CONFORM TO THE API SPECIFIED HERE
@@ -31,7 +200,7 @@ class FrontEndApi:
         capacity = cache_config.max_size_mb
         replacement_policy = cache_config.replacement_policy
         autoscaler_config = autoscaler_config.resizing_policy
-        response = requests.post(FRONTEND_APP_URL + "/api/notify_pool_size_change",
+        response = outbound.post(FRONTEND_APP_URL + "/api/notify_pool_size_change",
                                  data={'timestamp': timestamp,
                                        'capacity': capacity,
                                        'replacement_policy': replacement_policy.value,
@@ -50,7 +219,7 @@ class StorageApi:
 
         print("MADE IT HERE 3")
         print(STORAGE_APP_URL + "/api/store_image")
-        response = requests.post(STORAGE_APP_URL + "api/store_image",
+        response = outbound.post(STORAGE_APP_URL + "api/store_image",
                                  data={'key': key,
                                        'img_filename': img_filename
                                        },
@@ -60,7 +229,7 @@ class StorageApi:
 
     @staticmethod
     def get_img_url(key):
-        response = requests.post(STORAGE_APP_URL + "/api/get_image_url",
+        response = outbound.post(STORAGE_APP_URL + "/api/get_image_url",
                                  data={'key': key})
         json_response = response.json()
         if json_response['success'] is not True:
@@ -70,7 +239,7 @@ class StorageApi:
 
     @staticmethod
     def delete_all():
-        response = requests.post(STORAGE_APP_URL + "/api/delete_all")
+        response = outbound.post(STORAGE_APP_URL + "/api/delete_all")
         json_response = response.json()
         return json_response['success'] is True
 
@@ -78,13 +247,13 @@ class StorageApi:
     def save_cache_config(cache_config: CacheConfig):
         headers = {'Content-type': 'application/json'}
         data = jsonpickle.encode(cache_config)
-        response = requests.post(STORAGE_APP_URL + "/api/save_cache", headers=headers, data=data)
+        response = outbound.post(STORAGE_APP_URL + "/api/save_cache", headers=headers, data=data)
         json_response = response.json()
         return json_response['success'] is True
 
     @staticmethod
     def get_most_recent_cache_config():
-        response = requests.get(STORAGE_APP_URL + "/api/get_cache")
+        response = outbound.get(STORAGE_APP_URL + "/api/get_cache")
         json_response = response.json()
         if json_response['success'] is not True:
             return None
@@ -96,13 +265,13 @@ class StorageApi:
     def save_autoscaler_config(scaler_config: AutoScalerConfig):
         headers = {'Content-type': 'application/json'}
         data = jsonpickle.encode(scaler_config)
-        response = requests.post(STORAGE_APP_URL + "/api/save_autoscaler",headers=headers, data=data)
+        response = outbound.post(STORAGE_APP_URL + "/api/save_autoscaler",headers=headers, data=data)
         json_response = response.json()
         return json_response['success'] is True
 
     @staticmethod
     def get_most_recent_autoscaler_config():
-        response = requests.post(STORAGE_APP_URL + "/api/get_autoscaler")
+        response = outbound.post(STORAGE_APP_URL + "/api/get_autoscaler")
         json_response = response.json()
         if json_response['success'] is not True:
             return None
@@ -112,7 +281,7 @@ class StorageApi:
 
     @staticmethod
     def get_keys():
-        response = requests.post(STORAGE_APP_URL + "/api/get_all_keys")
+        response = outbound.post(STORAGE_APP_URL + "/api/get_all_keys")
         json_response = response.json()
         if json_response['success'] is not True:
             return None
@@ -122,7 +291,7 @@ class StorageApi:
 class AutoScalerApi:
     @staticmethod
     def refresh_config():
-        response = requests.get(AUTOSCALER_APP_URL + "/refresh_configuration")
+        response = outbound.get(AUTOSCALER_APP_URL + "/refresh_configuration")
         json_response = response.json()
         return json_response['success'] is True
 
@@ -133,34 +302,67 @@ class ManagerApi:
         replacement_policy = cache_config.replacement_policy.value
         max_size_mb = cache_config.max_size_mb
         max_num_items = cache_config.max_num_items
+        default_ttl_seconds = cache_config.default_ttl_seconds
+        compression_level = cache_config.compression_level
+        compression_threshold_bytes = cache_config.compression_threshold_bytes
         if max_num_items is not None:
-            response = requests.post(MANAGER_APP_URL + "/set_configuration", data={'replacement_policy': replacement_policy,
+            response = outbound.post(MANAGER_APP_URL + "/set_configuration", data={'replacement_policy': replacement_policy,
                                                                             'max_size_mb': max_size_mb,
-                                                                            'max_num_items': max_num_items})
+                                                                            'max_num_items': max_num_items,
+                                                                            'default_ttl_seconds': default_ttl_seconds,
+                                                                            'compression_level': compression_level,
+                                                                            'compression_threshold_bytes': compression_threshold_bytes})
         else:
-            response = requests.post(MANAGER_APP_URL + "/set_configuration", data={'replacement_policy': replacement_policy,
-                                                                            'max_size_mb': max_size_mb})
+            response = outbound.post(MANAGER_APP_URL + "/set_configuration", data={'replacement_policy': replacement_policy,
+                                                                            'max_size_mb': max_size_mb,
+                                                                            'default_ttl_seconds': default_ttl_seconds,
+                                                                            'compression_level': compression_level,
+                                                                            'compression_threshold_bytes': compression_threshold_bytes})
 
         json_response = response.json()
         return json_response['success'] is True
 
     @staticmethod
-    def put(key, img_data):
-        response = requests.post(MANAGER_APP_URL + "/put", data={'key': key, 'img_data': img_data})
+    def put(key, img_data, refill_cost_ms=None, ttl_seconds=None):
+        if isinstance(img_data, BINARY_VALUE_TYPES):
+            return ManagerApi.put_raw(key, img_data, refill_cost_ms, ttl_seconds)
+        response = outbound.post(MANAGER_APP_URL + "/put", data={'key': key, 'img_data': img_data,
+                                                                 'refill_cost_ms': refill_cost_ms,
+                                                                 'ttl_seconds': ttl_seconds})
         json_response = response.json()
         return json_response['success'] is True
 
     @staticmethod
     def get(key):
-        response = requests.get(MANAGER_APP_URL + "/get", data={'key': key})
+        response = outbound.get(MANAGER_APP_URL + "/get", data={'key': key})
         json_response = response.json()
         if json_response['success'] is not True:
             return None
-        return json_response['img_data']
+        return decode_value_from_json(json_response['img_data'], json_response.get('is_binary'))
+
+    @staticmethod
+    def put_raw(key, img_data, refill_cost_ms=None, ttl_seconds=None):
+        """ Place raw image bytes in the cache pool without any encoding.
+        refill_cost_ms is how long loading the image from storage took, used by cost aware replacement policies.
+        The entry expires after ttl_seconds, or the cache's default TTL if None. """
+        response = outbound.post(MANAGER_APP_URL + "/put_raw",
+                                 params={'key': key, 'refill_cost_ms': refill_cost_ms, 'ttl_seconds': ttl_seconds},
+                                 data=img_data,
+                                 headers={'Content-type': 'application/octet-stream'})
+        json_response = response.json()
+        return json_response['success'] is True
+
+    @staticmethod
+    def get_raw(key):
+        """ Get raw image bytes from the cache pool, None on a miss. """
+        response = outbound.get(MANAGER_APP_URL + "/get_raw", params={'key': key})
+        if response.status_code != 200:
+            return None
+        return response.content
 
     @staticmethod
     def get_rate(rate_type):
-        response = requests.get(MANAGER_APP_URL + "/getRate",  data={'type': rate_type})
+        response = outbound.get(MANAGER_APP_URL + "/getRate",  data={'type': rate_type})
         if response is None:
             return None
         json_response = response.json()
@@ -171,21 +373,21 @@ class ManagerApi:
     @staticmethod
     def expand_nodes(growth_factor):
         """ Expand number of nodes by provided factor, should only be called from Autoscaler app. """
-        response = requests.post(MANAGER_APP_URL + "/expand_nodes", data={'growth_factor': growth_factor})
+        response = outbound.post(MANAGER_APP_URL + "/expand_nodes", data={'growth_factor': growth_factor})
         json_response = response.json()
         return json_response['success'] is True
 
     @staticmethod
     def shrink_nodes(shrink_factor):
         """ Shrink number of nodes by provided factor, should only be called from Autoscaler app. """
-        response = requests.post(MANAGER_APP_URL + "/shrink_nodes", data={'shrink_factor': shrink_factor})
+        response = outbound.post(MANAGER_APP_URL + "/shrink_nodes", data={'shrink_factor': shrink_factor})
         json_response = response.json()
         return json_response['success'] is True
 
     @staticmethod
     def get_stat_ids():
         """ Get the stat ids of all nodes in the cache pool. """
-        response = requests.get(MANAGER_APP_URL + "/get_stat_ids")
+        response = outbound.get(MANAGER_APP_URL + "/get_stat_ids")
         json_response = response.json()
         if json_response['success'] is not True:
             return None
@@ -193,32 +395,81 @@ class ManagerApi:
 
     @staticmethod
     def get_num_active_nodes():
-        response = requests.get(MANAGER_APP_URL + "/get_num_active_nodes")
+        response = outbound.get(MANAGER_APP_URL + "/get_num_active_nodes")
         json_response = response.json()
         return json_response['num_active_nodes']
 
     @staticmethod
     def set_num_active_nodes(num_desired):
-        response = requests.post(MANAGER_APP_URL + "/set_num_active_nodes", data={'num_desired': num_desired})
+        response = outbound.post(MANAGER_APP_URL + "/set_num_active_nodes", data={'num_desired': num_desired})
         json_response = response.json()
         return json_response['success'] is True
 
 
     @staticmethod
     def clear():
-        response = requests.delete(MANAGER_APP_URL + "/clear_all_nodes")
+        response = outbound.delete(MANAGER_APP_URL + "/clear_all_nodes")
         json_response = response.json()
         return json_response['success'] is True
 
     @staticmethod
     def invalidate(key):
-        response = requests.delete(MANAGER_APP_URL + "/invalidate", data={'key': key})
+        response = outbound.delete(MANAGER_APP_URL + "/invalidate", data={'key': key})
         json_response = response.json()
         return json_response['success'] is True
 
+    @staticmethod
+    def scan_keys(cursor=None, count=DEFAULT_SCAN_COUNT, prefix=None):
+        response = outbound.get(MANAGER_APP_URL + "/scan_keys", params={'cursor': cursor, 'count': count,
+                                                                        'prefix': prefix})
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None, None
+        return json_response['keys'], json_response['cursor']
+
+    @staticmethod
+    def iter_keys(prefix=None):
+        with outbound.get(MANAGER_APP_URL + "/stream_keys", params={'prefix': prefix}, stream=True) as response:
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    @staticmethod
+    def get_hot_keys(count=DEFAULT_HOT_KEY_COUNT):
+        """ Returns the hot keys of the pool and the number of requests counted by each active node. """
+        response = outbound.get(MANAGER_APP_URL + "/hot_keys", params={'count': count})
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None, None
+        return json_response['hot_keys'], json_response['node_totals']
+
+    @staticmethod
+    def get_shrink_progress():
+        response = outbound.get(MANAGER_APP_URL + "/shrink_progress")
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None
+        return json_response['shrink']
+
+    @staticmethod
+    def get_migration_progress():
+        response = outbound.get(MANAGER_APP_URL + "/migration_progress")
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None
+        return json_response['migration']
+
+    @staticmethod
+    def predict_miss_rate(num_nodes):
+        response = outbound.get(MANAGER_APP_URL + "/predict_miss_rate", params={'num_nodes': num_nodes})
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None
+        return json_response['miss_rate']
+
     @staticmethod
     def get_all_keys():
-        response = requests.get(MANAGER_APP_URL + "/get_all_keys")
+        response = outbound.get(MANAGER_APP_URL + "/get_all_keys")
         if response is None:
             return []
         json_response = response.json()
@@ -228,69 +479,189 @@ class ManagerApi:
 
 
 class MemcacheApi:
-    """  """
+    """ Key/value operations go over the node's binary protocol when use_binary_protocol is set, everything else
+    always goes over HTTP. """
     url: str
+    binary_client: BinaryProtocolClient
 
-    def __init__(self, ip_addr):
+    def __init__(self, ip_addr, use_binary_protocol=USE_BINARY_PROTOCOL):
         self.url = "http://" + ip_addr + ":" + MEMCACHE_APP_PORT
+        self.binary_client = BinaryProtocolClient(ip_addr, int(MEMCACHE_BINARY_PORT)) if use_binary_protocol \
+            else None
+
+    @classmethod
+    def from_url(cls, url):
+        """ Get the api of the node at a url returned by get_url. """
+        return cls(urlsplit(url).hostname)
 
     def get_url(self):
         return self.url
 
     def get(self, key):
-        response = requests.get(self.url + "/get", data={'key': key})
+        if self.binary_client is not None:
+            return self.binary_client.get(key)
+        response = outbound.get(self.url + "/get", data={'key': key})
         json_response = response.json()
         img_data = None
         if json_response['success'] is True:
-            img_data = json_response['img_data']
+            img_data = decode_value_from_json(json_response['img_data'], json_response.get('is_binary'))
         return img_data
 
-    def put(self, key, img_data):
-        response = requests.post(self.url + "/put", data={'key': key, 'img_data': img_data})
+    def put(self, key, img_data, refill_cost_ms=None, ttl_seconds=None):
+        if self.binary_client is not None:
+            return self.binary_client.put(key, img_data, refill_cost_ms, ttl_seconds)
+        if isinstance(img_data, BINARY_VALUE_TYPES):
+            return self.put_raw(key, img_data, refill_cost_ms, ttl_seconds)
+        response = outbound.post(self.url + "/put", data={'key': key, 'img_data': img_data,
+                                                          'refill_cost_ms': refill_cost_ms,
+                                                          'ttl_seconds': ttl_seconds})
+        json_response = response.json()
+        return json_response['success'] is True
+
+    def get_raw(self, key):
+        if self.binary_client is not None:
+            value = self.binary_client.get(key)
+            return value.encode('utf-8') if isinstance(value, str) else value
+        response = outbound.get(self.url + "/get_raw", params={'key': key})
+        if response.status_code != 200:
+            return None
+        return response.content
+
+    def put_raw(self, key, img_data, refill_cost_ms=None, ttl_seconds=None):
+        if self.binary_client is not None:
+            return self.binary_client.put(key, bytes(img_data), refill_cost_ms, ttl_seconds)
+        response = outbound.post(self.url + "/put_raw",
+                                 params={'key': key, 'refill_cost_ms': refill_cost_ms, 'ttl_seconds': ttl_seconds},
+                                 data=img_data,
+                                 headers={'Content-type': 'application/octet-stream'})
         json_response = response.json()
         return json_response['success'] is True
 
+    def get_many(self, keys):
+        """ Get the values of a list of keys in one request. Returns a dict of key to value, None for misses. """
+        if self.binary_client is not None:
+            return self.binary_client.get_many(keys)
+        response = outbound.post(self.url + "/get_many", json={'keys': keys})
+        json_response = response.json()
+        values = {key: None for key in keys}
+        if json_response['success'] is True:
+            for key, encoded_value in json_response['values'].items():
+                if encoded_value is not None:
+                    values[key] = decode_value_from_json(encoded_value['img_data'], encoded_value['is_binary'])
+        return values
+
+    def put_many(self, values, ttl_seconds=None):
+        """ Put a dict of key/values in one request. Returns a dict of key to whether it was placed in cache. """
+        if self.binary_client is not None:
+            return self.binary_client.put_many(values, ttl_seconds)
+        encoded_values = {}
+        for key, value in values.items():
+            img_data, is_binary = encode_value_for_json(value)
+            encoded_values[key] = {'img_data': img_data, 'is_binary': is_binary}
+        response = outbound.post(self.url + "/put_many", json={'values': encoded_values, 'ttl_seconds': ttl_seconds})
+        json_response = response.json()
+        return json_response.get('results', {key: False for key in values})
+
+    def invalidate_many(self, keys):
+        if self.binary_client is not None:
+            return self.binary_client.delete_many(keys)
+        response = outbound.delete(self.url + "/invalidate_many", json={'keys': keys})
+        json_response = response.json()
+        return json_response['success'] is True
+
+    def export_entries(self, routing_table, remove=True):
+        """ Have the node start sending every key it holds that another node owns on the hash ring of routing_table
+        straight to that node. Returns the progress of the export, or None if it couldn't be started. """
+        response = outbound.post(self.url + "/export", json={'node_url': self.url, 'routing_table': routing_table,
+                                                             'remove': remove})
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None
+        return json_response['export']
+
+    def get_export_progress(self):
+        response = outbound.get(self.url + "/export_progress")
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None
+        return json_response['export']
+
+    def import_entries(self, data):
+        """ Send a batch of entries in the snapshot layout. Returns the number imported or None. """
+        response = outbound.post(self.url + "/import", data=data,
+                                 headers={'Content-Type': 'application/octet-stream'})
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None
+        return json_response['num_imported']
+
     def clear(self):
-        response = requests.delete(self.url + "/clear")
+        response = outbound.delete(self.url + "/clear")
         json_response = response.json()
         return json_response['success'] is True
 
     def invalidate(self, key):
-        response = requests.delete(self.url + "/invalidate", data={'key': key})
+        if self.binary_client is not None:
+            return self.binary_client.delete(key)
+        response = outbound.delete(self.url + "/invalidate", data={'key': key})
         json_response = response.json()
         return json_response['success'] is True
 
     def get_all_keys(self):
-        response = requests.get(self.url + "/get_keys")
+        response = outbound.get(self.url + "/get_keys")
         json_response = response.json()
         if json_response['success'] is not True:
             return None
         return json_response['keys']
 
+    def scan_keys(self, cursor=None, count=DEFAULT_SCAN_COUNT, prefix=None):
+        """ Get one page of keys, returns the keys and the cursor of the next page (None once the scan is done). """
+        response = outbound.get(self.url + "/scan_keys", params={'cursor': cursor, 'count': count, 'prefix': prefix})
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None, None
+        return json_response['keys'], json_response['cursor']
+
+    def iter_keys(self, prefix=None):
+        """ Iterate over all keys of the node as they are streamed back. """
+        with outbound.get(self.url + "/stream_keys", params={'prefix': prefix}, stream=True) as response:
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
     def set_configuration(self, cache_config: CacheConfig):
         replacement_policy = cache_config.replacement_policy.value
         max_size_mb = cache_config.max_size_mb
         max_num_items = cache_config.max_num_items
+        default_ttl_seconds = cache_config.default_ttl_seconds
+        compression_level = cache_config.compression_level
+        compression_threshold_bytes = cache_config.compression_threshold_bytes
         if max_num_items is not None:
-            response = requests.post(self.url + "/set_configuration", data={'replacement_policy': replacement_policy,
+            response = outbound.post(self.url + "/set_configuration", data={'replacement_policy': replacement_policy,
                                                                             'max_size_mb': max_size_mb,
-                                                                            'max_num_items': max_num_items})
+                                                                            'max_num_items': max_num_items,
+                                                                            'default_ttl_seconds': default_ttl_seconds,
+                                                                            'compression_level': compression_level,
+                                                                            'compression_threshold_bytes': compression_threshold_bytes})
         else:
-            response = requests.post(self.url + "/set_configuration", data={'replacement_policy': replacement_policy,
-                                                                            'max_size_mb': max_size_mb})
+            response = outbound.post(self.url + "/set_configuration", data={'replacement_policy': replacement_policy,
+                                                                            'max_size_mb': max_size_mb,
+                                                                            'default_ttl_seconds': default_ttl_seconds,
+                                                                            'compression_level': compression_level,
+                                                                            'compression_threshold_bytes': compression_threshold_bytes})
 
         json_response = response.json()
         return json_response['success'] is True
 
     def get_is_active(self):
-        response = requests.get(self.url + "/get_is_active")
+        response = outbound.get(self.url + "/get_is_active")
         json_response = response.json()
         if json_response['success'] is not True:
             return None
         return json_response['is_active']
 
     def set_is_active(self, is_active):
-        response = requests.post(self.url + "/set_is_active", data={'is_active': is_active})
+        response = outbound.post(self.url + "/set_is_active", data={'is_active': is_active})
         json_response = response.json()
         return json_response['success'] is True
 
@@ -300,15 +671,52 @@ class MemcacheApi:
     def deactivate(self):
         return self.set_is_active(False)
 
+    def get_stats(self):
+        response = outbound.get(self.url + "/stats")
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None
+        return json_response['stats']
+
+    def get_compression_stats(self):
+        response = outbound.get(self.url + "/get_compression_stats")
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None
+        return json_response['compression_stats']
+
+    def get_hot_keys(self, count=DEFAULT_HOT_KEY_COUNT):
+        """ Returns the node's hot keys and the total number of requests they are counted against. """
+        response = outbound.get(self.url + "/hot_keys", params={'count': count})
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None, None
+        return json_response['hot_keys'], json_response['total']
+
+    def get_shrink_progress(self):
+        response = outbound.get(self.url + "/shrink_progress")
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None
+        return json_response['shrink']
+
+    def get_miss_ratio_curve(self):
+        """ Returns the node's predicted miss rate curve and the estimated number of gets it is based on. """
+        response = outbound.get(self.url + "/miss_ratio_curve")
+        json_response = response.json()
+        if json_response['success'] is not True:
+            return None, None
+        return json_response['curve'], json_response['num_gets']
+
     def get_stat_id(self):
-        response = requests.get(self.url + "/get_stat_id")
+        response = outbound.get(self.url + "/get_stat_id")
         json_response = response.json()
         if json_response['success'] is not True:
             return None
         return json_response['stat_id']
 
     def set_stat_id(self, stat_id):
-        response = requests.post(self.url + "/set_stat_id", data={'stat_id': stat_id})
+        response = outbound.post(self.url + "/set_stat_id", data={'stat_id': stat_id})
         json_response = response.json()
         return json_response['success'] is True
 
@@ -1,9 +1,11 @@
 from flask import Flask, request
 from app.autoscaler.autoscaler import AutoScaler
+from app.metrics import instrument_app
 import logging
 
 # Configure Flask APP
 autoscalerapp = Flask(__name__, static_folder='../static')
+instrument_app(autoscalerapp)
 autoscaler = AutoScaler()
 
 # Define top level module logger
@@ -1,4 +1,5 @@
-from datetime import datetime
+import threading
+from datetime import datetime, timezone
 
 import boto3
 from app.common import TimeBoxedCacheStats
@@ -123,91 +124,56 @@ def get_jason_cloudwatch_client():
 
 
 STATS_NAMESPACE = "TEST3"
+# Max number of data points CloudWatch accepts in one put_metric_data call
+MAX_METRIC_DATA_PER_PUT = 1000
+
+shared_cloudwatch_client = None
+shared_cloudwatch_client_lock = threading.Lock()
+
+
+def get_shared_cloudwatch_client():
+    """ Get a CloudWatch client shared by the whole process, creating it on first use.
+    Creating a session and client is far more expensive than the calls made with them. """
+    global shared_cloudwatch_client
+    with shared_cloudwatch_client_lock:
+        if shared_cloudwatch_client is None:
+            shared_cloudwatch_client = get_jason_cloudwatch_client()
+        return shared_cloudwatch_client
 
 
 def save_time_boxed_cache_stats(node_name: str, tb_cache_stat: TimeBoxedCacheStats):
-    save_cache_stats(node_name=node_name,
-                     total_num_req=tb_cache_stat.num_req_served,
-                     num_get_req=tb_cache_stat.num_get_req,
-                     num_misses=tb_cache_stat.num_misses,
-                     num_hits=tb_cache_stat.num_hits,
-                     cache_size_bytes=tb_cache_stat.cache_size_bytes,
-                     num_items_in_cache=tb_cache_stat.num_items_in_cache,
-                     miss_rate=tb_cache_stat.miss_rate,
-                     hit_rate=tb_cache_stat.hit_rate)
-
-
-def save_cache_stats(node_name, total_num_req, num_get_req, num_misses, num_hits, cache_size_bytes,
-                     num_items_in_cache, miss_rate, hit_rate):
-    dimensions = [{'Name': 'STATS_BY_NODE', 'Value': node_name}]
-    if miss_rate is not None:
-        get_jason_cloudwatch_client().put_metric_data(
-            MetricData=[
-                {
-                    'MetricName': 'MISS_RATE',
-                    'Dimensions': dimensions,
-                    'Unit': 'None',
-                    'Value': miss_rate,
-                    'StorageResolution': 1
-                },
-                {
-                    'MetricName': 'HIT_RATE',
-                    'Dimensions': dimensions,
-                    'Unit': 'None',
-                    'Value': hit_rate,
-                    'StorageResolution': 1
-                }
-            ],
-            Namespace=STATS_NAMESPACE
-        )
+    put_cache_stat_metric_data(get_shared_cloudwatch_client(),
+                               build_cache_stat_metric_data(node_name, tb_cache_stat))
 
-    get_jason_cloudwatch_client().put_metric_data(
-        MetricData=[
-            {
-                'MetricName': 'TOT_NUM_REQ',
-                'Dimensions': dimensions,
-                'Unit': 'None',
-                'Value': total_num_req,
-                'StorageResolution': 1
-            },
-            {
-                'MetricName': 'NUM_GET_REQ',
-                'Dimensions': dimensions,
-                'Unit': 'None',
-                'Value': num_get_req,
-                'StorageResolution': 1
-            },
-            {
-                'MetricName': 'NUM_MISSES',
-                'Dimensions': dimensions,
-                'Unit': 'None',
-                'Value': num_misses,
-                'StorageResolution': 1
-            },
-            {
-                'MetricName': 'NUM_HITS',
-                'Dimensions': dimensions,
-                'Unit': 'None',
-                'Value': num_hits,
-                'StorageResolution': 1
-            },
-            {
-                'MetricName': 'CACHE_SIZE_BYTES',
-                'Dimensions': dimensions,
-                'Unit': 'None',
-                'Value': cache_size_bytes,
-                'StorageResolution': 1
-            },
-            {
-                'MetricName': 'NUM_ITEMS_IN_CACHE',
-                'Dimensions': dimensions,
-                'Unit': 'None',
-                'Value': num_items_in_cache,
-                'StorageResolution': 1
-            },
-        ],
-        Namespace=STATS_NAMESPACE
-    )
+
+def build_cache_stat_metric_data(node_name: str, tb_cache_stat: TimeBoxedCacheStats):
+    """ Get the CloudWatch metric data points of one cache stats sample, timestamped at the end of the sample. """
+    dimensions = [{'Name': 'STATS_BY_NODE', 'Value': node_name}]
+    timestamp = datetime.fromtimestamp(tb_cache_stat.end_time, tz=timezone.utc)
+    values = [('TOT_NUM_REQ', tb_cache_stat.num_req_served),
+              ('NUM_GET_REQ', tb_cache_stat.num_get_req),
+              ('NUM_MISSES', tb_cache_stat.num_misses),
+              ('NUM_HITS', tb_cache_stat.num_hits),
+              ('CACHE_SIZE_BYTES', tb_cache_stat.cache_size_bytes),
+              ('NUM_ITEMS_IN_CACHE', tb_cache_stat.num_items_in_cache)]
+    if tb_cache_stat.miss_rate is not None:
+        values.append(('MISS_RATE', tb_cache_stat.miss_rate))
+        values.append(('HIT_RATE', tb_cache_stat.hit_rate))
+
+    return [{'MetricName': metric_name,
+             'Dimensions': dimensions,
+             'Timestamp': timestamp,
+             'Unit': 'None',
+             'Value': value,
+             'StorageResolution': 1}
+            for (metric_name, value) in values]
+
+
+def put_cache_stat_metric_data(cw_client, metric_data):
+    """ Publish metric data points in as few put_metric_data calls as CloudWatch allows. """
+    for batch_start in range(0, len(metric_data), MAX_METRIC_DATA_PER_PUT):
+        cw_client.put_metric_data(MetricData=metric_data[batch_start:batch_start + MAX_METRIC_DATA_PER_PUT],
+                                  Namespace=STATS_NAMESPACE)
 
 
 def get_aggregated_cache_stats_at_time(node_names, end_time):
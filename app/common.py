@@ -1,4 +1,5 @@
 # THIS FILE IS USED TO DEFINE COMMON CLASSES/INTERFACES ACROSS THE VARIOUS FLASK APPS
+import base64
 import os
 import sys
 from enum import Enum
@@ -62,6 +63,43 @@ class TimeBoxedCacheStats:
 class ReplacementPolicy(Enum):
     RANDOM = "random"
     LRU = "lru"
+    LFU = "lfu"  # LFU with dynamic aging
+    ARC = "arc"  # Adaptive Replacement Cache
+    W_TINY_LFU = "w-tinylfu"  # Window TinyLFU with a count-min sketch admission filter
+    GDSF = "gdsf"  # GreedyDual-Size-Frequency, weighs entry size and refill cost
+
+
+# Default max number of keys examined per page of a key scan
+DEFAULT_SCAN_COUNT = 1000
+# Default number of hot keys reported by a node or the pool
+DEFAULT_HOT_KEY_COUNT = 10
+
+# Value types Memcache stores as raw bytes rather than text
+BINARY_VALUE_TYPES = (bytes, bytearray, memoryview)
+
+
+def encode_value_for_json(value):
+    """ Get a JSON safe (img_data, is_binary) pair for a cached value, base64 encoding binary values. """
+    if isinstance(value, BINARY_VALUE_TYPES):
+        return base64.b64encode(value).decode('ascii'), True
+    return value, False
+
+
+def decode_value_from_json(img_data, is_binary):
+    """ Reverse encode_value_for_json, returning bytes for binary values and the text as is otherwise. """
+    if img_data is not None and is_binary:
+        return base64.b64decode(img_data)
+    return img_data
+
+
+def value_to_bytes(value):
+    """ Get the raw bytes of a cached value, utf-8 encoding text values. """
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return bytes(value)
+
+
+DEFAULT_COMPRESSION_THRESHOLD_BYTES = 1024
 
 
 class CacheConfig:
@@ -70,8 +108,16 @@ class CacheConfig:
     replacement_policy: ReplacementPolicy
     max_size_mb: int
     max_num_items: int
-
-    def __init__(self, replacement_policy, max_size_mb, max_num_items):
+    # TTL applied to puts that don't specify one, None means entries never expire.
+    # Defined at class level so configs pickled before this field existed still load.
+    default_ttl_seconds = None
+    # zlib level (1-9) values are compressed with, None or 0 disables compression
+    compression_level = None
+    # Values smaller than this are never compressed
+    compression_threshold_bytes = DEFAULT_COMPRESSION_THRESHOLD_BYTES
+
+    def __init__(self, replacement_policy, max_size_mb, max_num_items, default_ttl_seconds=None,
+                 compression_level=None, compression_threshold_bytes=None):
         """ Create a new CacheConfig instance with default values. """
         self.replacement_policy = replacement_policy
         self.max_size_mb = max_size_mb
@@ -79,6 +125,12 @@ class CacheConfig:
             self.max_num_items = 10000000  # 10 million should be plenty as a default value
         else:
             self.max_num_items = max_num_items
+        self.default_ttl_seconds = default_ttl_seconds
+        self.compression_level = compression_level
+        if compression_threshold_bytes is None:
+            self.compression_threshold_bytes = DEFAULT_COMPRESSION_THRESHOLD_BYTES
+        else:
+            self.compression_threshold_bytes = compression_threshold_bytes
 
     def is_equivalent_to(self, other_config):
         """ Check if provided cache config instance is equivalent to this one. """
@@ -86,7 +138,10 @@ class CacheConfig:
             return False
         return (self.replacement_policy == other_config.replacement_policy
                 and self.max_size_mb == other_config.max_size_mb
-                and self.max_num_items == other_config.max_num_items)
+                and self.max_num_items == other_config.max_num_items
+                and self.default_ttl_seconds == other_config.default_ttl_seconds
+                and self.compression_level == other_config.compression_level
+                and self.compression_threshold_bytes == other_config.compression_threshold_bytes)
 
 
 ### LOGGING CONFIGURATION ###
@@ -6,15 +6,18 @@ from PIL import Image
 import base64
 from io import BytesIO
 import os
+import time
 import logging
 from app.apis import *
 import socket
 from app.boto_utils import *
+from app.metrics import instrument_app
 
 pool_sizes = ["","",""] # Init with 3 empty messages
 
 # Configure Flask APP
 frontendapp = Flask(__name__, static_folder='../static')
+instrument_app(frontendapp)
 
 # Define Upload Folder Path
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -95,19 +98,20 @@ def display_image():
     key = request.form.get('key')  # Get Key From User
     print("Displayed Key:", key)
 
-    # Call ManagerApi.get to see if img is in cache
-    img_data = ManagerApi.get(key) # should return None if image key not found
+    # Call ManagerApi.get_raw to see if img is in cache
+    img_data = ManagerApi.get_raw(key) # should return None if image key not found
 
     # If Image not in cache then call database
     if (img_data == None):
         if key not in StorageApi.get_keys():
             return render_template('unknownKey.html')
 
+        refill_start_time = time.time()
         img_url  = StorageApi.get_img_url(key)
-        response = requests.get(img_url)
+        response = outbound.get(img_url)
+        refill_cost_ms = (time.time() - refill_start_time) * 1000
         img = Image.open(BytesIO(response.content))
 
-        # Encode the image data in base64
         img_buffer = BytesIO()
         try:
             img.save(img_buffer, format="JPEG")
@@ -115,15 +119,15 @@ def display_image():
             print("Failed to save JPEG, will try png")
             img.save(img_buffer, format="PNG")
         img_data = img_buffer.getvalue()
-        encoded_img_data = base64.b64encode(img_data).decode('utf-8')
 
-        ManagerApi.put(key, encoded_img_data)  # Call ManagerApi.put to save encoded_img in cache
+        ManagerApi.put_raw(key, img_data, refill_cost_ms)  # Cache the raw image bytes, no encoding needed
         print("displaying from DB")
-        return render_template('display_Image_from_data.html', filename=encoded_img_data)
-
     else:
         print("displaying from memcache")
-        return render_template('display_Image_from_data.html', filename=img_data)
+
+    # Encode the image data in base64 for the HTML page only
+    encoded_img_data = base64.b64encode(img_data).decode('utf-8')
+    return render_template('display_Image_from_data.html', filename=encoded_img_data)
 
 
 #FROM URL
@@ -157,7 +161,7 @@ def show_contents():
         db_keys_string = ', '.join(db_keys)
 
     mc_keys_string = "EMPTY"
-    mc_keys = ManagerApi.get_all_keys()
+    mc_keys = list(ManagerApi.iter_keys())
     if mc_keys is not None and len(mc_keys) > 0:
         mc_keys_string = ', '.join(mc_keys)
     return render_template('show_contents.html', key_data_db = db_keys_string, key_data_mc = mc_keys_string)
@@ -246,6 +250,14 @@ def api_configure_cache():
         replacement_policy = ReplacementPolicy.RANDOM
     elif policy == "LRU":
         replacement_policy = ReplacementPolicy.LRU
+    elif policy == "LFU":
+        replacement_policy = ReplacementPolicy.LFU
+    elif policy == "ARC":
+        replacement_policy = ReplacementPolicy.ARC
+    elif policy == "W-TinyLFU":
+        replacement_policy = ReplacementPolicy.W_TINY_LFU
+    elif policy == "GDSF":
+        replacement_policy = ReplacementPolicy.GDSF
     else:
         return {
             "success": "false",
@@ -301,8 +313,8 @@ def api_upload():
 def api_key(key_value):
 
     key = key_value
-    # Call ManagerApi.get to see if img is in cache
-    img_data = ManagerApi.get(key)  # should return None if image key not found
+    # Call ManagerApi.get_raw to see if img is in cache
+    img_data = ManagerApi.get_raw(key)  # should return None if image key not found
 
     # If Image not in cache then call database
     if (img_data == None):
@@ -315,17 +327,16 @@ def api_key(key_value):
                 }
             }
 
+        refill_start_time = time.time()
         img_url = StorageApi.get_img_url(key)
-        response = requests.get(img_url)
+        response = outbound.get(img_url)
+        refill_cost_ms = (time.time() - refill_start_time) * 1000
         img = Image.open(BytesIO(response.content))
 
-        # Encode the image data in base64
         img_buffer = BytesIO()
         img.save(img_buffer, format="JPEG")
         img_data = img_buffer.getvalue()
-        encoded_img_data = base64.b64encode(img_data).decode('utf-8')
-        img_data = encoded_img_data
-        ManagerApi.put(key, encoded_img_data)  # Call ManagerApi.put to save encoded_img in cache
+        ManagerApi.put_raw(key, img_data, refill_cost_ms)  # Cache the raw image bytes, no encoding needed
         print("returning from DB")
     else:
         print("returning from memcache")
@@ -333,6 +344,6 @@ def api_key(key_value):
     response = {
                 "success": "true",
                 "key" : key,
-                "content" : img_data
+                "content" : base64.b64encode(img_data).decode('utf-8')  # Encode in base64 for the JSON response only
                 }
     return response
@@ -0,0 +1,71 @@
+import bisect
+import hashlib
+
+# Number of virtual nodes of the heaviest node of a ring, lighter nodes get proportionally fewer
+DEFAULT_NUM_VNODES = 160
+
+
+def hash_to_token(string):
+    """ Get the position of a string on the ring, the first 8 bytes of its md5 digest as an integer. """
+    return int.from_bytes(hashlib.md5(string.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """ Consistent hash ring mapping keys to nodes.
+    Each node is placed on the ring at several virtual node tokens derived from its id, in proportion to its weight,
+    and a key belongs to the node owning the first token at or after the key's own token. Adding or removing one of
+    N equally weighted nodes therefore only moves about 1/N of the keys.
+    Rings are immutable, the sorted token array is computed once so lookups are a single bisect. """
+    tokens: list
+    owners: list
+    nodes: list
+    num_vnodes: int
+    weighted_node_ids: list
+
+    def __init__(self, weighted_nodes, num_vnodes=DEFAULT_NUM_VNODES):
+        """ weighted_nodes is a list of (node_id, node, weight) tuples. Node ids must be stable across restarts, like
+        a node's url, so the same keys map to the same nodes every time. The heaviest node gets num_vnodes tokens. """
+        self.nodes = [node for (node_id, node, weight) in weighted_nodes]
+        self.num_vnodes = num_vnodes
+        self.weighted_node_ids = [(node_id, weight) for (node_id, node, weight) in weighted_nodes]
+        max_weight = max((weight for (node_id, node, weight) in weighted_nodes), default=0)
+        ring = []
+        for (node_id, node, weight) in weighted_nodes:
+            node_num_vnodes = max(1, round(num_vnodes * weight / max_weight)) if max_weight > 0 else num_vnodes
+            for vnode_idx in range(node_num_vnodes):
+                ring.append((hash_to_token(node_id + "#" + str(vnode_idx)), node_id, node))
+        # Ties between tokens are broken by node id, so every process builds the same ring
+        ring.sort(key=lambda item: (item[0], item[1]))
+        self.tokens = [token for (token, node_id, node) in ring]
+        self.owners = [node for (token, node_id, node) in ring]
+
+    @classmethod
+    def from_routing_table(cls, routing_table):
+        """ Rebuild a ring from its routing table, with every node represented by its id. """
+        return cls([(node_id, node_id, weight) for (node_id, weight) in routing_table["nodes"]],
+                   routing_table["num_vnodes"])
+
+    def get_routing_table(self):
+        """ Get what is needed to rebuild this ring in another process, ready to be sent as JSON. """
+        return {"nodes": [[node_id, weight] for (node_id, weight) in self.weighted_node_ids],
+                "num_vnodes": self.num_vnodes}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get_node(self, key):
+        """ Get the node responsible for a key, or None if the ring is empty. """
+        if not self.tokens:
+            return None
+        index = bisect.bisect_left(self.tokens, hash_to_token(key))
+        if index == len(self.tokens):
+            index = 0
+        return self.owners[index]
+
+
+def is_token_in_range(token, start_token, end_token):
+    """ Check if a token is in the ring range (start_token, end_token], which wraps around past the largest token if
+    start_token >= end_token. """
+    if start_token < end_token:
+        return start_token < token <= end_token
+    return token > start_token or token <= end_token
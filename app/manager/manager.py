@@ -1,38 +1,88 @@
-import hashlib
 import logging
 import math
+import os
 import time
+from threading import Thread, Lock, Event
 
 from app.rw_lock import ReadWriteLock
-from app.common import CacheConfig, ReplacementPolicy, MAX_NUM_NODES, EXPECTED_NUM_NODES
+from app.hash_ring import HashRing
+from app.memcache.stats import LockStats, lock_stats_to_metric_families
+from app.common import CacheConfig, ReplacementPolicy, MAX_NUM_NODES, EXPECTED_NUM_NODES, DEFAULT_SCAN_COUNT, \
+    DEFAULT_HOT_KEY_COUNT
 from app.apis import FrontEndApi, MemcacheApi, StorageApi
+from app.metrics import MetricFamily
+from app.memcache.mrc import interpolate_miss_rate
 from app.boto_utils import get_memcache_ip_addresses, get_aggregated_cache_stats_at_time
 
 logger = logging.getLogger(__name__)
-TOTAL_NUM_PARTITIONS = 16
+# Keep what active nodes restored from their snapshots when the manager starts instead of clearing them, enabled by
+# setting KEEP_NODE_CONTENTS_ON_BOOT=true in the environment. Off by default: invalidations sent while a node was down
+# are lost, so a restored snapshot may serve stale values.
+KEEP_NODE_CONTENTS_ON_BOOT = os.environ.get("KEEP_NODE_CONTENTS_ON_BOOT", "false").lower() == "true"
+# Max time an operation waits for the pool lock before failing with LockTimeoutError, so a wedged resize can't hang
+# every request
+LOCK_TIMEOUT_SECONDS = 10
+# How often the migrator checks on a node exporting its keys
+EXPORT_POLL_INTERVAL_SECONDS = 0.5
+# A failed migration is retried this many times in total before it is abandoned. The nth retry waits
+# MIGRATION_RETRY_BACKOFF_SECONDS * 2^(n-1) first.
+MIGRATION_MAX_ATTEMPTS = 5
+MIGRATION_RETRY_BACKOFF_SECONDS = 1
 
 DEFAULT_CACHE_CONFIG = CacheConfig(replacement_policy=ReplacementPolicy.LRU, max_size_mb=10, max_num_items=None)
 
-def md5_hash(string):
-    # encode the string into bytes
-    encoded_string = string.encode('utf-8')
 
-    # create an MD5 hash object
-    md5_hash_object = hashlib.md5()
-
-    # update the hash object with the encoded string
-    md5_hash_object.update(encoded_string)
-
-    # get the hexadecimal digest of the hash
-    hex_digest = md5_hash_object.hexdigest()
-
-    return hex_digest
+class MigrationTask:
+    """ Progress handle of a background migration moving keys to their owner on the current hash ring. """
+    task_id: int
+    started_at: float
+    finished_at = None
+    error = None  # Why the migration was abandoned, None if it wasn't
+    num_nodes_exported: int
+    num_keys_moved: int
+    num_keys_lost: int
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.started_at = time.time()
+        self.num_nodes_exported = 0
+        self.num_keys_moved = 0
+        self.num_keys_lost = 0
+
+    def is_done(self):
+        return self.finished_at is not None
+
+    def to_dict(self):
+        return {"task_id": self.task_id,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "is_done": self.is_done(),
+                "error": self.error,
+                "num_nodes_exported": self.num_nodes_exported,
+                "num_keys_moved": self.num_keys_moved,
+                "num_keys_lost": self.num_keys_lost}
 
 
 class Manager:
-    """ Maintains pool of memcache nodes and contains operations to interact with them. """
+    """ Maintains pool of memcache nodes and contains operations to interact with them.
+    Resizing the pool is done in two phases so requests never wait on it: the new hash ring goes live as soon as the
+    active nodes change, under a write lock held only to swap the rings, then a background migrator moves keys to
+    their new owner. Until it is done, gets missing on a key's owner fall through to its owner on the previous ring. """
     rw_lock: ReadWriteLock
+    lock_stats: LockStats
+    hash_ring: HashRing
+    previous_hash_ring = None  # Ring before the last resize, until its migration is done
+    migration_sources: list  # Nodes that may still hold keys they don't own on the current ring
+    migration_task = None
+    migration_generation: int
+    migration_pending: Event
+    resize_lock: Lock
+    # Keys invalidated while a migration is in progress. An export may have read a key just before it was invalidated
+    # and import the old value after, so they are invalidated again once all exports are done.
+    invalidated_during_migration: set
+    invalidated_lock: Lock
     cache_config: CacheConfig
+    config_lock: Lock  # Serializes config updates, so concurrent ones reach every node in the same order
     max_available_nodes: int
     cache_pool = []  # List of all available nodes whether active or not
     active_nodes = []
@@ -42,7 +92,17 @@ class Manager:
 
     def __init__(self):
         logger.info("Starting a new Manager instance.")
-        self.rw_lock = ReadWriteLock()
+        self.lock_stats = LockStats()
+        self.rw_lock = ReadWriteLock(self.lock_stats)
+        self.hash_ring = HashRing([])
+        self.migration_sources = []
+        self.migration_generation = 0
+        self.migration_pending = Event()
+        self.resize_lock = Lock()
+        self.invalidated_during_migration = set()
+        self.invalidated_lock = Lock()
+        self.config_lock = Lock()
+        Thread(target=self.migration_loop, daemon=True).start()
 
         run_remote = 1
 
@@ -56,13 +116,12 @@ class Manager:
             self.set_configuration(config)
 
             # Setup cache pool
-            self.rw_lock.acquire_write()
-            self.load_cache_pool()
-            #self.load_cache_pool_debug()
-            self.max_available_nodes = len(self.cache_pool)
-            self.reload_stat_ids()
-            self.active_nodes_history.append((time.time(), len(self.active_nodes)))
-            self.rw_lock.release_write()
+            with self.rw_lock.write_locked():
+                self.load_cache_pool()
+                #self.load_cache_pool_debug()
+                self.max_available_nodes = len(self.cache_pool)
+                self.reload_stat_ids()
+                self.active_nodes_history.append((time.time(), len(self.active_nodes)))
 
     def load_cache_pool(self):
         # Load ip addresses of EC2 instances w caches running
@@ -76,13 +135,19 @@ class Manager:
             if len(self.cache_pool) == EXPECTED_NUM_NODES:
                 break
             cache_api = MemcacheApi(ip_addr)
-            cache_api.clear()  # Clear caches for new run
+            is_active = cache_api.get_is_active()
+            if not KEEP_NODE_CONTENTS_ON_BOOT or is_active is not True:
+                cache_api.clear()  # Clear caches for new run
             cache_api.set_configuration(self.cache_config)
             self.cache_pool.append(MemcacheApi(ip_addr))
-            is_active = cache_api.get_is_active()
             if is_active is not None and is_active is True:
                 self.active_nodes.append(cache_api)
 
+        self.rebuild_hash_ring()
+        if KEEP_NODE_CONTENTS_ON_BOOT:
+            # The pool may have changed since the nodes were snapshotted, move any key held by the wrong node
+            self.start_migration(None, self.active_nodes)
+
     def load_cache_pool_debug(self):
         from app.memcache.memcache import Memcache
         """ Load a local version of the memcache instance for debugging purposes. """
@@ -100,13 +165,17 @@ class Manager:
             self.cache_pool.append(cache)
 
     def set_configuration(self, cache_config):
+        """ Make cache_config the config of the pool and of every node. The pool lock is only held to swap the config
+        and rebuild the ring, the nodes are configured once it is released. """
         if cache_config is None:
             return False
-        self.rw_lock.acquire_write()
-        self.cache_config = cache_config
-        for node in self.cache_pool:
-            node.set_configuration(cache_config)
-        self.rw_lock.release_write()
+        with self.config_lock:
+            with self.rw_lock.write_locked(LOCK_TIMEOUT_SECONDS):
+                self.cache_config = cache_config
+                self.rebuild_hash_ring()
+                nodes = list(self.cache_pool)
+            for node in nodes:
+                node.set_configuration(cache_config)
         return True
 
     def generate_node_state_id(self, node_index):
@@ -134,60 +203,90 @@ class Manager:
 
     def get_num_active_nodes(self):
         """ Get the number of active nodes. """
-        self.rw_lock.acquire_read()
-        num = len(self.active_nodes)
-        self.rw_lock.release_read()
+        with self.rw_lock.read_locked(LOCK_TIMEOUT_SECONDS):
+            num = len(self.active_nodes)
         return num
 
-    def get_hash_partition_from_key(self, key):
-        """ Get the hash partition (1-16) based on the provided key. """
-        hashed_key = md5_hash(key)
-        if len(hashed_key) < 32:
-            return 1
-        first_char = hashed_key[0]
-        return int(first_char, TOTAL_NUM_PARTITIONS) + 1
+    def rebuild_hash_ring(self):
+        """ Place the active nodes on a new consistent hash ring, weighted by their configured max size.
+        Must be called with the write lock held whenever the active nodes or their config change. """
+        self.hash_ring = HashRing([(node.get_url(), node, self.cache_config.max_size_mb)
+                                  for node in self.active_nodes])
 
     def get_active_node_for_key(self, key):
         """ Get an active cache for the provided key. """
-        partition = self.get_hash_partition_from_key(key)
-        active_cache_idx = (partition - 1) % len(self.active_nodes)
-        return self.active_nodes[active_cache_idx]
+        return self.hash_ring.get_node(key)
+
+    def get_nodes_for_key(self, key):
+        """ Get the owner of a key on the current ring and, while a migration is in progress, its owner on the
+        previous ring if that is another node, None otherwise. Nodes are only called once the lock is released. """
+        with self.rw_lock.read_locked(LOCK_TIMEOUT_SECONDS):
+            node = self.hash_ring.get_node(key)
+            previous_node = None if self.previous_hash_ring is None else self.previous_hash_ring.get_node(key)
+        return node, (previous_node if previous_node is not node else None)
 
-    def put(self, key, value):
+    def put(self, key, value, refill_cost_ms=None, ttl_seconds=None):
         """ Place key/value pair into cache pool. """
-        self.rw_lock.acquire_read()
-        cache = self.get_active_node_for_key(key)
-        result = cache.put(key, value)
-        self.rw_lock.release_read()
+        cache, previous_cache = self.get_nodes_for_key(key)
+        result = cache.put(key, value, refill_cost_ms, ttl_seconds)
+        if result is not True:
+            # A failed put still invalidated the key, an export racing it could bring back the old value
+            self.record_invalidation(key)
+        if previous_cache is not None:
+            # Gets falling through to the previous owner must not find the old value, even if this put failed
+            previous_cache.invalidate(key)
         return result
 
     def get(self, key):
         """ Get key/value pair into cache pool. """
-        self.rw_lock.acquire_read()
-        print("manager.get1")
-        cache = self.get_active_node_for_key(key)
-        print("manager.get2")
+        cache, previous_cache = self.get_nodes_for_key(key)
         value = cache.get(key)
-        print("manager.get3")
-        self.rw_lock.release_read()
-        print("manager.get4")
+        if value is None and previous_cache is not None:
+            value = previous_cache.get(key)
+        return value
+
+    def get_raw(self, key):
+        """ Get the raw bytes of a value in the cache pool. """
+        cache, previous_cache = self.get_nodes_for_key(key)
+        value = cache.get_raw(key)
+        if value is None and previous_cache is not None:
+            value = previous_cache.get_raw(key)
         return value
 
     def invalidate(self, key):
         """ Get key/value pair into cache pool. """
-        self.rw_lock.acquire_read()
-        cache = self.get_active_node_for_key(key)
+        # Recorded before the nodes are called, so a migration can't finish without seeing it once the key may be gone
+        self.record_invalidation(key)
+        cache, previous_cache = self.get_nodes_for_key(key)
         result = cache.invalidate(key)
-        self.rw_lock.release_read()
+        if previous_cache is not None:
+            result = previous_cache.invalidate(key) and result
         return result
 
+    def record_invalidation(self, key):
+        """ Remember a key is being invalidated if a migration is in progress. """
+        if self.migration_sources:
+            with self.invalidated_lock:
+                self.invalidated_during_migration.add(key)
+
+    def replay_invalidations(self, nodes):
+        """ Invalidate again, on every provided node, the keys invalidated since the migration started. Must only be
+        called once all exports are done, so no old value can be imported afterwards. """
+        with self.invalidated_lock:
+            keys = list(self.invalidated_during_migration)
+            self.invalidated_during_migration = set()
+        if len(keys) == 0:
+            return
+        for node in nodes:
+            node.invalidate_many(keys)
+        logger.info("Invalidated again " + str(len(keys)) + " key(s) invalidated during the migration.")
+
     def clear_all_nodes(self):
         """ Clear all the data in all the nodes. """
-        self.rw_lock.acquire_read()
-        result = True
-        for cache in self.cache_pool:
-            result = result and cache.clear()
-        self.rw_lock.release_read()
+        with self.rw_lock.read_locked(LOCK_TIMEOUT_SECONDS):
+            result = True
+            for cache in self.cache_pool:
+                result = result and cache.clear()
         return result
 
     def notify_pool_size_change(self, old_size, new_size):
@@ -240,28 +339,26 @@ class Manager:
                         + " available. Will activate all available nodes.")
             num_to_activate = num_available
 
-        # ACTIVATE NODES
-        num_activated = 0
-        self.rw_lock.acquire_write()
-        affected_nodes = self.active_nodes.copy()
+        with self.resize_lock:
+            with self.rw_lock.read_locked(LOCK_TIMEOUT_SECONDS):
+                active_urls = {node.get_url() for node in self.active_nodes}
+                inactive_nodes = [node for node in self.cache_pool if node.get_url() not in active_urls]
 
-        # Activate nodes in consecutive order
-        for node in self.cache_pool:
-            is_active = node.get_is_active()
-            if num_activated == num_to_activate:
-                break
-            if not is_active:
+            # Activate nodes in consecutive order
+            nodes_to_activate = inactive_nodes[:num_to_activate]
+            for node in nodes_to_activate:
                 node.set_is_active(True)
-                self.active_nodes.append(node)
-                num_activated += 1
 
-        # Rebalance keys in affected nodes
-        self.rebalance_keys(affected_nodes)
+            # Route keys to the new nodes right away, existing keys are moved over in the background
+            with self.rw_lock.write_locked(LOCK_TIMEOUT_SECONDS):
+                previous_hash_ring = self.hash_ring
+                self.active_nodes.extend(nodes_to_activate)
+                self.rebuild_hash_ring()
+                self.start_migration(previous_hash_ring, previous_hash_ring.nodes)
+                new_num_active_nodes = len(self.active_nodes)
 
         # Notify changes
-        self.notify_pool_size_change(num_active_nodes, len(self.active_nodes))
-        self.rw_lock.release_write()
-
+        self.notify_pool_size_change(num_active_nodes, new_num_active_nodes)
         return True
 
     def shrink_nodes_by_factor(self, shrink_factor):
@@ -290,44 +387,145 @@ class Manager:
                         + " available for this. Will deactivate all available nodes except 1")
             num_to_deactivate = num_available
 
-        # DEACTIVATE NODES
-        deactivated_nodes = []
-        self.rw_lock.acquire_write()
-
-        # Deactivate nodes in reverse order
-        for node in reversed(self.active_nodes):
-            if len(deactivated_nodes) == num_to_deactivate:
-                break
-            node.set_is_active(False)
-            self.active_nodes.remove(node)
-            deactivated_nodes.append(node)
-
-        # Rebalance keys in affected nodes
-        self.rebalance_keys(deactivated_nodes + self.active_nodes)
-
-        # Clear deactivated nodes
-        for deactivated_node in deactivated_nodes:
-            deactivated_node.clear()
+        with self.resize_lock:
+            # Deactivate nodes in reverse order. They keep serving gets falling through to them until their keys
+            # are migrated and they are cleared.
+            with self.rw_lock.write_locked(LOCK_TIMEOUT_SECONDS):
+                previous_hash_ring = self.hash_ring
+                # The pool may have shrunk since it was counted, always keep 1 node
+                num_to_deactivate = min(num_to_deactivate, len(self.active_nodes) - 1)
+                nodes_to_deactivate = self.active_nodes[len(self.active_nodes) - num_to_deactivate:]
+                for node in nodes_to_deactivate:
+                    self.active_nodes.remove(node)
+                self.rebuild_hash_ring()
+                self.start_migration(previous_hash_ring, previous_hash_ring.nodes)
+                new_num_active_nodes = len(self.active_nodes)
+
+            for node in nodes_to_deactivate:
+                node.set_is_active(False)
 
         # Notify changes
-        self.notify_pool_size_change(num_active_nodes, len(self.active_nodes))
-        self.rw_lock.release_write()
+        self.notify_pool_size_change(num_active_nodes, new_num_active_nodes)
         return True
 
-    def rebalance_keys(self, affected_nodes):
-        """ Redistribute key/values from affected nodes to currently active nodes. """
-        for affected_node in affected_nodes:
-            keys = affected_node.get_all_keys()
-            for key in keys:
-                new_node = self.get_active_node_for_key(key)
-                if new_node != affected_node:
-                    # Need to take this item from the old node and put it in the new one
-                    value = affected_node.get(key)
-                    if value is None:
-                        logger.error("Got none value when rebalancing nodes.")
-                    else:
-                        new_node.put(key, value)
-                        affected_node.invalidate(key)
+    def start_migration(self, previous_hash_ring, source_nodes):
+        """ Have the migrator move the keys of source_nodes to their owner on the current ring, with reads falling
+        through to previous_hash_ring meanwhile. Must be called with the write lock held, right after the ring
+        changed. A migration still in progress is restarted with the union of both sources; reads then only fall
+        through to the latest previous ring, so keys from the earlier resize miss until they are moved. """
+        self.previous_hash_ring = previous_hash_ring
+        for node in source_nodes:
+            if node not in self.migration_sources:
+                self.migration_sources.append(node)
+        if self.migration_task is None or self.migration_task.is_done():
+            self.migration_task = MigrationTask(0 if self.migration_task is None else self.migration_task.task_id + 1)
+        self.migration_generation += 1
+        self.migration_pending.set()
+
+    def migration_loop(self):
+        while True:
+            self.migration_pending.wait()
+            self.migration_pending.clear()
+            self.run_migration_with_retries()
+
+    def run_migration_with_retries(self):
+        """ Run the pending migration, retrying it with backoff when it fails and abandoning it once
+        MIGRATION_MAX_ATTEMPTS attempts failed. A resize during the backoff hands over to the migration it starts. """
+        with self.rw_lock.read_locked(LOCK_TIMEOUT_SECONDS):
+            generation = self.migration_generation
+        error = None
+        for attempt in range(MIGRATION_MAX_ATTEMPTS):
+            if attempt > 0 and self.migration_pending.wait(MIGRATION_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1)):
+                return
+            try:
+                self.run_migration()
+                return
+            except Exception as e:
+                error = e
+                logger.error("Key migration attempt " + str(attempt + 1) + " failed: " + str(e))
+        self.abandon_migration(generation, str(error))
+
+    def abandon_migration(self, generation, error):
+        """ Give up on a migration that keeps failing: reads stop falling through to the previous ring, the
+        invalidations recorded meanwhile are replayed as far as the nodes allow, and the error is recorded on the
+        migration task. Keys not moved yet are lost, as on a cache miss. """
+        with self.rw_lock.write_locked(LOCK_TIMEOUT_SECONDS):
+            if generation != self.migration_generation:
+                return
+            hash_ring = self.hash_ring
+            source_nodes = list(self.migration_sources)
+            self.previous_hash_ring = None
+            self.migration_sources = []
+            task = self.migration_task
+            task.error = error
+            task.finished_at = time.time()
+            active_urls = {node.get_url() for node in self.active_nodes}
+        logger.error("Abandoned the key migration after " + str(MIGRATION_MAX_ATTEMPTS) + " failed attempts: " + error)
+        try:
+            self.replay_invalidations(hash_ring.nodes + [node for node in source_nodes if node not in hash_ring.nodes])
+        except Exception as e:
+            logger.error("Failed to replay invalidations of the abandoned migration: " + str(e))
+        # Inactive sources would otherwise serve the keys they kept once reactivated
+        for node in source_nodes:
+            if node.get_url() not in active_urls:
+                try:
+                    node.clear()
+                except Exception as e:
+                    logger.error("Failed to clear node " + node.get_url() + " after abandoning the migration: "
+                                 + str(e))
+
+    def run_migration(self):
+        """ Move every key of the migration sources that is owned by another node on the current ring, without
+        holding the pool lock during any node request. Gives up as soon as the pool is resized again, the migration
+        then restarts on the new ring. Once all sources are migrated, reads stop falling through to the previous
+        ring and the sources that are no longer active are cleared. """
+        with self.rw_lock.read_locked(LOCK_TIMEOUT_SECONDS):
+            generation = self.migration_generation
+            hash_ring = self.hash_ring
+            source_nodes = list(self.migration_sources)
+            task = self.migration_task
+
+        for source_node in source_nodes:
+            if not self.migrate_keys(source_node, hash_ring, task, generation):
+                return
+        self.replay_invalidations(hash_ring.nodes + [node for node in source_nodes if node not in hash_ring.nodes])
+
+        with self.rw_lock.write_locked(LOCK_TIMEOUT_SECONDS):
+            if generation != self.migration_generation:
+                return
+            self.previous_hash_ring = None
+            self.migration_sources = []
+            task.finished_at = time.time()
+            active_urls = {node.get_url() for node in self.active_nodes}
+        for node in source_nodes:
+            if node.get_url() not in active_urls:
+                node.clear()
+        logger.info("Migrated " + str(task.num_keys_moved) + " key(s) after resizing the pool.")
+
+    def migrate_keys(self, source_node, hash_ring, task, generation):
+        """ Have source_node export the keys owned by another node on hash_ring straight to their owner, which only
+        adds those it doesn't hold yet so a newer put is never overwritten. Entries never go through the manager.
+        Returns False if the pool was resized since the migration started. """
+        if generation != self.migration_generation:
+            return False
+        export = source_node.export_entries(hash_ring.get_routing_table())
+        if export is None:
+            raise ValueError("Node " + source_node.get_url() + " failed to start exporting its keys")
+        while not export["is_done"]:
+            time.sleep(EXPORT_POLL_INTERVAL_SECONDS)
+            export = source_node.get_export_progress()
+            if export is None:
+                raise ValueError("Lost track of the export of node " + source_node.get_url())
+        task.num_nodes_exported += 1
+        task.num_keys_moved += export["num_exported"]
+        task.num_keys_lost += export["num_failed"]
+        return generation == self.migration_generation
+
+    def get_migration_progress(self):
+        """ Get the progress of the last background key migration, or None if the pool was never resized. """
+        with self.rw_lock.read_locked(LOCK_TIMEOUT_SECONDS):
+            task = self.migration_task
+        return None if task is None else task.to_dict()
 
     def get_stat_ids(self):
         if len(self.stat_ids) != EXPECTED_NUM_NODES:
@@ -336,19 +534,121 @@ class Manager:
         return self.stat_ids
 
     def get_all_keys(self):
-        self.rw_lock.acquire_read()
-        keys = []
-        for node in self.active_nodes:
-            keys.extend(node.get_all_keys())
-        self.rw_lock.release_read()
-        return keys
+        return list(self.iter_keys())
+
+    def scan_keys(self, cursor=None, count=DEFAULT_SCAN_COUNT, prefix=None):
+        """ Get one page of the keys stored across all active nodes, taking a single page from one node per call.
+        The cursor is the index of the active node being scanned followed by that node's own cursor, the scan is
+        done once the returned cursor is None. Resizing the pool during a scan may skip or repeat keys. """
+        if cursor is None or cursor == "":
+            node_idx, node_cursor = 0, None
+        else:
+            node_idx_string, node_cursor = cursor.split(":", 1)
+            node_idx = int(node_idx_string)
+
+        with self.rw_lock.read_locked(LOCK_TIMEOUT_SECONDS):
+            nodes = list(self.active_nodes)
+        if node_idx >= len(nodes):
+            return [], None
+
+        keys, node_cursor = nodes[node_idx].scan_keys(node_cursor, count, prefix)
+        if keys is None:
+            raise ValueError("Invalid scan cursor: " + cursor)
+        if node_cursor is None:
+            node_idx += 1
+            node_cursor = ""
+        next_cursor = None if node_idx >= len(nodes) else str(node_idx) + ":" + node_cursor
+        return keys, next_cursor
+
+    def iter_keys(self, prefix=None):
+        """ Iterate over the keys stored across all active nodes, streaming them from one node at a time. """
+        with self.rw_lock.read_locked(LOCK_TIMEOUT_SECONDS):
+            nodes = list(self.active_nodes)
+        for node in nodes:
+            yield from node.iter_keys(prefix)
+
+    def get_hot_keys(self, count=DEFAULT_HOT_KEY_COUNT):
+        """ Get the count most requested keys across all active nodes, most requested first, along with the number of
+        requests each node counted. Counts of a key reported by several nodes, like right after a resize, are summed.
+        Each hot key lists the nodes reporting it and its share of the requests of the whole pool, so a key whose
+        share dwarfs its node's fair share of the pool stands out. """
+        with self.rw_lock.read_locked(LOCK_TIMEOUT_SECONDS):
+            nodes = list(self.active_nodes)
+
+        hot_keys = {}
+        node_totals = []
+        pool_total = 0
+        for node in nodes:
+            node_hot_keys, node_total = node.get_hot_keys(count)
+            if node_hot_keys is None:
+                logger.error("Failed to get hot keys from node " + node.get_url())
+                continue
+            node_totals.append({"node": node.get_url(), "total": node_total})
+            pool_total += node_total
+            for node_hot_key in node_hot_keys:
+                hot_key = hot_keys.setdefault(node_hot_key["key"],
+                                              {"key": node_hot_key["key"], "count": 0, "error": 0, "nodes": []})
+                hot_key["count"] += node_hot_key["count"]
+                hot_key["error"] += node_hot_key["error"]
+                hot_key["nodes"].append(node.get_url())
+
+        top_hot_keys = sorted(hot_keys.values(), key=lambda hot_key: hot_key["count"], reverse=True)[:count]
+        for hot_key in top_hot_keys:
+            hot_key["share"] = hot_key["count"] / pool_total if pool_total else 0
+        return top_hot_keys, node_totals
+
+    def get_shrink_progress(self):
+        """ Get the progress of the last background shrink of every node, which nodes start when the configured
+        budget is lowered below what they hold. """
+        with self.rw_lock.read_locked(LOCK_TIMEOUT_SECONDS):
+            nodes = list(self.cache_pool)
+        return [{"node": node.get_url(), "shrink": node.get_shrink_progress()} for node in nodes]
+
+    def predict_miss_rate(self, num_nodes):
+        """ Predict the miss rate of the pool if it had num_nodes active nodes, from the miss ratio curves of the
+        active nodes. Keys are spread evenly across active nodes, so going from n to num_nodes nodes gives the keys
+        of each node num_nodes / n times its capacity, which is read off its curve. Nodes are weighted by their number
+        of recent gets. Returns None if no node has sampled any get yet. """
+        with self.rw_lock.read_locked(LOCK_TIMEOUT_SECONDS):
+            nodes = list(self.active_nodes)
+        if len(nodes) == 0:
+            return None
+
+        size_multiplier = num_nodes / len(nodes)
+        total_gets = 0
+        total_misses = 0
+        for node in nodes:
+            curve, num_gets = node.get_miss_ratio_curve()
+            if curve is None:
+                logger.error("Failed to get the miss ratio curve of node " + node.get_url())
+                continue
+            miss_rate = interpolate_miss_rate([(point["size_multiplier"], point["miss_rate"]) for point in curve],
+                                              size_multiplier)
+            if miss_rate is None or num_gets == 0:
+                continue
+            total_gets += num_gets
+            total_misses += miss_rate * num_gets
+        return total_misses / total_gets if total_gets > 0 else None
 
     def set_cache_config(self, cache_config: CacheConfig):
-        self.rw_lock.acquire_read()
-        for node in self.cache_pool:
-            node.set_configuration(cache_config)
-        self.rw_lock.release_read()
+        with self.config_lock:
+            with self.rw_lock.read_locked(LOCK_TIMEOUT_SECONDS):
+                nodes = list(self.cache_pool)
+            for node in nodes:
+                node.set_configuration(cache_config)
         return True
 
+    def collect_metrics(self):
+        """ Get the size of the cache pool and the wait and hold times of the pool lock as metric families to
+        scrape. """
+        return [MetricFamily("manager_active_nodes", "gauge", "Number of memcache nodes in the active pool.")
+                .add_sample({}, len(self.active_nodes)),
+                MetricFamily("manager_available_nodes", "gauge", "Number of memcache nodes that can be activated.")
+                .add_sample({}, len(self.cache_pool)),
+                MetricFamily("manager_migration_in_progress", "gauge",
+                             "Whether keys are being moved to their owner after a resize of the pool.")
+                .add_sample({}, 1 if self.previous_hash_ring is not None or self.migration_sources else 0)] \
+            + lock_stats_to_metric_families("manager_pool_lock", self.lock_stats)
+
     def get_last_min_stats(self):
         return get_aggregated_cache_stats_at_time(self.stat_ids, time.time())
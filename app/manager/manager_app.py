@@ -1,12 +1,13 @@
 import time
 from datetime import datetime
-from flask import Flask, request
+from flask import Flask, request, Response
 from flask import render_template
 import matplotlib
 import matplotlib.pyplot as plt
 from PIL import Image
 import base64
 import io
+import json
 import re
 
 import app.boto_utils
@@ -16,12 +17,17 @@ import requests
 import logging
 
 from app.manager.manager import Manager
+from app.rw_lock import LockTimeoutError
+from app.metrics import REGISTRY, instrument_app
 from app.boto_utils import get_aggregated_cache_stats_at_time
-from app.common import TimeBoxedCacheStats
+from app.common import TimeBoxedCacheStats, encode_value_for_json, DEFAULT_SCAN_COUNT, \
+    DEFAULT_HOT_KEY_COUNT
 
 # Configure Flask APP
 managerapp = Flask(__name__, static_folder='../static')
 manager = Manager()
+instrument_app(managerapp)
+REGISTRY.register(manager.collect_metrics)
 
 # Define top level module logger
 logger = logging.getLogger(__name__)
@@ -82,8 +88,8 @@ def apply_c_r_policy(): # Capacity and Replacement Policy
     selected_policy_string = request.form.get('replacement-policy')
 
     replacement_policy = ReplacementPolicy.LRU
-    if selected_policy_string == "RANDOM":
-        replacement_policy = ReplacementPolicy.RANDOM
+    if selected_policy_string in ReplacementPolicy.__members__:
+        replacement_policy = ReplacementPolicy[selected_policy_string]
 
     capacity_mb = int(re.search(r'\d+', selected_capacity_string).group())
 
@@ -173,16 +179,36 @@ def apply_auto_resize():
 def put():
     key = request.form['key']
     img_data = request.form['img_data']
-    return {"success": manager.put(key, img_data)}
+    refill_cost_ms = request.form.get('refill_cost_ms', type=float)
+    ttl_seconds = request.form.get('ttl_seconds', type=float)
+    return {"success": manager.put(key, img_data, refill_cost_ms, ttl_seconds)}
+
+@managerapp.route('/put_raw', methods = ['POST'])
+def put_raw():
+    key = request.args['key']
+    img_data = request.get_data()
+    refill_cost_ms = request.args.get('refill_cost_ms', type=float)
+    ttl_seconds = request.args.get('ttl_seconds', type=float)
+    return {"success": manager.put(key, img_data, refill_cost_ms, ttl_seconds)}
 
 @managerapp.route('/get', methods = ['GET'])
 def get():
     key = request.form['key']
     print("WE REACH manager.get")
+    img_data, is_binary = encode_value_for_json(manager.get(key))
     return {"success": True,
-            "img_data": manager.get(key)
+            "img_data": img_data,
+            "is_binary": is_binary
             }
 
+@managerapp.route('/get_raw', methods = ['GET'])
+def get_raw():
+    key = request.args['key']
+    img_data = manager.get_raw(key)
+    if img_data is None:
+        return Response(status=404)
+    return Response(img_data, mimetype='application/octet-stream')
+
 @managerapp.route('/clear_all_nodes', methods = ['DELETE'])
 def clear_all_nodes():
     return {"success": manager.clear_all_nodes()}
@@ -197,6 +223,41 @@ def shrink_nodes():
     shrink_factor = float(request.form['shrink_factor'])
     return {"success": manager.shrink_nodes_by_factor(shrink_factor)}
 
+@managerapp.errorhandler(LockTimeoutError)
+def lock_timeout(e):
+    logger.warning("Timed out waiting for the pool lock: " + str(e))
+    return {"success": False}, 503
+
+@managerapp.route('/lock_stats', methods=['GET'])
+def lock_stats():
+    """ Wait and hold time percentiles of the pool lock, by read or write mode. """
+    return {"success": True,
+            "lock_stats": manager.lock_stats.to_dict()
+            }
+
+@managerapp.route('/shrink_progress', methods=['GET'])
+def shrink_progress():
+    return {"success": True,
+            "shrink": manager.get_shrink_progress()
+            }
+
+@managerapp.route('/migration_progress', methods=['GET'])
+def migration_progress():
+    """ Progress of the last background key migration, None if the pool was never resized. """
+    return {"success": True,
+            "migration": manager.get_migration_progress()
+            }
+
+@managerapp.route('/predict_miss_rate', methods=['GET'])
+def predict_miss_rate():
+    num_nodes = request.args.get('num_nodes', type=int)
+    if num_nodes is None or num_nodes <= 0 or num_nodes > manager.max_available_nodes:
+        logger.warning("Invalid number of nodes to predict the miss rate of:" + str(num_nodes))
+        return {"success": False}
+    return {"success": True,
+            "miss_rate": manager.predict_miss_rate(num_nodes)
+            }
+
 @managerapp.route('/get_num_active_nodes', methods=['GET'])
 def get_num_active_nodes():
     return {"success": True,
@@ -223,6 +284,42 @@ def get_keys():
             "keys": manager.get_all_keys()
             }
 
+@managerapp.route('/scan_keys', methods=['GET'])
+def scan_keys():
+    cursor = request.args.get('cursor')
+    count = request.args.get('count', DEFAULT_SCAN_COUNT, type=int)
+    prefix = request.args.get('prefix')
+    if count <= 0:
+        logger.warning("Invalid scan count:" + str(count))
+        return {"success": False}
+    try:
+        keys, next_cursor = manager.scan_keys(cursor, count, prefix)
+    except ValueError:
+        logger.warning("Invalid scan cursor:" + str(cursor))
+        return {"success": False}
+    return {"success": True,
+            "keys": keys,
+            "cursor": next_cursor
+            }
+
+@managerapp.route('/stream_keys', methods=['GET'])
+def stream_keys():
+    prefix = request.args.get('prefix')
+    return Response((json.dumps(key) + "\n" for key in manager.iter_keys(prefix)),
+                    mimetype='application/x-ndjson')
+
+@managerapp.route('/hot_keys', methods=['GET'])
+def hot_keys():
+    count = request.args.get('count', DEFAULT_HOT_KEY_COUNT, type=int)
+    if count <= 0:
+        logger.warning("Invalid hot key count:" + str(count))
+        return {"success": False}
+    pool_hot_keys, node_totals = manager.get_hot_keys(count)
+    return {"success": True,
+            "hot_keys": pool_hot_keys,
+            "node_totals": node_totals
+            }
+
 @managerapp.route('/getRate', methods=['GET'])
 def get_rate():
     rate_type = request.form['type']
@@ -331,20 +428,25 @@ def set_configuration():
     replacement_policy_string = request.form.get('replacement_policy')
     max_size_mb_str = request.form.get('max_size_mb')
     max_num_items_str = request.form.get('max_num_items')
+    default_ttl_seconds = request.form.get('default_ttl_seconds', type=float)
+    compression_level = request.form.get('compression_level', type=int)
+    compression_threshold_bytes = request.form.get('compression_threshold_bytes', type=int)
 
-    if replacement_policy_string == ReplacementPolicy.RANDOM.value:
-        replacement_policy = ReplacementPolicy.RANDOM
-    elif replacement_policy_string == ReplacementPolicy.LRU.value:
-        replacement_policy = ReplacementPolicy.RANDOM
-    else:
-        logger.warning("Invalid specification for replacement policy:" + replacement_policy_string)
+    try:
+        replacement_policy = ReplacementPolicy(replacement_policy_string)
+    except ValueError:
+        logger.warning("Invalid specification for replacement policy:" + str(replacement_policy_string))
         return {"success": False}
 
     max_size_mb = None if max_size_mb_str is None else float(max_size_mb_str)
-    max_num_items = None if max_size_mb_str is None else int(max_num_items_str)
+    max_num_items = None if max_num_items_str is None else int(max_num_items_str)
     if max_size_mb is None and max_num_items is None:
         logger.warning("One of max_size_mb or max_num_items must be specified.")
         return {"success": False}
+    if compression_level is not None and not 0 <= compression_level <= 9:
+        logger.warning("Invalid compression level:" + str(compression_level))
+        return {"success": False}
 
-    success = manager.set_configuration(CacheConfig(replacement_policy, max_size_mb, max_num_items))
+    success = manager.set_configuration(CacheConfig(replacement_policy, max_size_mb, max_num_items, default_ttl_seconds,
+                                                compression_level, compression_threshold_bytes))
     return {"success": success}
@@ -0,0 +1,214 @@
+import asyncio
+import io
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+logger = logging.getLogger(__name__)
+
+# Idle keep-alive connections are closed after this long without a new request
+KEEP_ALIVE_TIMEOUT_SECONDS = 75
+# Max size of the request line and headers of a single request
+MAX_HEADER_BYTES = 64 * 1024
+# Max size of a request body
+MAX_BODY_BYTES = 64 * 1024 * 1024
+# Number of worker threads running the requests that aren't safe to run on the event loop
+NUM_EXECUTOR_THREADS = 16
+
+REASON_PHRASES = {400: "Bad Request", 413: "Payload Too Large", 431: "Request Header Fields Too Large",
+                  501: "Not Implemented"}
+
+
+class HttpError(Exception):
+    """ Raised for requests that can't be parsed, the connection is answered with status and then closed. """
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class AsyncWsgiServer:
+    """ HTTP/1.1 server running a WSGI app from an asyncio event loop.
+    Connections are coroutines instead of OS threads, so thousands of idle keep-alive connections only cost their
+    read buffers. Requests whose path is_loop_path accepts, checked on every request, are run directly on the loop,
+    which only suits CPU-trivial handlers that never block for long, like the memcache node's key/value operations.
+    Every other request runs in a pool of worker threads, so one slow route can't freeze every connection. """
+    host: str
+    port: int
+    executor: ThreadPoolExecutor
+
+    def __init__(self, wsgi_app, host, port, is_loop_path=None):
+        self.wsgi_app = wsgi_app
+        self.host = host
+        self.port = port
+        self.is_loop_path = is_loop_path
+        self.executor = ThreadPoolExecutor(NUM_EXECUTOR_THREADS, thread_name_prefix="wsgi")
+
+    async def call(self, on_loop, function, *args):
+        """ Call a function on the loop if on_loop is set, otherwise in a worker thread without blocking the loop. """
+        if on_loop:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port, limit=MAX_HEADER_BYTES)
+        logger.info("Serving HTTP on an event loop on port " + str(self.port))
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        remote_addr = peer[0] if peer else ""
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), KEEP_ALIVE_TIMEOUT_SECONDS)
+                except HttpError as e:
+                    writer.write(encode_error_response(e.status))
+                    await writer.drain()
+                    return
+                if request is None:
+                    return
+                keep_alive = await self.respond(writer, request, remote_addr)
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        """ Read one request, returns (method, target, version, headers, body) or None if the peer closed the
+        connection between requests. """
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise
+        except asyncio.LimitOverrunError:
+            raise HttpError(431)
+
+        lines = head.decode('latin-1').split("\r\n")
+        request_line = lines[0].split(" ")
+        if len(request_line) != 3:
+            raise HttpError(400)
+        method, target, version = request_line
+        headers = []
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, separator, value = line.partition(":")
+            if not separator:
+                raise HttpError(400)
+            headers.append((name.strip().lower(), value.strip()))
+
+        header_dict = dict(headers)
+        if 'transfer-encoding' in header_dict:
+            # None of our clients send chunked request bodies
+            raise HttpError(501)
+        try:
+            content_length = int(header_dict.get('content-length', 0))
+        except ValueError:
+            raise HttpError(400)
+        if content_length < 0:
+            raise HttpError(400)
+        if content_length > MAX_BODY_BYTES:
+            raise HttpError(413)
+        body = await reader.readexactly(content_length) if content_length > 0 else b""
+        return method, target, version, headers, body
+
+    async def respond(self, writer, request, remote_addr):
+        """ Run the WSGI app for a request and write its response. Returns whether the connection can be reused. """
+        method, target, version, headers, body = request
+        connection_header = dict(headers).get('connection', "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection_header != "close"
+        else:
+            keep_alive = connection_header == "keep-alive"
+
+        environ = self.build_environ(method, target, version, headers, body, remote_addr)
+        on_loop = self.is_loop_path is not None and self.is_loop_path(environ['PATH_INFO'])
+        response_start = []
+
+        def start_response(status, response_headers, exc_info=None):
+            response_start[:] = [status, response_headers]
+
+        result = await self.call(on_loop, self.wsgi_app, environ, start_response)
+        try:
+            body_iter = iter(result)
+            # Apps may only call start_response once they produced their first chunk
+            first_chunk = await self.call(on_loop, next, body_iter, b"")
+            status, response_headers = response_start
+            has_length = any(name.lower() == 'content-length' for (name, value) in response_headers)
+            chunked = not has_length and version == "HTTP/1.1"
+            if not has_length and not chunked:
+                # HTTP/1.0 peers can only find the end of an unsized body by the connection closing
+                keep_alive = False
+
+            head_lines = ["HTTP/1.1 " + status]
+            head_lines.extend(name + ": " + value for (name, value) in response_headers
+                              if name.lower() != 'connection')
+            if chunked:
+                head_lines.append("Transfer-Encoding: chunked")
+            head_lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+            writer.write(("\r\n".join(head_lines) + "\r\n\r\n").encode('latin-1'))
+
+            chunk = first_chunk
+            while True:
+                if chunk:
+                    writer.write(encode_chunk(chunk) if chunked else chunk)
+                    # Apply backpressure so a streamed response never buffers more than the transport allows
+                    await writer.drain()
+                chunk = await self.call(on_loop, next, body_iter, None)
+                if chunk is None:
+                    break
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            if hasattr(result, 'close'):
+                await self.call(on_loop, result.close)
+        return keep_alive
+
+    def build_environ(self, method, target, version, headers, body, remote_addr):
+        path, separator, query_string = target.partition("?")
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': "",
+            'PATH_INFO': unquote(path, 'latin-1'),
+            'QUERY_STRING': query_string,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': remote_addr,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': "http",
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for (name, value) in headers:
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'content-length':
+                key = 'HTTP_' + name.upper().replace("-", "_")
+                environ[key] = environ[key] + "," + value if key in environ else value
+        return environ
+
+
+def encode_chunk(chunk):
+    return b"%x\r\n" % len(chunk) + chunk + b"\r\n"
+
+
+def encode_error_response(status):
+    return ("HTTP/1.1 " + str(status) + " " + REASON_PHRASES[status] + "\r\n"
+            "Content-Length: 0\r\nConnection: close\r\n\r\n").encode('latin-1')
+
+
+def run_async_server(wsgi_app, host, port, is_loop_path=None):
+    """ Serve a WSGI app from an asyncio event loop until the process is stopped, see AsyncWsgiServer. """
+    asyncio.run(AsyncWsgiServer(wsgi_app, host, port, is_loop_path).serve_forever())
@@ -0,0 +1,256 @@
+import math
+import socket
+import struct
+import threading
+
+# Length-prefixed binary protocol spoken by memcache nodes next to their HTTP API.
+# Every request and response is a fixed size header followed by a body made of extras, key and value:
+#   magic (1B) | opcode (1B) | key length (2B) | extras length (1B) | flags (1B) | status (2B)
+#   | body length (4B) | opaque (4B)
+# The opaque is echoed back in the response, so a client can pipeline many requests over one connection and
+# match responses to them. Responses are always sent back in the order the requests were received.
+HEADER = struct.Struct('!BBHBBHII')
+REQUEST_MAGIC = 0x80
+RESPONSE_MAGIC = 0x81
+# Largest body a node accepts in one frame
+MAX_BODY_LENGTH = 64 * 1024 * 1024
+
+# Opcodes
+OP_GET = 0x00
+OP_PUT = 0x01
+OP_DELETE = 0x04
+OP_GET_MANY = 0x10
+OP_PUT_MANY = 0x11
+OP_DELETE_MANY = 0x14
+
+# Response statuses
+STATUS_OK = 0x00
+STATUS_NOT_FOUND = 0x01
+STATUS_NOT_STORED = 0x02
+STATUS_BAD_REQUEST = 0x03
+STATUS_UNKNOWN_OPCODE = 0x04
+
+# Value flags, values are raw bytes unless VALUE_IS_TEXT is set in which case they are utf-8 encoded text
+FLAG_VALUE_IS_TEXT = 0x01
+# Set on batch response items for keys that missed on a get or weren't stored on a put
+FLAG_MISS = 0x02
+
+# Extras of a put: ttl_seconds and refill_cost_ms, NaN when not provided. Batch puts only carry a ttl.
+PUT_EXTRAS = struct.Struct('!dd')
+PUT_MANY_EXTRAS = struct.Struct('!d')
+# Batch bodies are a sequence of items, each a key length, flags and value length followed by key and value
+BATCH_ITEM = struct.Struct('!HBI')
+
+
+class ProtocolError(Exception):
+    """ Raised when a peer sends a frame that doesn't follow the binary protocol. """
+
+
+def encode_frame(magic, opcode, key=b'', value=b'', extras=b'', flags=0, status=STATUS_OK, opaque=0):
+    """ Build a complete frame out of its header fields and body sections. """
+    body_length = len(extras) + len(key) + len(value)
+    return b''.join((HEADER.pack(magic, opcode, len(key), len(extras), flags, status, body_length, opaque),
+                     extras, key, value))
+
+
+def decode_frame(buffer, offset, expected_magic):
+    """ Decode the frame starting at offset of buffer.
+    Returns (opcode, flags, status, opaque, extras, key, value) along with the offset of the next frame, or None if
+    the buffer doesn't hold a complete frame yet. Raises ProtocolError for malformed frames. """
+    if len(buffer) - offset < HEADER.size:
+        return None
+    magic, opcode, key_length, extras_length, flags, status, body_length, opaque = \
+        HEADER.unpack_from(buffer, offset)
+    if magic != expected_magic:
+        raise ProtocolError("Invalid magic byte: " + str(magic))
+    if body_length > MAX_BODY_LENGTH or key_length + extras_length > body_length:
+        raise ProtocolError("Invalid body length: " + str(body_length))
+    body_start = offset + HEADER.size
+    frame_end = body_start + body_length
+    if len(buffer) < frame_end:
+        return None
+    key_start = body_start + extras_length
+    value_start = key_start + key_length
+    extras = bytes(buffer[body_start:key_start])
+    key = bytes(buffer[key_start:value_start])
+    value = bytes(buffer[value_start:frame_end])
+    return (opcode, flags, status, opaque, extras, key, value), frame_end
+
+
+def encode_value(value):
+    """ Get the (bytes, flags) pair sent over the wire for a cached value. """
+    if isinstance(value, str):
+        return value.encode('utf-8'), FLAG_VALUE_IS_TEXT
+    return bytes(value), 0
+
+
+def decode_value(data, flags):
+    """ Reverse encode_value, returning text values as str and everything else as bytes. """
+    if flags & FLAG_VALUE_IS_TEXT:
+        return data.decode('utf-8')
+    return data
+
+
+def encode_optional_float(value):
+    return math.nan if value is None else float(value)
+
+
+def decode_optional_float(value):
+    return None if math.isnan(value) else value
+
+
+def encode_batch_items(items):
+    """ Encode a list of (key, data, flags) tuples into a batch body. """
+    parts = []
+    for (key, data, flags) in items:
+        encoded_key = key.encode('utf-8')
+        parts.append(BATCH_ITEM.pack(len(encoded_key), flags, len(data)))
+        parts.append(encoded_key)
+        parts.append(data)
+    return b''.join(parts)
+
+
+def decode_batch_items(body):
+    """ Decode a batch body into a list of (key, data, flags) tuples. Raises ProtocolError if it is truncated. """
+    items = []
+    offset = 0
+    while offset < len(body):
+        if len(body) - offset < BATCH_ITEM.size:
+            raise ProtocolError("Truncated batch item header")
+        key_length, flags, data_length = BATCH_ITEM.unpack_from(body, offset)
+        key_start = offset + BATCH_ITEM.size
+        data_start = key_start + key_length
+        offset = data_start + data_length
+        if offset > len(body):
+            raise ProtocolError("Truncated batch item")
+        items.append((body[key_start:data_start].decode('utf-8'), body[data_start:offset], flags))
+    return items
+
+
+class BinaryProtocolClient:
+    """ Client for the binary protocol of a single memcache node, keeping one connection open.
+    Calls are serialized by a lock, use a pipeline to send many requests in one round trip. """
+    host: str
+    port: int
+    timeout_seconds: float
+
+    def __init__(self, host, port, timeout_seconds=5):
+        self.host = host
+        self.port = port
+        self.timeout_seconds = timeout_seconds
+        self.sock = None
+        self.buffer = bytearray()
+        self.next_opaque = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.sock is None:
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout_seconds)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.buffer = bytearray()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def execute(self, frames):
+        """ Send a list of (opcode, key, value, extras, flags) requests in one write and return their decoded
+        responses in order, each as (status, flags, extras, key, value). The connection is dropped on any error,
+        so the next call starts on a fresh one. """
+        with self.lock:
+            try:
+                self.connect()
+                first_opaque = self.next_opaque
+                self.next_opaque = (self.next_opaque + len(frames)) & 0xFFFFFFFF
+                self.sock.sendall(b''.join(
+                    encode_frame(REQUEST_MAGIC, opcode, key, value, extras, flags,
+                                 opaque=(first_opaque + i) & 0xFFFFFFFF)
+                    for i, (opcode, key, value, extras, flags) in enumerate(frames)))
+                return [self.read_response((first_opaque + i) & 0xFFFFFFFF) for i in range(len(frames))]
+            except (OSError, ProtocolError):
+                self.close()
+                raise
+
+    def read_response(self, expected_opaque):
+        while True:
+            decoded = decode_frame(self.buffer, 0, RESPONSE_MAGIC)
+            if decoded is not None:
+                (opcode, flags, status, opaque, extras, key, value), frame_end = decoded
+                del self.buffer[:frame_end]
+                if opaque != expected_opaque:
+                    raise ProtocolError("Out of order response: " + str(opaque))
+                return status, flags, extras, key, value
+            data = self.sock.recv(65536)
+            if not data:
+                raise ProtocolError("Connection closed by node")
+            self.buffer += data
+
+    def pipeline(self):
+        return BinaryPipeline(self)
+
+    def get(self, key):
+        return self.pipeline().get(key).execute()[0]
+
+    def put(self, key, value, refill_cost_ms=None, ttl_seconds=None):
+        return self.pipeline().put(key, value, refill_cost_ms, ttl_seconds).execute()[0]
+
+    def delete(self, key):
+        return self.pipeline().delete(key).execute()[0]
+
+    def get_many(self, keys):
+        """ Get the values of a list of keys in one request. Returns a dict of key to value, None for misses. """
+        body = encode_batch_items((key, b'', 0) for key in keys)
+        status, flags, extras, response_key, response_body = self.execute([(OP_GET_MANY, b'', body, b'', 0)])[0]
+        values = {key: None for key in keys}
+        for (key, data, item_flags) in decode_batch_items(response_body):
+            if not item_flags & FLAG_MISS:
+                values[key] = decode_value(data, item_flags)
+        return values
+
+    def put_many(self, values, ttl_seconds=None):
+        """ Put a dict of key/values in one request. Returns a dict of key to whether it was placed in cache. """
+        body = encode_batch_items((key,) + encode_value(value) for key, value in values.items())
+        extras = PUT_MANY_EXTRAS.pack(encode_optional_float(ttl_seconds))
+        status, flags, extras, response_key, response_body = self.execute([(OP_PUT_MANY, b'', body, extras, 0)])[0]
+        return {key: not item_flags & FLAG_MISS for (key, data, item_flags) in decode_batch_items(response_body)}
+
+    def delete_many(self, keys):
+        body = encode_batch_items((key, b'', 0) for key in keys)
+        status, flags, extras, response_key, response_body = self.execute([(OP_DELETE_MANY, b'', body, b'', 0)])[0]
+        return status == STATUS_OK
+
+
+class BinaryPipeline:
+    """ Queues single key requests to send them to a node in one write. execute returns one result per request:
+    the value (None on a miss) for a get and whether it succeeded for a put or delete. """
+
+    def __init__(self, client):
+        self.client = client
+        self.frames = []
+
+    def get(self, key):
+        self.frames.append((OP_GET, key.encode('utf-8'), b'', b'', 0))
+        return self
+
+    def put(self, key, value, refill_cost_ms=None, ttl_seconds=None):
+        data, flags = encode_value(value)
+        extras = PUT_EXTRAS.pack(encode_optional_float(ttl_seconds), encode_optional_float(refill_cost_ms))
+        self.frames.append((OP_PUT, key.encode('utf-8'), data, extras, flags))
+        return self
+
+    def delete(self, key):
+        self.frames.append((OP_DELETE, key.encode('utf-8'), b'', b'', 0))
+        return self
+
+    def execute(self):
+        frames = self.frames
+        self.frames = []
+        results = []
+        for (opcode, key, value, extras, flags), response in zip(frames, self.client.execute(frames)):
+            status, response_flags, response_extras, response_key, response_value = response
+            if opcode == OP_GET:
+                results.append(decode_value(response_value, response_flags) if status == STATUS_OK else None)
+            else:
+                results.append(status == STATUS_OK)
+        return results
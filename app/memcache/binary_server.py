@@ -0,0 +1,127 @@
+import logging
+import socket
+import socketserver
+import struct
+from threading import Thread
+from app.memcache.memcache import Memcache
+from app.memcache.binary_protocol import REQUEST_MAGIC, RESPONSE_MAGIC, OP_GET, OP_PUT, OP_DELETE, OP_GET_MANY, \
+    OP_PUT_MANY, OP_DELETE_MANY, STATUS_OK, STATUS_NOT_FOUND, STATUS_NOT_STORED, STATUS_BAD_REQUEST, \
+    STATUS_UNKNOWN_OPCODE, FLAG_MISS, PUT_EXTRAS, PUT_MANY_EXTRAS, ProtocolError, encode_frame, decode_frame, \
+    encode_value, decode_value, decode_optional_float, encode_batch_items, decode_batch_items
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from a connection per recv call
+RECV_SIZE = 256 * 1024
+
+
+class BinaryProtocolHandler(socketserver.BaseRequestHandler):
+    """ Serves one connection of the binary protocol.
+    All complete frames received in one read are handled before any response is written, and their responses are
+    sent back in a single write, so pipelined requests cost one syscall each way instead of one per request. """
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        memcache = self.server.memcache
+        buffer = bytearray()
+        while True:
+            data = self.request.recv(RECV_SIZE)
+            if not data:
+                return
+            buffer += data
+
+            responses = []
+            offset = 0
+            try:
+                while True:
+                    decoded = decode_frame(buffer, offset, REQUEST_MAGIC)
+                    if decoded is None:
+                        break
+                    frame, offset = decoded
+                    responses.append(handle_frame(memcache, *frame))
+            except ProtocolError as e:
+                # Framing is lost, answer what was parsed so far and drop the connection
+                logger.warning("Closing binary protocol connection: " + str(e))
+                self.request.sendall(b''.join(responses))
+                return
+            del buffer[:offset]
+            if responses:
+                self.request.sendall(b''.join(responses))
+
+
+def handle_frame(memcache: Memcache, opcode, flags, status, opaque, extras, key, value):
+    """ Run the operation of one request frame against memcache and return the encoded response frame. """
+    try:
+        response_status, response_flags, response_value = dispatch(memcache, opcode, flags, extras, key, value)
+    except (ProtocolError, UnicodeDecodeError, struct.error) as e:
+        logger.warning("Bad binary protocol request: " + str(e))
+        response_status, response_flags, response_value = STATUS_BAD_REQUEST, 0, b''
+    return encode_frame(RESPONSE_MAGIC, opcode, value=response_value, flags=response_flags,
+                        status=response_status, opaque=opaque)
+
+
+def dispatch(memcache: Memcache, opcode, flags, extras, key, value):
+    """ Returns the (status, flags, value) of the response to a request. """
+    if opcode == OP_GET:
+        cached_value = memcache.get(key.decode('utf-8'))
+        if cached_value is None:
+            return STATUS_NOT_FOUND, 0, b''
+        data, value_flags = encode_value(cached_value)
+        return STATUS_OK, value_flags, data
+
+    if opcode == OP_PUT:
+        ttl_seconds, refill_cost_ms = None, None
+        if extras:
+            ttl_seconds, refill_cost_ms = (decode_optional_float(field) for field in PUT_EXTRAS.unpack(extras))
+        if memcache.put(key.decode('utf-8'), decode_value(value, flags), refill_cost_ms, ttl_seconds):
+            return STATUS_OK, 0, b''
+        return STATUS_NOT_STORED, 0, b''
+
+    if opcode == OP_DELETE:
+        memcache.invalidate(key.decode('utf-8'))
+        return STATUS_OK, 0, b''
+
+    if opcode == OP_GET_MANY:
+        keys = [item_key for (item_key, data, item_flags) in decode_batch_items(value)]
+        items = []
+        for item_key, cached_value in memcache.get_many(keys).items():
+            if cached_value is None:
+                items.append((item_key, b'', FLAG_MISS))
+            else:
+                items.append((item_key,) + encode_value(cached_value))
+        return STATUS_OK, 0, encode_batch_items(items)
+
+    if opcode == OP_PUT_MANY:
+        ttl_seconds = decode_optional_float(PUT_MANY_EXTRAS.unpack(extras)[0]) if extras else None
+        values = {item_key: decode_value(data, item_flags)
+                  for (item_key, data, item_flags) in decode_batch_items(value)}
+        results = memcache.put_many(values, ttl_seconds)
+        items = [(item_key, b'', 0 if is_stored else FLAG_MISS) for item_key, is_stored in results.items()]
+        return STATUS_OK if all(results.values()) else STATUS_NOT_STORED, 0, encode_batch_items(items)
+
+    if opcode == OP_DELETE_MANY:
+        memcache.invalidate_many([item_key for (item_key, data, item_flags) in decode_batch_items(value)])
+        return STATUS_OK, 0, b''
+
+    return STATUS_UNKNOWN_OPCODE, 0, b''
+
+
+class BinaryProtocolServer(socketserver.ThreadingTCPServer):
+    """ Threaded TCP server exposing a Memcache instance over the binary protocol. """
+    daemon_threads = True
+    allow_reuse_address = True
+    memcache: Memcache
+
+    def __init__(self, memcache, host, port):
+        self.memcache = memcache
+        super().__init__((host, port), BinaryProtocolHandler)
+
+
+def start_binary_server(memcache, host, port):
+    """ Start serving memcache over the binary protocol on a background thread. Returns the server. """
+    server = BinaryProtocolServer(memcache, host, port)
+    Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Serving binary protocol on port " + str(port))
+    return server
@@ -0,0 +1,105 @@
+import threading
+import time
+import zlib
+
+# A compressed value is only kept if it is at most this fraction of the original size
+MAX_COMPRESSION_RATIO = 0.9
+# Values over 4 samples long are first checked by compressing a sample of their head, so incompressible payloads
+# like JPEG bytes don't pay for a full compression pass
+SAMPLE_BYTES = 4096
+
+
+class CompressedValue:
+    """ A cached value stored zlib compressed. Text values are utf-8 encoded before compression. """
+    __slots__ = ('data', 'is_text')
+
+    def __init__(self, data, is_text):
+        self.data = data
+        self.is_text = is_text
+
+
+class CompressionStats:
+    """ Counts how much compression saves and how much CPU time it costs. """
+    num_compressed: int
+    num_skipped: int
+    num_decompressed: int
+    original_bytes: int
+    compressed_bytes: int
+    compress_seconds: float
+    decompress_seconds: float
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.num_compressed = 0
+            self.num_skipped = 0
+            self.num_decompressed = 0
+            self.original_bytes = 0
+            self.compressed_bytes = 0
+            self.compress_seconds = 0
+            self.decompress_seconds = 0
+
+    def add_compression(self, original_bytes, compressed_bytes, seconds, is_kept):
+        with self.lock:
+            if is_kept:
+                self.num_compressed += 1
+                self.original_bytes += original_bytes
+                self.compressed_bytes += compressed_bytes
+            else:
+                self.num_skipped += 1
+            self.compress_seconds += seconds
+
+    def add_decompression(self, seconds):
+        with self.lock:
+            self.num_decompressed += 1
+            self.decompress_seconds += seconds
+
+    def to_dict(self):
+        with self.lock:
+            return {"num_compressed": self.num_compressed,
+                    "num_skipped": self.num_skipped,
+                    "num_decompressed": self.num_decompressed,
+                    "original_bytes": self.original_bytes,
+                    "compressed_bytes": self.compressed_bytes,
+                    "bytes_saved": self.original_bytes - self.compressed_bytes,
+                    "compress_seconds": self.compress_seconds,
+                    "decompress_seconds": self.decompress_seconds}
+
+
+def compress_value(value, level, threshold_bytes, stats: CompressionStats):
+    """ Get the value to store for a text or binary value: a CompressedValue if compressing it at the provided zlib
+    level pays off, the value itself otherwise. Values smaller than threshold_bytes are never compressed. """
+    if not level or isinstance(value, CompressedValue):
+        return value
+    is_text = isinstance(value, str)
+    data = value.encode('utf-8') if is_text else value
+    if len(data) < threshold_bytes:
+        return value
+
+    start_time = time.perf_counter()
+    if len(data) > 4 * SAMPLE_BYTES:
+        sample = zlib.compress(data[:SAMPLE_BYTES], 1)
+        if len(sample) > MAX_COMPRESSION_RATIO * SAMPLE_BYTES:
+            stats.add_compression(len(data), len(data), time.perf_counter() - start_time, is_kept=False)
+            return value
+    compressed = zlib.compress(data, level)
+    is_kept = len(compressed) <= MAX_COMPRESSION_RATIO * len(data)
+    stats.add_compression(len(data), len(compressed), time.perf_counter() - start_time, is_kept)
+    if not is_kept:
+        return value
+    return CompressedValue(compressed, is_text)
+
+
+def decompress_value(value, stats: CompressionStats):
+    """ Get the original value back from a value returned by compress_value. """
+    if not isinstance(value, CompressedValue):
+        return value
+    start_time = time.perf_counter()
+    data = zlib.decompress(value.data)
+    if value.is_text:
+        data = data.decode('utf-8')
+    stats.add_decompression(time.perf_counter() - start_time)
+    return data
@@ -0,0 +1,178 @@
+from bisect import bisect_right
+from sys import getsizeof
+from app.memcache.policies import EvictionPolicy
+from app.memcache.compression import CompressedValue
+
+# Amortized bytes a dict spends per key (hash table slot and index), measured with tracemalloc on CPython 3.11 for
+# tables of 10k+ keys.
+DICT_SLOT_BYTES = 40
+# Bytes the scan index spends per entry, a sequence number shared with the entry and a slot in each of its two lists
+SCAN_INDEX_BYTES = getsizeof(1 << 40) + 2 * 8
+
+
+class CacheEntry:
+    """ A single key/value pair stored in the cache along with the number of bytes it is charged for, the
+    measured cost of refilling it on a miss (in ms, None if unknown) and when it expires (None if never).
+    seq is the insertion sequence number the entry got from its table. """
+    __slots__ = ('key', 'value', 'size', 'refill_cost_ms', 'expires_at', 'seq')
+
+    def __init__(self, key, value, size, refill_cost_ms=None, expires_at=None):
+        self.key = key
+        self.value = value
+        self.size = size
+        self.refill_cost_ms = refill_cost_ms
+        self.expires_at = expires_at
+        self.seq = 0
+
+    def is_expired(self, now):
+        return self.expires_at is not None and self.expires_at <= now
+
+
+# Bytes charged for every entry on top of its key, payload and eviction policy bookkeeping
+ENTRY_OVERHEAD_BYTES = getsizeof(CacheEntry(None, None, 0)) + DICT_SLOT_BYTES + SCAN_INDEX_BYTES
+
+
+def get_value_size(value):
+    """ Get the number of bytes of process memory a cached value occupies. """
+    if isinstance(value, memoryview):
+        # A view only reports the size of the view object, not the buffer it keeps alive
+        return getsizeof(value) + value.nbytes
+    if isinstance(value, CompressedValue):
+        return getsizeof(value) + get_value_size(value.data)
+    return getsizeof(value)
+
+
+def compute_entry_size(key, value, policy=None):
+    """ Get the number of bytes of process memory a key/value pair occupies once stored in an EntryTable. """
+    size = getsizeof(key) + get_value_size(value) + ENTRY_OVERHEAD_BYTES
+    if policy is not None:
+        size += policy.entry_overhead_bytes
+    return size
+
+
+class EntryTable:
+    """ Indexed table of cache entries with O(1) size and item counters.
+    The eviction order of the entries is kept by the table's EvictionPolicy.
+    Every added entry gets the next insertion sequence number, and the scan index lists (seq, key) pairs in increasing
+    seq order, so scans resume from a sequence number rather than a position that removals and re-puts shift. Pairs
+    of removed or replaced entries are skipped by scans and compacted away once they outnumber the live ones. """
+    entries: dict
+    policy: EvictionPolicy
+    size_bytes: int
+    next_seq: int
+    scan_seqs: list
+    scan_keys_by_seq: list
+    num_stale_scan_slots: int
+
+    def __init__(self, policy):
+        self.entries = {}
+        self.policy = policy
+        self.size_bytes = 0
+        # Never reset, so a cursor taken before a clear can't skip entries added after it
+        self.next_seq = 1
+        self.scan_seqs = []
+        self.scan_keys_by_seq = []
+        self.num_stale_scan_slots = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """ Get the entry stored for a key without counting it as an access, or None if it isn't in the table. """
+        return self.entries.get(key)
+
+    def promote(self, key, now):
+        """ Record an access to the entry stored for a key. Returns the entry or None on a miss.
+        An entry that expired by now is removed and treated as a miss. """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.is_expired(now):
+            self.remove(key)
+            return None
+        self.policy.on_access(entry)
+        return entry
+
+    def add(self, key, value, refill_cost_ms=None, expires_at=None):
+        """ Store a key/value pair, replacing any existing entry for the key. """
+        self.remove(key)
+        entry = CacheEntry(key, value, compute_entry_size(key, value, self.policy), refill_cost_ms, expires_at)
+        entry.seq = self.next_seq
+        self.next_seq += 1
+        self.scan_seqs.append(entry.seq)
+        self.scan_keys_by_seq.append(key)
+        self.entries[key] = entry
+        self.size_bytes += entry.size
+        self.policy.on_insert(entry)
+        return entry
+
+    def remove(self, key, evicted=False):
+        """ Remove the entry stored for a key. Returns the removed entry or None if it wasn't in the table. """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry.size
+            self.policy.on_remove(entry, evicted)
+            self.num_stale_scan_slots += 1
+            if self.num_stale_scan_slots > len(self.entries):
+                self.compact_scan_index()
+        return entry
+
+    def compact_scan_index(self):
+        """ Drop the scan index pairs of entries that are no longer in the table. """
+        live_slots = [(seq, key) for (seq, key) in zip(self.scan_seqs, self.scan_keys_by_seq) if self.is_live(seq, key)]
+        self.scan_seqs = [seq for (seq, key) in live_slots]
+        self.scan_keys_by_seq = [key for (seq, key) in live_slots]
+        self.num_stale_scan_slots = 0
+
+    def is_live(self, seq, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry.seq == seq
+
+    def evict(self, exclude_keys=()):
+        """ Remove and return the entry picked by the eviction policy, never removing one of exclude_keys.
+        Returns None if there was nothing to evict. """
+        victim_key = self.policy.pick_victim(exclude_keys)
+        if victim_key is None:
+            return None
+        return self.remove(victim_key, evicted=True)
+
+    def set_policy(self, policy):
+        """ Switch to a new eviction policy, re-registering all current entries with it. """
+        self.policy = policy
+        self.size_bytes = 0
+        for entry in self.entries.values():
+            entry.size = compute_entry_size(entry.key, entry.value, policy)
+            self.size_bytes += entry.size
+            policy.on_insert(entry)
+
+    def keys(self):
+        """ Get a copy of all keys in the table. """
+        return list(self.entries.keys())
+
+    def entries_in_eviction_order(self):
+        """ Get all entries, from the one the policy would evict first to the one it would evict last. """
+        return [self.entries[key] for key in self.policy.keys_in_eviction_order()]
+
+    def scan_keys(self, after_seq, count):
+        """ Get up to count keys of the entries added after sequence number after_seq, in insertion order, along with
+        the sequence number to resume from, or None if there are no more. Costs O(log n) plus the slots walked. """
+        keys = []
+        index = bisect_right(self.scan_seqs, after_seq)
+        while index < len(self.scan_seqs) and len(keys) < count:
+            if self.is_live(self.scan_seqs[index], self.scan_keys_by_seq[index]):
+                keys.append(self.scan_keys_by_seq[index])
+            index += 1
+        if index == len(self.scan_seqs):
+            return keys, None
+        return keys, self.scan_seqs[index - 1]
+
+    def clear(self):
+        self.entries.clear()
+        self.policy.clear()
+        self.size_bytes = 0
+        self.scan_seqs = []
+        self.scan_keys_by_seq = []
+        self.num_stale_scan_slots = 0
@@ -0,0 +1,70 @@
+import heapq
+import itertools
+
+
+class SpaceSavingSketch:
+    """ Space-saving heavy hitters sketch tracking the most frequent keys of a stream in bounded memory.
+    At most capacity keys are counted. A new key replaces the key with the lowest count and inherits that count as
+    its error, so every tracked count overestimates the true count by at most its error, and any key seen more than
+    total / capacity times is guaranteed to be tracked.
+    Counts are kept in a heap with lazy deletion like LFUPolicy, stale heap items are skipped when replacing a key.
+    Not thread safe, callers serialize access. """
+    capacity: int
+    counters: dict
+    heap: list
+    total: int
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}  # key -> [count, error, sequence number of its live heap item]
+        self.heap = []
+        self.total = 0
+        self.sequence = itertools.count()
+
+    def set_count(self, key, count, error):
+        sequence = next(self.sequence)
+        self.counters[key] = [count, error, sequence]
+        heapq.heappush(self.heap, (count, sequence, key))
+        if len(self.heap) > 4 * self.capacity + 64:
+            self.compact_heap()
+
+    def compact_heap(self):
+        """ Rebuild the heap from live items only. """
+        self.heap = [(count, sequence, key) for key, (count, error, sequence) in self.counters.items()]
+        heapq.heapify(self.heap)
+
+    def add(self, key, weight=1):
+        """ Count weight occurrences of key. """
+        self.total += weight
+        counter = self.counters.get(key)
+        if counter is not None:
+            self.set_count(key, counter[0] + weight, counter[1])
+        elif len(self.counters) < self.capacity:
+            self.set_count(key, weight, 0)
+        else:
+            while True:
+                min_count, sequence, min_key = heapq.heappop(self.heap)
+                min_counter = self.counters.get(min_key)
+                if min_counter is not None and min_counter[2] == sequence:
+                    break
+            del self.counters[min_key]
+            self.set_count(key, min_count + weight, min_count)
+
+    def decay(self):
+        """ Halve every count so keys that stopped being requested age out. """
+        self.total //= 2
+        for counter in self.counters.values():
+            counter[0] //= 2
+            counter[1] //= 2
+        self.compact_heap()
+
+    def top(self, k=None):
+        """ Get the (key, count, error) of the k most frequent keys, most frequent first. """
+        items = sorted(((key, count, error) for key, (count, error, sequence) in self.counters.items()),
+                       key=lambda item: item[1], reverse=True)
+        return items if k is None else items[:k]
+
+    def clear(self):
+        self.counters.clear()
+        self.heap.clear()
+        self.total = 0
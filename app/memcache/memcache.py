@@ -1,18 +1,47 @@
-from sys import getsizeof
-import random
+import atexit
 import logging
+import struct
 import time
-from threading import Thread
-from collections import OrderedDict
-from app.memcache.stats import RunningCacheStats
-from app.rw_lock import ReadWriteLock
-from app.common import CacheConfig, ReplacementPolicy
+from threading import Thread, Lock
+from app.memcache.entry_table import CacheEntry
+from app.memcache.segment import CacheSegment, BudgetCoordinator
+from app.memcache.policies import create_eviction_policy
+from app.memcache.timer_wheel import HierarchicalTimerWheel
+from app.memcache.snapshot import SnapshotReader, write_snapshot, encode_entries
+from app.memcache.compression import CompressionStats, CompressedValue, compress_value, decompress_value
+from app.memcache.stats import RunningCacheStats, lock_stats_to_metric_families
+from app.memcache.mrc import ShardsGhostCache, DEFAULT_SIZE_MULTIPLIERS
+from app.common import CacheConfig, ReplacementPolicy, DEFAULT_SCAN_COUNT, DEFAULT_HOT_KEY_COUNT
+from app.memcache.stats_flusher import StatsFlusher, CloudWatchSink
+from app.metrics import MetricFamily, DEFAULT_LATENCY_BUCKETS
 from random import choice
 from string import ascii_uppercase
-import requests
 
 logger = logging.getLogger(__name__)
 
+# Number of independently locked segments the cache is split into
+NUM_SEGMENTS = 16
+# Resolution of the expiry sweeper, entries are reclaimed at most this long after their TTL ran out
+EXPIRY_TICK_SECONDS = 1
+# Max number of expired keys removed per segment lock acquisition by the sweeper
+EXPIRY_SWEEP_BATCH_SIZE = 256
+# How often the contents of a cache with a snapshot path are dumped to it
+SNAPSHOT_INTERVAL_SECONDS = 300
+# Number of entries restored from a snapshot per batch by the background restore
+SNAPSHOT_RESTORE_BATCH_SIZE = 256
+# Number of keys each segment counts in its hot keys sketch
+HOT_KEY_CAPACITY_PER_SEGMENT = 64
+# How often hot key counts are halved, so the sketch follows the current traffic rather than all time totals
+HOT_KEY_DECAY_SECONDS = 60
+# Max number of entries evicted per segment lock acquisition when shrinking the cache in the background
+SHRINK_BATCH_SIZE = 64
+# Max number of entries evicted per second when shrinking the cache in the background, so requests still get their
+# share of the segment locks
+SHRINK_EVICTIONS_PER_SECOND = 20000
+# Max number of entries and bytes of values sent to another node per /import request when exporting entries
+EXPORT_BATCH_SIZE = 256
+EXPORT_BATCH_MAX_BYTES = 8 * 1024 * 1024
+
 
 def generate_random_stat_id():
     first_half = ''.join(choice(ascii_uppercase) for i in range(4))
@@ -20,24 +49,120 @@ def generate_random_stat_id():
     return first_half + '_' + second_half
 
 
+def split_entries_by_size(entries, max_bytes):
+    """ Split a list of entries into consecutive batches whose total size stays under max_bytes, except for batches
+    of a single larger entry. """
+    batch = []
+    batch_bytes = 0
+    for entry in entries:
+        if batch and batch_bytes + entry.size > max_bytes:
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(entry)
+        batch_bytes += entry.size
+    if batch:
+        yield batch
+
+
+def parse_scan_cursor(cursor):
+    """ Split a scan cursor into its segment index and the sequence number the scan of that segment resumes after, a
+    None cursor starts a new scan. Raises ValueError if the cursor is malformed. """
+    if cursor is None or cursor == "":
+        return 0, 0
+    segment_idx, after_seq = cursor.split(":")
+    segment_idx, after_seq = int(segment_idx), int(after_seq)
+    if segment_idx < 0 or after_seq < 0:
+        raise ValueError("Invalid scan cursor: " + cursor)
+    return segment_idx, after_seq
+
+
+class ShrinkTask:
+    """ Progress handle of a background eviction bringing the cache under a lowered budget. """
+    task_id: int
+    started_at: float
+    finished_at = None
+    start_size_bytes: int
+    start_num_items: int
+    num_evicted: int
+    bytes_evicted: int
+
+    def __init__(self, task_id, start_size_bytes, start_num_items):
+        self.task_id = task_id
+        self.started_at = time.time()
+        self.start_size_bytes = start_size_bytes
+        self.start_num_items = start_num_items
+        self.num_evicted = 0
+        self.bytes_evicted = 0
+
+    def is_done(self):
+        return self.finished_at is not None
+
+    def to_dict(self):
+        return {"task_id": self.task_id,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "is_done": self.is_done(),
+                "start_size_bytes": self.start_size_bytes,
+                "start_num_items": self.start_num_items,
+                "num_evicted": self.num_evicted,
+                "bytes_evicted": self.bytes_evicted}
+
+
+class ExportTask:
+    """ Progress handle of a background export of entries to other nodes. """
+    task_id: int
+    started_at: float
+    finished_at = None
+    num_exported: int
+    num_failed: int
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.started_at = time.time()
+        self.num_exported = 0
+        self.num_failed = 0
+
+    def is_done(self):
+        return self.finished_at is not None
+
+    def to_dict(self):
+        return {"task_id": self.task_id,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "is_done": self.is_done(),
+                "num_exported": self.num_exported,
+                "num_failed": self.num_failed}
+
+
 class Memcache:
     """ Maintains cache data structure and associated structures. """
     is_active = True
-    cache: OrderedDict
+    segments: list
+    budget_coordinator: BudgetCoordinator
     cache_config: CacheConfig
     stat_tracker: RunningCacheStats
-    stat_save_thread: Thread
-    rw_lock: ReadWriteLock
-    cache_size = 0
+    compression_stats: CompressionStats
+    ghost_cache: ShardsGhostCache
+    stats_flusher: StatsFlusher
+    expiry_wheel: HierarchicalTimerWheel
+    expiry_sweep_thread: Thread
     stat_id: str
-
-    def __init__(self):
-        """Create a new memcache class instance."""
+    snapshot_path: str
+    pending_snapshot_records = None  # key -> SnapshotRecord of entries not restored from the snapshot yet
+    snapshot_reader = None
+    is_dirty = False  # Whether the cache was used since the last snapshot
+    holds_compressed_values = False  # Whether a compressed value may have been stored since the last clear
+    shrink_task = None  # ShrinkTask of the last background shrink
+    export_task = None  # ExportTask of the last background export
+
+    def __init__(self, snapshot_path=None, stats_sink=None):
+        """Create a new memcache class instance.
+        If a snapshot path is provided, the cache is warmed from the snapshot at that path and its contents are
+        dumped back to it periodically and when the process exits.
+        Stats are flushed to the provided StatsSink, CloudWatch by default. """
         logger.info("Starting a new Memcache instance.")
         self.stat_id = None #generate_random_stat_id()
-        self.cache = OrderedDict()
-        self.rw_lock = ReadWriteLock()
-
         cache_config = None #db_instance.get_most_recent_cache_config() # TODO: get from RDS
         if cache_config is None:
             logger.warning("Couldn't load cache config from DB, creating default.")
@@ -47,8 +172,31 @@ class Memcache:
         #     self.cache_config = cache_config
 
         self.stat_tracker = RunningCacheStats()
-        self.stat_save_thread = Thread(target=self.stat_polling_loop)
-        self.stat_save_thread.start()
+        self.compression_stats = CompressionStats()
+        self.ghost_cache = ShardsGhostCache()
+
+        self.segments = [CacheSegment(create_eviction_policy(self.cache_config.replacement_policy),
+                                      self.stat_tracker.segment_locks, HOT_KEY_CAPACITY_PER_SEGMENT)
+                         for i in range(NUM_SEGMENTS)]
+        self.budget_coordinator = BudgetCoordinator(self.segments)
+        self.budget_coordinator.set_limits(self.get_max_cache_size_bytes(), self.cache_config.max_num_items)
+        self.stats_flusher = StatsFlusher(CloudWatchSink() if stats_sink is None else stats_sink, self.collect_stats)
+        self.stats_flusher.start()
+
+        self.expiry_wheel = HierarchicalTimerWheel(EXPIRY_TICK_SECONDS, time.time())
+        self.expiry_sweep_thread = Thread(target=self.expiry_sweep_loop, daemon=True)
+        self.expiry_sweep_thread.start()
+        Thread(target=self.hot_key_decay_loop, daemon=True).start()
+
+        self.shrink_lock = Lock()
+        self.export_lock = Lock()
+
+        self.snapshot_path = snapshot_path
+        self.snapshot_lock = Lock()
+        if snapshot_path is not None:
+            self.load_snapshot()
+            Thread(target=self.snapshot_loop, daemon=True).start()
+            atexit.register(self.dump_snapshot)
 
     def set_stat_id(self, new_id):
         if new_id is not None:
@@ -71,73 +219,300 @@ class Memcache:
 
     def get(self, key):
         """ Retrieve a value based on the key. """
+        start_time = time.perf_counter()
         if not self.is_active:
             logger.warning("Attempting to get from deactivated cache, continuing anyways.")
 
-        value = self.get_value_internal(key)
-        if value is not None:
-            # Remove and place back on top of queue
-            self.invalidate(key)
-            self.add_key_value_internal(key, value)
+        # Lookup and move to the top of the queue under a single lock acquisition, so a concurrent put or
+        # invalidate can't slip in between and have a stale value put back
+        value = self.get_segment(key).get_and_promote(key, time.time())
+        if value is None and self.pending_snapshot_records is not None:
+            value = self.restore_snapshot_entry(key)
+        self.is_dirty = True
         self.stat_tracker.add_req_served(is_get=True, is_miss=(value is None))
+        self.ghost_cache.record_get(key)
+        value = decompress_value(value, self.compression_stats)
+        self.stat_tracker.get_latency.record(time.perf_counter() - start_time)
         return value
 
-    def put(self, key, value):
-        """ Place key-value pair in cache. Returns True if successful, false otherwise. """
+    def get_many(self, keys):
+        """ Retrieve the values of a list of keys, locking each segment touched only once.
+        Returns a dict of key to value, with None for misses. """
+        if not self.is_active:
+            logger.warning("Attempting to get from deactivated cache, continuing anyways.")
+
+        now = time.time()
+        values = {}
+        for segment, segment_keys in self.group_keys_by_segment(keys).items():
+            values.update(segment.get_many_and_promote(segment_keys, now))
+        if self.pending_snapshot_records is not None:
+            for key in keys:
+                if values[key] is None:
+                    values[key] = self.restore_snapshot_entry(key)
+        self.is_dirty = True
+        for key in keys:
+            self.stat_tracker.add_req_served(is_get=True, is_miss=(values[key] is None))
+            self.ghost_cache.record_get(key)
+            values[key] = decompress_value(values[key], self.compression_stats)
+        return values
+
+    def put(self, key, value, refill_cost_ms=None, ttl_seconds=None):
+        """ Place key-value pair in cache. Returns True if successful, false otherwise.
+        Values can be text or binary (bytes/memoryview), binary values are stored without any encoding.
+        refill_cost_ms is how long it took the caller to load the value after a miss, if known.
+        The entry expires after ttl_seconds, or the configured default TTL if not provided. """
         if not self.is_active:
             logger.warning("Attempting to put to deactivated cache, ignoring.")
             return False
+        start_time = time.perf_counter()
         self.stat_tracker.add_req_served(is_get=False, is_miss=False)
 
-        # Invalidate the key no matter what
-        self.invalidate(key)
-
-        # Check to make sure value isn't too large
-        if getsizeof(value) > self.get_max_cache_size_bytes():
-            # key/value too large to place in cache
+        if isinstance(value, bytearray):
+            # Don't hold on to a buffer the caller can still mutate
+            value = bytes(value)
+        value = self.compress_value(value)
+        self.is_dirty = True
+        self.discard_snapshot_entries((key,))
+        segment = self.get_segment(key)
+
+        # Check to make sure value isn't too large, sized the same way the segment will charge it
+        entry_size = segment.compute_entry_size(key, value)
+        if entry_size > self.get_max_cache_size_bytes():
+            # key/value too large to place in cache, the old value is still invalidated
             logger.warning("Cache to small for data entry: bytes="
-                           + str(getsizeof(value))
+                           + str(entry_size)
                            + " (key=" + key + ")")
+            segment.remove(key)
+            self.ghost_cache.record_remove(key)
+            self.stat_tracker.put_latency.record(time.perf_counter() - start_time)
             return False
 
-        # Add key/value to cache
-        self.add_key_value_internal(key, value)
-        # Clear cache using replacement policy until enough space is free
-        self.clear_space_as_necessary(skip_top_entry=True)
+        expires_at = self.get_expires_at(ttl_seconds, time.time())
 
+        # Add key/value to cache, replacing any existing entry in the same critical section
+        segment.add(key, value, refill_cost_ms, expires_at)
+        self.ghost_cache.record_put(key, entry_size)
+        if expires_at is not None:
+            self.expiry_wheel.schedule(key, expires_at)
+        # Clear cache using replacement policy until enough space is free. While a shrink is in progress only make
+        # room for this entry and leave the rest to the background task, so puts don't take over its work.
+        self.clear_space_as_necessary(skip_keys=(key,), bytes_to_free=entry_size if self.is_shrinking() else None)
+
+        self.stat_tracker.put_latency.record(time.perf_counter() - start_time)
         return True
-    
-    def clear_space_as_necessary(self, skip_top_entry):
-        """ Remove elements from cache using replacement policy until it is under the max size limit. """
-        while (self.get_cache_size_bytes() > self.get_max_cache_size_bytes()
-                or self.get_num_items_in_cache() > self.cache_config.max_num_items) and self.get_num_items_in_cache() > 0:
-            self.invalidate_by_policy(skip_top_entry=skip_top_entry)
-
-    def get_value_internal(self, key):
-        """ Get a value stored in the cache. """
-        self.rw_lock.acquire_read()
-        value = None
-        if key in self.cache:
-            value = self.cache[key]
-        self.rw_lock.release_read()
+
+    def put_many(self, values, ttl_seconds=None, if_absent=False):
+        """ Place a dict of key-value pairs in cache, locking each segment touched only once.
+        Returns a dict of key to True if the pair was placed in cache, False otherwise.
+        Every entry expires after ttl_seconds, or the configured default TTL if not provided.
+        With if_absent, keys already in cache keep their value, so copying entries in from another node never
+        overwrites a newer put, and are reported as False. The batch's own entries are never evicted to make room
+        for it unless it is larger than the whole cache. """
+        if not self.is_active:
+            logger.warning("Attempting to put to deactivated cache, ignoring.")
+            return {key: False for key in values}
+        self.is_dirty = True
+        self.discard_snapshot_entries(values.keys())
+
+        expires_at = self.get_expires_at(ttl_seconds, time.time())
+        max_size_bytes = self.get_max_cache_size_bytes()
+        results = {}
+        items_by_segment = {}
+        entry_sizes = {}
+        too_large_keys = []
+        for key, value in values.items():
+            self.stat_tracker.add_req_served(is_get=False, is_miss=False)
+            if isinstance(value, bytearray):
+                value = bytes(value)
+            value = self.compress_value(value)
+            segment = self.get_segment(key)
+            entry_size = segment.compute_entry_size(key, value)
+            if entry_size > max_size_bytes:
+                logger.warning("Cache to small for data entry: bytes="
+                               + str(entry_size)
+                               + " (key=" + key + ")")
+                too_large_keys.append(key)
+                results[key] = False
+                continue
+            items_by_segment.setdefault(segment, []).append((key, value, None, expires_at))
+            entry_sizes[key] = entry_size
+
+        # Keys that didn't fit still have their old value invalidated, same as a single put
+        if not if_absent:
+            for segment, segment_keys in self.group_keys_by_segment(too_large_keys).items():
+                segment.remove_many(segment_keys)
+            for key in too_large_keys:
+                self.ghost_cache.record_remove(key)
+        stored_keys = set()
+        for segment, items in items_by_segment.items():
+            if if_absent:
+                items = segment.add_many_if_absent(items)
+            else:
+                segment.add_many(items)
+            stored_keys.update(item[0] for item in items)
+        bytes_added = 0
+        for key in entry_sizes:
+            results[key] = key in stored_keys
+            if results[key]:
+                self.ghost_cache.record_put(key, entry_sizes[key])
+                bytes_added += entry_sizes[key]
+                if expires_at is not None:
+                    self.expiry_wheel.schedule(key, expires_at)
+        if self.is_shrinking():
+            self.clear_space_as_necessary(skip_keys=stored_keys, bytes_to_free=bytes_added)
+        else:
+            self.clear_space_as_necessary(skip_keys=stored_keys)
+            # A batch larger than the whole cache can't be kept in full
+            self.clear_space_as_necessary()
+
+        return results
+
+    def compress_value(self, value):
+        """ Compress a value about to be stored if the cache config enables it and it pays off. Runs before any
+        segment lock is taken so concurrent operations never wait on it. """
+        value = compress_value(value, self.cache_config.compression_level,
+                               self.cache_config.compression_threshold_bytes, self.compression_stats)
+        if isinstance(value, CompressedValue):
+            self.holds_compressed_values = True
         return value
 
+    def is_compression_active(self):
+        """ Whether puts may compress values or gets may have to decompress them. """
+        return bool(self.cache_config.compression_level) or self.holds_compressed_values
+
+    def get_expires_at(self, ttl_seconds, now):
+        """ Get when an entry put now expires, falling back to the configured default TTL. """
+        if ttl_seconds is None:
+            ttl_seconds = self.cache_config.default_ttl_seconds
+        return None if ttl_seconds is None else now + ttl_seconds
+
+    def get_segment(self, key):
+        """ Get the segment responsible for storing the provided key. """
+        return self.segments[hash(key) % NUM_SEGMENTS]
+
+    def clear_space_as_necessary(self, skip_keys=(), bytes_to_free=None):
+        """ Remove elements from cache using replacement policy until it is under the max size limit.
+        If we just added keys we don't want to remove then they should be passed as skip_keys.
+        If bytes_to_free is provided, stop once that many bytes were freed even if the cache is still over budget. """
+        bytes_freed = 0
+        while self.budget_coordinator.is_over_budget():
+            if bytes_to_free is not None and bytes_freed >= bytes_to_free:
+                break
+            start_time = time.perf_counter()
+            segment = self.budget_coordinator.pick_segment_to_evict(exclude_keys=skip_keys)
+            entry = None if segment is None else segment.evict(exclude_keys=skip_keys)
+            if entry is None:
+                break
+            bytes_freed += entry.size
+            self.stat_tracker.add_eviction(time.perf_counter() - start_time)
+
+    def is_shrinking(self):
+        shrink_task = self.shrink_task
+        return shrink_task is not None and not shrink_task.is_done()
+
+    def start_shrink(self):
+        """ Start evicting entries in the background until the cache is under its budget, unless a shrink is already
+        running, in which case it carries on to the current budget. Returns the ShrinkTask tracking it. """
+        with self.shrink_lock:
+            if self.is_shrinking():
+                return self.shrink_task
+            task_id = 1 if self.shrink_task is None else self.shrink_task.task_id + 1
+            self.shrink_task = ShrinkTask(task_id, self.get_cache_size_bytes(), self.get_num_items_in_cache())
+            Thread(target=self.run_shrink_task, args=(self.shrink_task,), daemon=True).start()
+            return self.shrink_task
+
+    def run_shrink_task(self, task):
+        """ Evict entries in batches of SHRINK_BATCH_SIZE, at most SHRINK_EVICTIONS_PER_SECOND, until the cache is
+        under budget. Each batch comes from a single segment, so its lock is taken once per batch. """
+        while True:
+            if not self.budget_coordinator.is_over_budget():
+                # Only stop under the lock, so a shrink started meanwhile can't think this task will handle it
+                with self.shrink_lock:
+                    if not self.budget_coordinator.is_over_budget():
+                        task.finished_at = time.time()
+                        logger.info("Shrink " + str(task.task_id) + " evicted " + str(task.num_evicted)
+                                    + " entries.")
+                        return
+                continue
+
+            start_time = time.perf_counter()
+            segment = self.budget_coordinator.pick_segment_to_evict()
+            if segment is None:
+                with self.shrink_lock:
+                    task.finished_at = time.time()
+                return
+            bytes_over = self.get_cache_size_bytes() - self.budget_coordinator.max_size_bytes
+            items_over = self.get_num_items_in_cache() - self.budget_coordinator.max_num_items
+            entries = segment.evict_many(SHRINK_BATCH_SIZE, bytes_over, items_over)
+            elapsed = time.perf_counter() - start_time
+            for entry in entries:
+                self.stat_tracker.add_eviction(elapsed / len(entries))
+                task.num_evicted += 1
+                task.bytes_evicted += entry.size
+            time.sleep(max(0, len(entries) / SHRINK_EVICTIONS_PER_SECOND - elapsed))
+
+    def get_shrink_progress(self):
+        """ Get the progress of the last background shrink, or None if the cache was never shrunk. """
+        shrink_task = self.shrink_task
+        if shrink_task is None:
+            return None
+        progress = shrink_task.to_dict()
+        progress["size_bytes"] = self.get_cache_size_bytes()
+        progress["num_items"] = self.get_num_items_in_cache()
+        progress["max_size_bytes"] = self.budget_coordinator.max_size_bytes
+        progress["max_num_items"] = self.budget_coordinator.max_num_items
+        return progress
+
     def get_all_keys(self):
         """ Get all keys stored in the cache. """
-        self.rw_lock.acquire_read()
-        keys = list(self.cache.keys())
-        self.rw_lock.release_read()
+        keys = []
+        for segment in self.segments:
+            keys.extend(segment.keys())
         return keys
 
+    def scan_keys(self, cursor=None, count=DEFAULT_SCAN_COUNT, prefix=None):
+        """ Get one page of the keys stored in the cache, only holding a segment lock for as long as it takes to
+        copy that page. Pass the returned cursor back in to get the next page, the scan is done once it is None.
+        At most count keys are examined per page, so a page may hold fewer keys than count when filtering on a
+        prefix. The cursor holds the insertion sequence number the scan of a segment resumes after, so keys present
+        for the whole scan are always returned. A key put again during the scan gets a new sequence number and may be
+        returned twice. """
+        segment_idx, after_seq = parse_scan_cursor(cursor)
+        keys = []
+        num_scanned = 0
+        while segment_idx < NUM_SEGMENTS and num_scanned < count:
+            page, after_seq = self.segments[segment_idx].scan_keys(after_seq, count - num_scanned)
+            num_scanned += len(page)
+            keys.extend(key for key in page if prefix is None or key.startswith(prefix))
+            if after_seq is None:
+                segment_idx += 1
+                after_seq = 0
+
+        next_cursor = None if segment_idx >= NUM_SEGMENTS else str(segment_idx) + ":" + str(after_seq)
+        return keys, next_cursor
+
+    def iter_keys(self, prefix=None, count=DEFAULT_SCAN_COUNT):
+        """ Iterate over all keys stored in the cache, scanning count keys at a time. """
+        cursor = None
+        while True:
+            keys, cursor = self.scan_keys(cursor, count, prefix)
+            yield from keys
+            if cursor is None:
+                return
+
     def clear(self):
         if not self.is_active:
             logger.info("Attempting to clear deactivated cache, proceeding anyways.")
 
         """ Empty the entire cache. """
-        self.rw_lock.acquire_write()
-        self.cache.clear()
-        self.cache_size = 0
-        self.rw_lock.release_write()
+        with self.snapshot_lock:
+            self.pending_snapshot_records = None
+        self.is_dirty = True
+        for segment in self.segments:
+            segment.clear()
+        self.holds_compressed_values = False
+        self.expiry_wheel.clear()
+        self.ghost_cache.clear()
         return True
 
     def invalidate(self, key):
@@ -145,49 +520,31 @@ class Memcache:
             logger.warning("Attempting to invalidate entry in deactivated cache, continuing anyways.")
 
         """ Remove a specified key-value pair from the cache based on provided key. """
-        self.rw_lock.acquire_write()
-        if key in self.cache:
-            value = self.cache.pop(key)
-            self.cache_size -= getsizeof(value)
-            if self.cache_size < 0:
-                self.cache_size = 0
-        self.rw_lock.release_write()
+        self.is_dirty = True
+        self.discard_snapshot_entries((key,))
+        self.get_segment(key).remove(key)
+        self.ghost_cache.record_remove(key)
         return True
 
-    def add_key_value_internal(self, key, value):
-        self.rw_lock.acquire_write()
-        self.cache[key] = value
-        self.cache_size += getsizeof(value)
-        self.rw_lock.release_write()
-
-    def invalidate_by_policy(self, skip_top_entry):
-        """ Remove an element from the cache based on the configured replacement policy. """
-        if self.cache_config.replacement_policy == ReplacementPolicy.RANDOM:
-            return self.invalidate_random(skip_top_entry)
-        elif self.cache_config.replacement_policy == ReplacementPolicy.LRU:
-            return self.invalidate_lru()
-        else:
-            return False
+    def invalidate_many(self, keys):
+        """ Remove the key-value pairs of a list of keys from the cache, locking each segment touched only once. """
+        if not self.is_active:
+            logger.warning("Attempting to invalidate entry in deactivated cache, continuing anyways.")
 
-    def invalidate_lru(self):
-        """ Remove an element from the cache based on which was last recently used. """
-        self.rw_lock.acquire_write()
-        (key, value) = self.cache.popitem(last=False)
-        self.cache_size -= getsizeof(value)
-        if self.cache_size < 0:
-            self.cache_size = 0
-        self.rw_lock.release_write()
+        self.is_dirty = True
+        self.discard_snapshot_entries(keys)
+        for segment, segment_keys in self.group_keys_by_segment(keys).items():
+            segment.remove_many(segment_keys)
+        for key in keys:
+            self.ghost_cache.record_remove(key)
         return True
 
-    def invalidate_random(self, skip_top_entry):
-        """ Remove a random element from the cache.
-        If we just added a key we don't want to remove then skip_top_entry should be true. """
-        keys = self.get_all_keys()
-        if skip_top_entry:
-            rand_key = random.choice(keys[:-1])
-        else:
-            rand_key = random.choice(keys)
-        return self.invalidate(rand_key)
+    def group_keys_by_segment(self, keys):
+        """ Group a list of keys into a dict of segment to the keys it is responsible for. """
+        keys_by_segment = {}
+        for key in keys:
+            keys_by_segment.setdefault(self.get_segment(key), []).append(key)
+        return keys_by_segment
 
     def get_max_cache_size_bytes(self):
         """ Get the max size of the cache in bytes. """
@@ -195,11 +552,11 @@ class Memcache:
 
     def get_cache_size_bytes(self):
         """ Get the current size of the cache in bytes. """
-        return self.cache_size
+        return self.budget_coordinator.get_size_bytes()
 
     def get_num_items_in_cache(self):
         """ Get the current number of items in the cache. """
-        return len(self.get_all_keys())
+        return self.budget_coordinator.get_num_items()
 
     # def refresh_cache_config(self):
     #     """ Refresh the current cache configuration based on most recent one saved in DB. """
@@ -207,7 +564,9 @@ class Memcache:
     #     return self.set_cache_config(new_config)
 
     def set_configuration(self, new_config):
-        """ Set cache config of this memcache to be one provided. """
+        """ Set cache config of this memcache to be one provided.
+        If the new budget is lower than what the cache holds, entries are evicted by a background shrink whose
+        progress is reported by get_shrink_progress. """
         if new_config is None:
             logger.error("New cache config is None, skipping update.")
             return False
@@ -215,24 +574,306 @@ class Memcache:
             logger.warning("Ignoring cache config update due to lack of changes.")
             return True
         else:
+            if new_config.replacement_policy != self.cache_config.replacement_policy:
+                for segment in self.segments:
+                    segment.set_policy(create_eviction_policy(new_config.replacement_policy))
             self.cache_config = new_config
-            self.clear_space_as_necessary(skip_top_entry=False)
+            self.budget_coordinator.set_limits(self.get_max_cache_size_bytes(), new_config.max_num_items)
+            # Evicting down to a lowered budget can take a while, it is left to a background task
+            if self.budget_coordinator.is_over_budget():
+                self.start_shrink()
             return True
 
     def get_cache_config(self):
         """ Get the current cache config. """
         return self.cache_config
 
-    def stat_polling_loop(self):
+    def expiry_sweep_loop(self):
         while True:
-            time.sleep(5)
-            #self.save_stats()
-            response = requests.get("http://127.0.0.1:5004" + "/save_stats")
+            time.sleep(EXPIRY_TICK_SECONDS)
+            self.remove_expired_entries()
+
+    def remove_expired_entries(self):
+        """ Remove entries whose TTL has run out, as reported by the expiry timer wheel.
+        Keys are removed in small batches per segment so the segment locks are only held briefly. """
+        now = time.time()
+        num_removed = 0
+        for segment, keys in self.group_keys_by_segment(self.expiry_wheel.advance(now)).items():
+            for batch_start in range(0, len(keys), EXPIRY_SWEEP_BATCH_SIZE):
+                num_removed += segment.remove_expired(keys[batch_start:batch_start + EXPIRY_SWEEP_BATCH_SIZE], now)
+        return num_removed
+
+    def hot_key_decay_loop(self):
+        while True:
+            time.sleep(HOT_KEY_DECAY_SECONDS)
+            for segment in self.segments:
+                segment.decay_hot_keys()
+
+    def get_hot_keys(self, count=DEFAULT_HOT_KEY_COUNT):
+        """ Get the count most requested keys by gets and puts, most requested first, and the total number of
+        requests counted. Each hot key is a dict of its estimated request count, the max overestimation of that count
+        and its share of all requests. Counts are halved every HOT_KEY_DECAY_SECONDS. """
+        hot_keys = []
+        total = 0
+        for segment in self.segments:
+            segment_hot_keys, segment_total = segment.get_hot_keys(count)
+            hot_keys.extend(segment_hot_keys)
+            total += segment_total
+        # Segments count disjoint keys, so the top keys of the cache are among the top keys of each segment
+        hot_keys.sort(key=lambda item: item[1], reverse=True)
+        return [{"key": key, "count": key_count, "error": error, "share": key_count / total if total else 0}
+                for (key, key_count, error) in hot_keys[:count]], total
+
+    def get_miss_ratio_curve(self, size_multipliers=DEFAULT_SIZE_MULTIPLIERS):
+        """ Get the miss rate this node is predicted to have at each of the provided multiples of its capacity, from
+        the sampled reuse distances of its gets. The prediction models an LRU cache whatever the configured policy.
+        Returns a list of dicts of the size multiplier, cache size in bytes and predicted miss rate, which is None
+        until a get was sampled. """
+        max_size_bytes = self.get_max_cache_size_bytes()
+        cache_sizes_bytes = [multiplier * max_size_bytes for multiplier in size_multipliers]
+        miss_rates = self.ghost_cache.get_miss_ratio_curve(cache_sizes_bytes)
+        return [{"size_multiplier": multiplier, "cache_size_bytes": int(cache_size_bytes), "miss_rate": miss_rate}
+                for (multiplier, cache_size_bytes, miss_rate) in zip(size_multipliers, cache_sizes_bytes, miss_rates)]
+
+    def snapshot_loop(self):
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL_SECONDS)
+            self.dump_snapshot()
 
-    def save_stats(self):
-        if self.is_active and self.stat_id is not None:
-            self.stat_tracker.save_time_boxed_stat(self.stat_id,
-                                                   self.get_num_items_in_cache(),
-                                                   self.get_cache_size_bytes())
+    def dump_snapshot(self):
+        """ Write the contents of the cache to its snapshot file, ordered from the entry that would be evicted first
+        to the one that would be evicted last. Skipped if nothing was read or written since the last dump. """
+        if self.snapshot_path is None or not self.is_dirty:
+            return False
+        self.is_dirty = False
+        now = time.time()
+
+        # Entries not restored from the last snapshot yet are the coldest, the rest are interleaved across segments
+        # by their relative position in their segment's eviction order
+        ranked_entries = []
+        with self.snapshot_lock:
+            if self.pending_snapshot_records is not None:
+                for record in self.pending_snapshot_records.values():
+                    ranked_entries.append((-1, CacheEntry(record.key, self.snapshot_reader.get_value(record), 0,
+                                                          record.refill_cost_ms, record.expires_at)))
+        for segment in self.segments:
+            entries = segment.entries_in_eviction_order()
+            for rank, entry in enumerate(entries):
+                ranked_entries.append((rank / len(entries), entry))
+        ranked_entries.sort(key=lambda ranked_entry: ranked_entry[0])
+
+        try:
+            num_entries = write_snapshot(self.snapshot_path,
+                                         [entry for (rank, entry) in ranked_entries if not entry.is_expired(now)])
+        except OSError as e:
+            logger.error("Failed to write snapshot to " + self.snapshot_path + ": " + str(e))
+            return False
+        logger.info("Wrote " + str(num_entries) + " entries to snapshot in " + str(time.time() - now) + "s")
+        return True
+
+    def load_snapshot(self):
+        """ Memory-map the snapshot file and restore its entries in the background, coldest first so that the
+        hottest entries are the last to be evicted if the snapshot doesn't fit. Until an entry is restored, a get for
+        its key restores it on the spot. """
+        try:
+            reader = SnapshotReader(self.snapshot_path)
+        except FileNotFoundError:
+            logger.info("No snapshot found at " + self.snapshot_path + ", starting empty.")
+            return False
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning("Ignoring unreadable snapshot " + self.snapshot_path + ": " + str(e))
+            return False
 
+        now = time.time()
+        with self.snapshot_lock:
+            self.snapshot_reader = reader
+            self.pending_snapshot_records = {record.key: record for record in reader.records
+                                             if record.expires_at is None or record.expires_at > now}
+        logger.info("Restoring " + str(len(self.pending_snapshot_records)) + " entries from snapshot.")
+        Thread(target=self.restore_snapshot, daemon=True).start()
         return True
+
+    def restore_snapshot(self):
+        """ Restore all pending snapshot entries in batches, then release the snapshot. """
+        keys = list(self.pending_snapshot_records or ())
+        for batch_start in range(0, len(keys), SNAPSHOT_RESTORE_BATCH_SIZE):
+            with self.snapshot_lock:
+                if self.pending_snapshot_records is None:
+                    break
+                records = [self.pending_snapshot_records.pop(key, None)
+                           for key in keys[batch_start:batch_start + SNAPSHOT_RESTORE_BATCH_SIZE]]
+                self.restore_snapshot_records([record for record in records if record is not None])
+            self.clear_space_as_necessary()
+
+        with self.snapshot_lock:
+            self.pending_snapshot_records = None
+            self.snapshot_reader = None
+        logger.info("Finished restoring snapshot.")
+
+    def restore_snapshot_entry(self, key):
+        """ Restore a single entry from the snapshot ahead of the background restore, returns its value or None if
+        the snapshot doesn't have it. """
+        with self.snapshot_lock:
+            if self.pending_snapshot_records is None:
+                return None
+            record = self.pending_snapshot_records.pop(key, None)
+            if record is None:
+                return None
+            self.restore_snapshot_records([record])
+        self.clear_space_as_necessary(skip_keys=(key,))
+        return self.get_segment(key).get_and_promote(key, time.time())
+
+    def restore_snapshot_records(self, records):
+        """ Add snapshot records to the cache unless their key was put since. Must hold the snapshot lock. """
+        self.add_snapshot_records(self.snapshot_reader, records)
+
+    def add_snapshot_records(self, reader, records, copy_values=False):
+        """ Add the records of a snapshot reader to the cache unless their key is already in it, skipping expired
+        records and those too large to fit. Values are copied out of the reader's buffer if copy_values is set, so
+        the cache doesn't keep the whole buffer alive. Returns the number of entries added. """
+        now = time.time()
+        max_size_bytes = self.get_max_cache_size_bytes()
+        items_by_segment = {}
+        for record in records:
+            if record.expires_at is not None and record.expires_at <= now:
+                continue
+            value = reader.get_value(record)
+            if copy_values and isinstance(value, memoryview):
+                value = bytes(value)
+            elif copy_values and isinstance(value, CompressedValue):
+                value = CompressedValue(bytes(value.data), value.is_text)
+            if isinstance(value, CompressedValue):
+                self.holds_compressed_values = True
+            segment = self.get_segment(record.key)
+            if segment.compute_entry_size(record.key, value) > max_size_bytes:
+                continue
+            items_by_segment.setdefault(segment, []).append(
+                (record.key, value, record.refill_cost_ms, record.expires_at))
+        num_added = 0
+        for segment, items in items_by_segment.items():
+            added_items = segment.add_many_if_absent(items)
+            num_added += len(added_items)
+            for (key, value, refill_cost_ms, expires_at) in added_items:
+                if expires_at is not None:
+                    self.expiry_wheel.schedule(key, expires_at)
+        return num_added
+
+    def start_export(self, get_target, send_batch, remove_exported=True):
+        """ Start exporting entries in the background, see export_entries. Returns the ExportTask tracking it, or None
+        if an export is already running. """
+        with self.export_lock:
+            if self.export_task is not None and not self.export_task.is_done():
+                return None
+            self.export_task = ExportTask(1 if self.export_task is None else self.export_task.task_id + 1)
+            Thread(target=self.run_export_task, args=(self.export_task, get_target, send_batch, remove_exported),
+                   daemon=True).start()
+            return self.export_task
+
+    def run_export_task(self, task, get_target, send_batch, remove_exported):
+        try:
+            self.export_entries(task, get_target, send_batch, remove_exported)
+        except Exception as e:
+            logger.error("Export " + str(task.task_id) + " failed: " + str(e))
+        finally:
+            task.finished_at = time.time()
+        logger.info("Export " + str(task.task_id) + " sent " + str(task.num_exported) + " entries, "
+                    + str(task.num_failed) + " failed.")
+
+    def get_export_progress(self):
+        """ Get the progress of the last background export, or None if there was none. """
+        export_task = self.export_task
+        return None if export_task is None else export_task.to_dict()
+
+    def export_entries(self, task, get_target, send_batch, remove_exported=True):
+        """ Send every entry whose key get_target maps to a target, rather than None, to that target in batches of
+        up to EXPORT_BATCH_SIZE entries or EXPORT_BATCH_MAX_BYTES bytes. Entries are peeked at without promoting them
+        or counting them as requests, so exporting doesn't disturb the eviction order or stats of this node.
+        send_batch(target, data) is called with the batch in the snapshot layout and returns whether the target
+        imported it. Exported entries are then removed unless remove_exported is False or they were put again
+        meanwhile. The number of entries exported and failed to be are counted in task as it goes. """
+        now = time.time()
+        for segment in self.segments:
+            keys_by_target = {}
+            for key in segment.keys():
+                target = get_target(key)
+                if target is not None:
+                    keys_by_target.setdefault(target, []).append(key)
+
+            for target, keys in keys_by_target.items():
+                for batch_start in range(0, len(keys), EXPORT_BATCH_SIZE):
+                    entries = segment.peek_many(keys[batch_start:batch_start + EXPORT_BATCH_SIZE], now)
+                    for batch in split_entries_by_size(entries, EXPORT_BATCH_MAX_BYTES):
+                        if not send_batch(target, encode_entries(batch)):
+                            task.num_failed += len(batch)
+                            continue
+                        task.num_exported += len(batch)
+                        if remove_exported:
+                            self.is_dirty = True
+                            segment.remove_entries(batch)
+                            for entry in batch:
+                                self.ghost_cache.record_remove(entry.key)
+
+    def import_entries(self, data):
+        """ Add the entries exported by another node, in the snapshot layout, unless their key is already in cache so
+        a newer put is never overwritten. They aren't counted as requests. Returns the number of entries added.
+        Raises ValueError or struct.error if data isn't a valid batch. """
+        reader = SnapshotReader("import", data)
+        self.is_dirty = True
+        num_added = self.add_snapshot_records(reader, reader.records, copy_values=True)
+        self.clear_space_as_necessary()
+        return num_added
+
+    def discard_snapshot_entries(self, keys):
+        """ Drop keys that are being put or invalidated from the pending snapshot entries, so the background restore
+        can't bring back their old value afterwards. """
+        if self.pending_snapshot_records is None:
+            return
+        with self.snapshot_lock:
+            if self.pending_snapshot_records is not None:
+                for key in keys:
+                    self.pending_snapshot_records.pop(key, None)
+
+    def collect_stats(self):
+        """ Get a (stat_id, TimeBoxedCacheStats) sample of the stats since the cache was activated, or None if this
+        cache isn't reporting stats. """
+        if not self.is_active or self.stat_id is None:
+            return None
+        return self.stat_id, self.stat_tracker.create_time_boxed_stat(int(time.time()),
+                                                                      self.get_num_items_in_cache(),
+                                                                      self.get_cache_size_bytes())
+
+    def collect_metrics(self):
+        """ Get the size, request counters and latency histograms of the cache as metric families to scrape.
+        Counters restart from 0 when the cache is activated again, like they would after a restart. """
+        tracker = self.stat_tracker
+        families = [
+            MetricFamily("memcache_size_bytes", "gauge", "Bytes used by cached values.")
+            .add_sample({}, self.get_cache_size_bytes()),
+            MetricFamily("memcache_max_size_bytes", "gauge", "Configured capacity of the cache in bytes.")
+            .add_sample({}, self.get_max_cache_size_bytes()),
+            MetricFamily("memcache_items", "gauge", "Number of cached entries.")
+            .add_sample({}, self.get_num_items_in_cache()),
+            MetricFamily("memcache_active", "gauge", "Whether the node is part of the active pool.")
+            .add_sample({}, int(self.is_active)),
+            MetricFamily("memcache_requests_total", "counter", "Get and put requests served.")
+            .add_sample({}, tracker.num_req_served.get()),
+            MetricFamily("memcache_get_requests_total", "counter", "Get requests served by result.")
+            .add_sample({"result": "hit"}, tracker.num_hits.get())
+            .add_sample({"result": "miss"}, tracker.num_misses.get()),
+            MetricFamily("memcache_evictions_total", "counter", "Entries evicted to make room.")
+            .add_sample({}, tracker.num_evictions.get()),
+        ]
+        operations = MetricFamily("memcache_operation_duration_seconds", "histogram",
+                                  "Time spent in the cache per operation, including lock waits.")
+        for (operation, histogram) in (("get", tracker.get_latency), ("put", tracker.put_latency),
+                                       ("eviction", tracker.eviction_latency)):
+            operations.add_histogram({"operation": operation}, DEFAULT_LATENCY_BUCKETS,
+                                     *histogram.get_cumulative_counts(DEFAULT_LATENCY_BUCKETS))
+        families.append(operations)
+        families.extend(lock_stats_to_metric_families("memcache_segment_lock", tracker.segment_locks))
+        return families
+
+    def save_stats(self):
+        """ Take a stats sample now and flush it along with any buffered ones. """
+        self.stats_flusher.collect()
+        return self.stats_flusher.flush()
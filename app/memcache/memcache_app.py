@@ -1,16 +1,45 @@
-from flask import Flask, request
+from flask import Flask, request, Response
 from app.memcache.memcache import Memcache
-from app.common import ReplacementPolicy, CacheConfig
+from app.metrics import REGISTRY, instrument_app
+from app.hash_ring import HashRing, hash_to_token, is_token_in_range
+from app.apis import MemcacheApi
+from app.common import ReplacementPolicy, CacheConfig, encode_value_for_json, \
+    decode_value_from_json, value_to_bytes, DEFAULT_SCAN_COUNT, DEFAULT_HOT_KEY_COUNT
+import json
 import logging
+import os
+import struct
+import requests
+
+# The node's contents are dumped here periodically and on shutdown, and restored from here on boot. Set
+# MEMCACHE_SNAPSHOT_PATH in the environment to move it, by default it lives in a data directory in the user's home,
+# never in the source tree since it holds cached user images.
+SNAPSHOT_PATH = os.environ.get("MEMCACHE_SNAPSHOT_PATH",
+                               os.path.join(os.path.expanduser("~"), ".photo_album", "memcache.snapshot"))
+os.makedirs(os.path.dirname(os.path.abspath(SNAPSHOT_PATH)), exist_ok=True)
+
+# Routes the async server can run directly on its event loop, see is_loop_path. They only touch the cache, and the
+# background tasks holding segment locks (expiry sweep, shrink, snapshot restore) only hold them for one bounded batch
+# at a time. Everything else, like /save_stats calling CloudWatch or /export, runs in worker threads.
+ASYNC_LOOP_PATHS = frozenset({"/get", "/get_raw", "/put", "/put_raw", "/get_many", "/put_many", "/invalidate",
+                              "/invalidate_many"})
 
 # Configure Flask APP
 memcacheapp = Flask(__name__)
-memcache = Memcache()
+memcache = Memcache(snapshot_path=SNAPSHOT_PATH)
+instrument_app(memcacheapp)
+REGISTRY.register(memcache.collect_metrics)
 
 # Define top level module logger
 logger = logging.getLogger(__name__)
 logger.info("START MEMCACHE APP")
 
+def is_loop_path(path):
+    """ Whether the async server may run a request to path on its event loop. Key/value routes only qualify while the
+    cache neither compresses values nor holds compressed ones, since zlib on a multi-MB image would stall every
+    connection. """
+    return path in ASYNC_LOOP_PATHS and not memcache.is_compression_active()
+
 @memcacheapp.route('/')
 def home():
     msg = "Memcache App"
@@ -21,28 +50,98 @@ def home():
 def get():
     key = request.form.get('key')
     logger.info("Received GET for key=" + key)
-    encoded_img_data = memcache.get(key)
-    if encoded_img_data is not None:
+    value = memcache.get(key)
+    if value is not None:
+        img_data, is_binary = encode_value_for_json(value)
         return {"success": True,
-                "img_data": encoded_img_data
+                "img_data": img_data,
+                "is_binary": is_binary
                 }
     else:
         return {"success": False,
-                "img_data": encoded_img_data
+                "img_data": None
                 }
 
 
+@memcacheapp.route('/get_raw', methods=['GET'])
+def get_raw():
+    """ Binary variant of /get, the value is returned as the response body with a 404 on a miss. """
+    key = request.args.get('key')
+    logger.info("Received raw GET for key=" + key)
+    value = memcache.get(key)
+    if value is None:
+        return Response(status=404)
+    return Response(value_to_bytes(value), mimetype='application/octet-stream')
+
+
 @memcacheapp.route('/put', methods=['POST'])
 def put():
     key = request.form.get('key')
     logger.info("Received PUT for key=" + key)
     encode_img_data = request.form.get('img_data')
-    if memcache.put(key, encode_img_data):
+    refill_cost_ms = request.form.get('refill_cost_ms', type=float)
+    ttl_seconds = request.form.get('ttl_seconds', type=float)
+    if memcache.put(key, encode_img_data, refill_cost_ms, ttl_seconds):
+        return {"success": True}
+    else:
+        return {"success": False}
+
+
+@memcacheapp.route('/put_raw', methods=['POST'])
+def put_raw():
+    """ Binary variant of /put, the key is passed as a query param and the value is the raw request body. """
+    key = request.args.get('key')
+    logger.info("Received raw PUT for key=" + key)
+    img_data = request.get_data()
+    refill_cost_ms = request.args.get('refill_cost_ms', type=float)
+    ttl_seconds = request.args.get('ttl_seconds', type=float)
+    if memcache.put(key, img_data, refill_cost_ms, ttl_seconds):
         return {"success": True}
     else:
         return {"success": False}
 
 
+@memcacheapp.route('/get_many', methods=['POST'])
+def get_many():
+    """ Batch variant of /get. Takes a JSON body {"keys": [...]} and returns the encoded value of every key,
+    null for misses. """
+    keys = request.get_json()['keys']
+    logger.info("Received batch GET for " + str(len(keys)) + " keys")
+    encoded_values = {}
+    for key, value in memcache.get_many(keys).items():
+        if value is None:
+            encoded_values[key] = None
+        else:
+            img_data, is_binary = encode_value_for_json(value)
+            encoded_values[key] = {"img_data": img_data, "is_binary": is_binary}
+    return {"success": True,
+            "values": encoded_values
+            }
+
+
+@memcacheapp.route('/put_many', methods=['POST'])
+def put_many():
+    """ Batch variant of /put. Takes a JSON body {"values": {key: {"img_data": ..., "is_binary": ...}},
+    "ttl_seconds": ..., "if_absent": ...} and returns whether each key was placed in cache. """
+    json_request = request.get_json()
+    values = {}
+    for key, encoded_value in json_request['values'].items():
+        values[key] = decode_value_from_json(encoded_value['img_data'], encoded_value.get('is_binary'))
+    logger.info("Received batch PUT for " + str(len(values)) + " keys")
+    results = memcache.put_many(values, json_request.get('ttl_seconds'), json_request.get('if_absent', False))
+    return {"success": all(results.values()),
+            "results": results
+            }
+
+
+@memcacheapp.route('/invalidate_many', methods=['DELETE'])
+def invalidate_many():
+    """ Batch variant of /invalidate. Takes a JSON body {"keys": [...]}. """
+    keys = request.get_json()['keys']
+    success = memcache.invalidate_many(keys)
+    return {"success": success}
+
+
 @memcacheapp.route('/get_keys', methods=['GET'])
 def get_keys():
     keys = memcache.get_all_keys()
@@ -51,6 +150,36 @@ def get_keys():
             }
 
 
+@memcacheapp.route('/scan_keys', methods=['GET'])
+def scan_keys():
+    """ Get one page of keys. Takes optional cursor, count and prefix query params and returns the keys of the page
+    along with the cursor of the next one, which is null once the scan is done. """
+    cursor = request.args.get('cursor')
+    count = request.args.get('count', DEFAULT_SCAN_COUNT, type=int)
+    prefix = request.args.get('prefix')
+    if count <= 0:
+        logger.warning("Invalid scan count:" + str(count))
+        return {"success": False}
+    try:
+        keys, next_cursor = memcache.scan_keys(cursor, count, prefix)
+    except ValueError:
+        logger.warning("Invalid scan cursor:" + str(cursor))
+        return {"success": False}
+    return {"success": True,
+            "keys": keys,
+            "cursor": next_cursor
+            }
+
+
+@memcacheapp.route('/stream_keys', methods=['GET'])
+def stream_keys():
+    """ Stream all keys matching an optional prefix query param as newline-delimited JSON strings, scanning the
+    cache a page at a time while the response is being written. """
+    prefix = request.args.get('prefix')
+    return Response((json.dumps(key) + "\n" for key in memcache.iter_keys(prefix)),
+                    mimetype='application/x-ndjson')
+
+
 @memcacheapp.route('/invalidate', methods=['DELETE'])
 def invalidate():
     key = request.form.get('key')
@@ -69,23 +198,148 @@ def set_configuration():
     replacement_policy_string = request.form.get('replacement_policy')
     max_size_mb_str = request.form.get('max_size_mb')
     max_num_items_str = request.form.get('max_num_items')
+    default_ttl_seconds = request.form.get('default_ttl_seconds', type=float)
+    compression_level = request.form.get('compression_level', type=int)
+    compression_threshold_bytes = request.form.get('compression_threshold_bytes', type=int)
 
-    if replacement_policy_string == ReplacementPolicy.RANDOM.value:
-        replacement_policy = ReplacementPolicy.RANDOM
-    elif replacement_policy_string == ReplacementPolicy.LRU.value:
-        replacement_policy = ReplacementPolicy.RANDOM
-    else:
-        logger.warning("Invalid specification for replacement policy:" + replacement_policy_string)
+    try:
+        replacement_policy = ReplacementPolicy(replacement_policy_string)
+    except ValueError:
+        logger.warning("Invalid specification for replacement policy:" + str(replacement_policy_string))
         return {"success": False}
 
     max_size_mb = None if max_size_mb_str is None else float(max_size_mb_str)
-    max_num_items = None if max_size_mb_str is None else int(max_num_items_str)
+    max_num_items = None if max_num_items_str is None else int(max_num_items_str)
     if max_size_mb is None and max_num_items is None:
         logger.warning("One of max_size_mb or max_num_items must be specified.")
         return {"success": False}
+    if compression_level is not None and not 0 <= compression_level <= 9:
+        logger.warning("Invalid compression level:" + str(compression_level))
+        return {"success": False}
 
-    success = memcache.set_configuration(CacheConfig(replacement_policy, max_size_mb, max_num_items))
-    return {"success": success}
+    success = memcache.set_configuration(CacheConfig(replacement_policy, max_size_mb, max_num_items, default_ttl_seconds,
+                                                     compression_level, compression_threshold_bytes))
+    return {"success": success,
+            "shrink": memcache.get_shrink_progress() if memcache.is_shrinking() else None
+            }
+
+
+@memcacheapp.route('/shrink_progress', methods=['GET'])
+def shrink_progress():
+    """ Get the progress of the last background shrink started by lowering the cache budget, null if there was
+    none. """
+    return {"success": True,
+            "shrink": memcache.get_shrink_progress()
+            }
+
+
+@memcacheapp.route('/export', methods=['POST'])
+def export_entries():
+    """ Start sending entries of this node directly to other nodes' /import in the background, picked in one of two
+    ways by the JSON body: {"node_url": ..., "routing_table": ...} sends every key to its owner on the hash ring of
+    the routing table, unless that is this node's own url, {"target_url": ..., "token_range": [start, end]} sends the
+    keys hashed in the ring range (start, end] to the target. Exported entries are removed from this node unless
+    "remove" is false. Returns the export's progress right away, poll /export_progress until it is done. """
+    json_request = request.get_json()
+    if json_request.get('routing_table') is not None and json_request.get('node_url') is not None:
+        hash_ring = HashRing.from_routing_table(json_request['routing_table'])
+        node_url = json_request['node_url']
+
+        def get_target(key):
+            owner_url = hash_ring.get_node(key)
+            return None if owner_url == node_url else owner_url
+    elif json_request.get('target_url') is not None and json_request.get('token_range') is not None:
+        target_url = json_request['target_url']
+        start_token, end_token = json_request['token_range']
+
+        def get_target(key):
+            return target_url if is_token_in_range(hash_to_token(key), start_token, end_token) else None
+    else:
+        logger.warning("Invalid export request:" + str(json_request))
+        return {"success": False}
+
+    def send_batch(target_url, data):
+        try:
+            return MemcacheApi.from_url(target_url).import_entries(data) is not None
+        except requests.RequestException as e:
+            logger.warning("Failed to export entries to " + target_url + ": " + str(e))
+            return False
+
+    export_task = memcache.start_export(get_target, send_batch, json_request.get('remove', True))
+    if export_task is None:
+        logger.warning("Ignoring export request while another export is running.")
+        return {"success": False}
+    return {"success": True,
+            "export": export_task.to_dict()
+            }
+
+
+@memcacheapp.route('/export_progress', methods=['GET'])
+def export_progress():
+    """ Get the progress of the last background export, null if there was none. """
+    return {"success": True,
+            "export": memcache.get_export_progress()
+            }
+
+
+@memcacheapp.route('/import', methods=['POST'])
+def import_entries():
+    """ Add the entries of a batch sent by another node's /export, in the snapshot layout, keeping the value of keys
+    already in cache. """
+    try:
+        num_imported = memcache.import_entries(request.get_data())
+    except (ValueError, struct.error) as e:
+        logger.warning("Invalid import batch:" + str(e))
+        return {"success": False}
+    return {"success": True,
+            "num_imported": num_imported
+            }
+
+
+@memcacheapp.route('/stats', methods=['GET'])
+def stats():
+    """ Request counters, latency percentiles of gets, puts and evictions and segment lock wait and hold times. """
+    node_stats = memcache.stat_tracker.to_dict()
+    node_stats["num_items_in_cache"] = memcache.get_num_items_in_cache()
+    node_stats["cache_size_bytes"] = memcache.get_cache_size_bytes()
+    node_stats["compression"] = memcache.compression_stats.to_dict()
+    return {"success": True,
+            "stats": node_stats
+            }
+
+
+@memcacheapp.route('/get_compression_stats', methods=['GET'])
+def get_compression_stats():
+    return {"success": True,
+            "compression_stats": memcache.compression_stats.to_dict()
+            }
+
+
+@memcacheapp.route('/hot_keys', methods=['GET'])
+def hot_keys():
+    """ Get the most requested keys of this node. Takes an optional count query param and returns the hot keys, most
+    requested first, along with the total number of requests they are counted against. """
+    count = request.args.get('count', DEFAULT_HOT_KEY_COUNT, type=int)
+    if count <= 0:
+        logger.warning("Invalid hot key count:" + str(count))
+        return {"success": False}
+    node_hot_keys, total = memcache.get_hot_keys(count)
+    return {"success": True,
+            "hot_keys": node_hot_keys,
+            "total": total
+            }
+
+
+@memcacheapp.route('/miss_ratio_curve', methods=['GET'])
+def miss_ratio_curve():
+    """ Get the miss rate this node is predicted to have at 0.25x to 4x its capacity, along with the estimated number
+    of recent gets the prediction is based on. """
+    sampling_rate = memcache.ghost_cache.get_sampling_rate()
+    return {"success": True,
+            "curve": memcache.get_miss_ratio_curve(),
+            "sampling_rate": sampling_rate,
+            "num_gets": memcache.ghost_cache.num_sampled_gets / sampling_rate
+            }
 
 
 @memcacheapp.route('/save_stats', methods=['GET'])
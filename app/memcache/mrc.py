@@ -0,0 +1,214 @@
+import heapq
+import math
+import threading
+
+# Keys are sampled by the low bits of their hash, a key is sampled when they are below the sampling threshold
+SAMPLING_MODULUS = 1 << 24
+# Every power of two of bytes is split into this many reuse distance buckets
+SUB_BUCKETS = 8
+# Cache sizes the miss ratio curve is reported at, as multiples of the current capacity
+DEFAULT_SIZE_MULTIPLIERS = (0.25, 0.5, 0.75, 1, 1.5, 2, 3, 4)
+
+
+class FenwickTree:
+    """ Prefix sums over a fixed number of slots, with O(log n) updates and queries. """
+
+    def __init__(self, size):
+        self.size = size
+        self.tree = [0] * (size + 1)
+
+    def add(self, index, amount):
+        index += 1
+        while index <= self.size:
+            self.tree[index] += amount
+            index += index & -index
+
+    def prefix_sum(self, index):
+        """ Get the sum of slots 0 to index excluded. """
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+
+class ShardsGhostCache:
+    """ Spatially sampled ghost LRU cache of key sizes, used to estimate the miss ratio curve of the cache (SHARDS).
+    Only keys whose hash falls under the sampling threshold are tracked, so with a rate of 1% about one request in a
+    hundred takes the lock. For every sampled get of a key seen before, its byte-weighted reuse distance, the bytes of
+    the distinct sampled keys requested since its last access scaled up by the sampling rate, is added to a
+    histogram. A get would have hit an LRU cache of any size above that distance.
+    When more than max_sampled_keys are tracked, the key with the highest hash is dropped and the threshold lowered
+    to it, so memory stays bounded whatever the key space. Tracked keys are kept in a max-heap by hash to find it in
+    O(log n); heap items of keys no longer tracked are skipped when popped and dropped when the heap is rebuilt. """
+    threshold: int
+    max_sampled_keys: int
+    decay_window: int
+    num_sampled_gets: float
+
+    def __init__(self, sampling_rate=0.01, max_sampled_keys=8192, decay_window=100000):
+        """ Histogram counts are halved every decay_window sampled gets, so the curve follows the current traffic. """
+        self.threshold = int(sampling_rate * SAMPLING_MODULUS)
+        self.max_sampled_keys = max_sampled_keys
+        self.decay_window = decay_window
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """ Forget all sampled keys and reuse distances. """
+        with self.lock:
+            self.last_access = {}  # key -> [access time slot, size, hash]
+            self.hash_heap = []  # (-hash, key) of tracked keys, and of some keys no longer tracked
+            self.slots = FenwickTree(2 * self.max_sampled_keys)
+            self.clock = 0
+            self.histogram = {}  # reuse distance bucket -> number of sampled gets
+            self.num_sampled_gets = 0
+            self.num_gets_since_decay = 0
+
+    def get_sampling_rate(self):
+        return self.threshold / SAMPLING_MODULUS
+
+    def get_sampled_hash(self, key):
+        """ Get the sampling hash of a key, or None if the key isn't sampled. """
+        key_hash = hash(key) & (SAMPLING_MODULUS - 1)
+        return key_hash if key_hash < self.threshold else None
+
+    def record_get(self, key):
+        key_hash = self.get_sampled_hash(key)
+        if key_hash is None:
+            return
+        with self.lock:
+            self.num_sampled_gets += 1
+            self.num_gets_since_decay += 1
+            access = self.last_access.get(key)
+            # Keys never seen or never put would miss at any cache size
+            if access is not None and access[1] > 0:
+                distance = self.slots.prefix_sum(self.clock) - self.slots.prefix_sum(access[0] + 1)
+                # The key itself has to fit in the cache too
+                bucket = get_bucket_index(distance / self.get_sampling_rate() + access[1])
+                self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+            self.move_to_front(key, key_hash, None if access is None else access[1])
+            if self.num_gets_since_decay >= self.decay_window:
+                self.decay()
+
+    def record_put(self, key, size):
+        key_hash = self.get_sampled_hash(key)
+        if key_hash is None:
+            return
+        with self.lock:
+            self.move_to_front(key, key_hash, size)
+
+    def record_remove(self, key):
+        key_hash = self.get_sampled_hash(key)
+        if key_hash is None:
+            return
+        with self.lock:
+            self.remove_sampled_key(key)
+
+    def move_to_front(self, key, key_hash, size):
+        """ Move a sampled key to the most recently used position, with its size if known. """
+        access = self.remove_sampled_key(key)
+        if key_hash >= self.threshold:
+            # Lowered below this key since it was first sampled
+            return
+        if self.clock == self.slots.size:
+            self.compact_slots()
+        size = size or 0
+        self.last_access[key] = [self.clock, size, key_hash]
+        self.slots.add(self.clock, size)
+        self.clock += 1
+        if access is None:
+            self.push_hash(key, key_hash)
+        if len(self.last_access) > self.max_sampled_keys:
+            self.lower_threshold()
+
+    def remove_sampled_key(self, key):
+        access = self.last_access.pop(key, None)
+        if access is not None:
+            self.slots.add(access[0], -access[1])
+        return access
+
+    def push_hash(self, key, key_hash):
+        """ Add a newly tracked key to the hash heap, rebuilding it from the tracked keys once removed keys make up
+        more than half of it. """
+        if len(self.hash_heap) >= 2 * len(self.last_access):
+            self.hash_heap = [(-access[2], tracked_key) for (tracked_key, access) in self.last_access.items()]
+            heapq.heapify(self.hash_heap)
+        else:
+            heapq.heappush(self.hash_heap, (-key_hash, key))
+
+    def compact_slots(self):
+        """ Renumber the access slots of tracked keys from 0, keeping their order. """
+        self.slots = FenwickTree(self.slots.size)
+        self.clock = 0
+        for access in sorted(self.last_access.values(), key=lambda access: access[0]):
+            access[0] = self.clock
+            self.slots.add(self.clock, access[1])
+            self.clock += 1
+
+    def lower_threshold(self):
+        """ Drop the tracked key with the highest hash and stop sampling keys hashed at or above it. """
+        while True:
+            (negative_hash, max_key) = heapq.heappop(self.hash_heap)
+            # A key's hash never changes, so any item of a tracked key is accurate
+            if max_key in self.last_access:
+                break
+        self.threshold = -negative_hash
+        self.remove_sampled_key(max_key)
+
+    def decay(self):
+        self.num_gets_since_decay = 0
+        self.num_sampled_gets /= 2
+        for bucket in self.histogram:
+            self.histogram[bucket] /= 2
+
+    def get_miss_ratio_curve(self, cache_sizes_bytes):
+        """ Get the predicted miss rate of an LRU cache of each of the provided sizes, or None for all of them if no
+        get was sampled yet. Distances are assumed evenly spread within a bucket, so a bucket straddling a size counts
+        as hits in proportion to how much of it is under the size. """
+        with self.lock:
+            num_sampled_gets = self.num_sampled_gets
+            histogram = sorted(self.histogram.items())
+        if num_sampled_gets == 0:
+            return [None] * len(cache_sizes_bytes)
+        curve = []
+        for cache_size_bytes in cache_sizes_bytes:
+            num_hits = 0
+            for (bucket, count) in histogram:
+                lower_bound = get_bucket_upper_bound(bucket - 1) if bucket > 0 else 0
+                upper_bound = get_bucket_upper_bound(bucket)
+                if upper_bound <= cache_size_bytes:
+                    num_hits += count
+                elif lower_bound < cache_size_bytes:
+                    num_hits += count * (cache_size_bytes - lower_bound) / (upper_bound - lower_bound)
+            curve.append(1 - num_hits / num_sampled_gets)
+        return curve
+
+
+def get_bucket_index(num_bytes):
+    if num_bytes < 1:
+        return 0
+    mantissa, exponent = math.frexp(num_bytes)
+    return 1 + (exponent - 1) * SUB_BUCKETS + int((mantissa * 2 - 1) * SUB_BUCKETS)
+
+
+def get_bucket_upper_bound(index):
+    if index == 0:
+        return 1
+    exponent, sub_bucket = divmod(index - 1, SUB_BUCKETS)
+    return (2 ** exponent) * (1 + (sub_bucket + 1) / SUB_BUCKETS)
+
+
+def interpolate_miss_rate(curve, size_multiplier):
+    """ Get the miss rate at a size multiplier from a list of (size multiplier, miss rate) points sorted by size,
+    linearly interpolated between points and clamped to the ends of the curve. """
+    points = [(multiplier, miss_rate) for (multiplier, miss_rate) in curve if miss_rate is not None]
+    if not points:
+        return None
+    if size_multiplier <= points[0][0]:
+        return points[0][1]
+    for ((low_multiplier, low_miss_rate), (high_multiplier, high_miss_rate)) in zip(points, points[1:]):
+        if size_multiplier <= high_multiplier:
+            fraction = (size_multiplier - low_multiplier) / (high_multiplier - low_multiplier)
+            return low_miss_rate + fraction * (high_miss_rate - low_miss_rate)
+    return points[-1][1]
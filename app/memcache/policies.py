@@ -0,0 +1,504 @@
+import heapq
+import itertools
+import random
+from collections import OrderedDict
+from app.common import ReplacementPolicy
+
+# Refill cost GDSF charges entries without a measured one before any entry has one
+GDSF_DEFAULT_REFILL_COST_MS = 1
+# GDSF re-ranks entries without a measured refill cost once the average measured cost moves by more than this factor
+GDSF_REKEY_COST_RATIO = 2
+
+
+class EvictionPolicy:
+    """ Decides which entry of an EntryTable to evict next. Policies only track keys, the table owns the values. """
+    # Amortized bytes of bookkeeping the policy keeps per tracked key
+    entry_overhead_bytes = 0
+
+    def on_insert(self, entry):
+        """ Start tracking an entry that was just added to the table. """
+        pass
+
+    def on_access(self, entry):
+        """ Record a hit on an entry. """
+        pass
+
+    def on_remove(self, entry, evicted):
+        """ Stop tracking an entry that was removed from the table, evicted is True if it was picked as a victim. """
+        pass
+
+    def pick_victim(self, exclude_keys=()):
+        """ Get the key of the entry that should be evicted next, never picking one of exclude_keys.
+        Returns None if there is no entry to evict. """
+        return None
+
+    def keys_in_eviction_order(self):
+        """ Get all tracked keys, from the one that would be evicted first to the one that would be evicted last. """
+        return []
+
+    def clear(self):
+        pass
+
+
+def first_key(ordered_keys, exclude_keys=()):
+    """ Get the oldest key of an OrderedDict that isn't one of exclude_keys, None if there isn't one. """
+    for key in ordered_keys:
+        if key not in exclude_keys:
+            return key
+    return None
+
+
+class LRUPolicy(EvictionPolicy):
+    """ Evicts the least recently used entry. """
+    entry_overhead_bytes = 92  # OrderedDict slot and linked list node
+    order: OrderedDict
+
+    def __init__(self):
+        self.order = OrderedDict()
+
+    def on_insert(self, entry):
+        self.order[entry.key] = None
+
+    def on_access(self, entry):
+        self.order.move_to_end(entry.key)
+
+    def on_remove(self, entry, evicted):
+        self.order.pop(entry.key, None)
+
+    def pick_victim(self, exclude_keys=()):
+        return first_key(self.order, exclude_keys)
+
+    def keys_in_eviction_order(self):
+        return list(self.order)
+
+    def clear(self):
+        self.order.clear()
+
+
+class RandomPolicy(EvictionPolicy):
+    """ Evicts an entry picked uniformly at random. Keys are kept in an indexable array with swap-remove so both
+    removing a key and picking a victim are O(1). """
+    entry_overhead_bytes = 76  # Array slot plus position index dict slot
+    keys: list
+    positions: dict
+
+    def __init__(self):
+        self.keys = []
+        self.positions = {}
+
+    def on_insert(self, entry):
+        self.positions[entry.key] = len(self.keys)
+        self.keys.append(entry.key)
+
+    def on_remove(self, entry, evicted):
+        position = self.positions.pop(entry.key, None)
+        if position is None:
+            return
+        # Move the last key into the hole left by the removed one
+        last_key = self.keys.pop()
+        if position < len(self.keys):
+            self.keys[position] = last_key
+            self.positions[last_key] = position
+
+    def pick_victim(self, exclude_keys=()):
+        excluded_positions = sorted(self.positions[key] for key in exclude_keys if key in self.positions)
+        num_candidates = len(self.keys) - len(excluded_positions)
+        if num_candidates <= 0:
+            return None
+        position = random.randrange(num_candidates)
+        for excluded_position in excluded_positions:
+            if position >= excluded_position:
+                # Skip over the excluded key while keeping the pick uniform
+                position += 1
+        return self.keys[position]
+
+    def keys_in_eviction_order(self):
+        # Every key is as likely to be evicted next
+        return list(self.keys)
+
+    def clear(self):
+        self.keys.clear()
+        self.positions.clear()
+
+
+class LFUPolicy(EvictionPolicy):
+    """ Evicts the least frequently used entry, with dynamic aging (LFU-DA): an entry's priority is its hit count
+    plus the priority of the last evicted entry, so entries that were popular a long time ago eventually age out.
+    Priorities are kept in a heap with lazy deletion, stale heap items are skipped when picking a victim. """
+    entry_overhead_bytes = 296  # Priority record, its dict slot and its live and stale heap items
+    priorities: dict
+    heap: list
+    age: float
+
+    def __init__(self):
+        self.priorities = {}  # key -> [priority, frequency, sequence number of its live heap item]
+        self.heap = []
+        self.age = 0
+        self.sequence = itertools.count()
+
+    def get_priority(self, entry, frequency):
+        """ Get the priority of an entry accessed frequency times, lowest priority is evicted first. """
+        return self.age + frequency
+
+    def update(self, entry, frequency):
+        priority = self.get_priority(entry, frequency)
+        sequence = next(self.sequence)
+        self.priorities[entry.key] = [priority, frequency, sequence]
+        heapq.heappush(self.heap, (priority, sequence, entry.key))
+        if len(self.heap) > 2 * len(self.priorities) + 64:
+            self.compact_heap()
+
+    def compact_heap(self):
+        """ Rebuild the heap from live items only. """
+        self.heap = [(priority, sequence, key) for key, (priority, frequency, sequence) in self.priorities.items()]
+        heapq.heapify(self.heap)
+
+    def is_live(self, heap_item):
+        record = self.priorities.get(heap_item[2])
+        return record is not None and record[2] == heap_item[1]
+
+    def on_insert(self, entry):
+        self.update(entry, 1)
+
+    def on_access(self, entry):
+        self.update(entry, self.priorities[entry.key][1] + 1)
+
+    def on_remove(self, entry, evicted):
+        record = self.priorities.pop(entry.key, None)
+        if record is not None and evicted:
+            self.age = record[0]
+
+    def pick_victim(self, exclude_keys=()):
+        skipped = []
+        victim = None
+        while self.heap:
+            if not self.is_live(self.heap[0]):
+                heapq.heappop(self.heap)
+            elif self.heap[0][2] in exclude_keys:
+                skipped.append(heapq.heappop(self.heap))
+            else:
+                victim = self.heap[0][2]
+                break
+        for heap_item in skipped:
+            heapq.heappush(self.heap, heap_item)
+        return victim
+
+    def keys_in_eviction_order(self):
+        records = sorted(self.priorities.items(), key=lambda item: (item[1][0], item[1][2]))
+        return [key for key, record in records]
+
+    def clear(self):
+        self.priorities.clear()
+        self.heap.clear()
+        self.age = 0
+
+
+class GDSFPolicy(LFUPolicy):
+    """ GreedyDual-Size-Frequency. Like LFU-DA but an entry's hit count is weighted by its refill cost per byte, so
+    small entries that are expensive to reload outlive large cheap ones and one big image can't push out dozens of
+    small hot ones. Entries without a measured refill cost are charged the average refill cost of the entries that
+    have one, or GDSF_DEFAULT_REFILL_COST_MS until one is measured, so they are still weighted by their size and
+    ranked on the same scale as measured entries. When that average drifts by more than GDSF_REKEY_COST_RATIO from
+    the cost the unmeasured entries were ranked with, their priorities are recomputed and the heap rebuilt. """
+    # Plus the age and size of entries without a measured refill cost, and its dict slot
+    entry_overhead_bytes = LFUPolicy.entry_overhead_bytes + 120
+    total_measured_cost_ms: float
+    num_measured: int
+    default_cost_ms: float
+    unmeasured: dict
+
+    def __init__(self):
+        super().__init__()
+        self.total_measured_cost_ms = 0
+        self.num_measured = 0
+        self.default_cost_ms = GDSF_DEFAULT_REFILL_COST_MS
+        self.unmeasured = {}  # key -> [age when last prioritized, size] of entries without a measured refill cost
+
+    def get_priority(self, entry, frequency):
+        cost_ms = self.default_cost_ms if entry.refill_cost_ms is None else entry.refill_cost_ms
+        return self.age + frequency * cost_ms / max(entry.size, 1)
+
+    def update(self, entry, frequency):
+        super().update(entry, frequency)
+        if entry.refill_cost_ms is None:
+            self.unmeasured[entry.key] = [self.age, entry.size]
+
+    def on_insert(self, entry):
+        if entry.refill_cost_ms is not None:
+            self.total_measured_cost_ms += entry.refill_cost_ms
+            self.num_measured += 1
+        super().on_insert(entry)
+        self.rekey_if_cost_drifted()
+
+    def on_remove(self, entry, evicted):
+        if entry.refill_cost_ms is not None:
+            self.total_measured_cost_ms -= entry.refill_cost_ms
+            self.num_measured -= 1
+        self.unmeasured.pop(entry.key, None)
+        super().on_remove(entry, evicted)
+        self.rekey_if_cost_drifted()
+
+    def rekey_if_cost_drifted(self):
+        """ Re-rank entries without a measured refill cost if the average measured cost moved too far from the cost
+        they were ranked with. """
+        if self.num_measured == 0:
+            average_cost_ms = GDSF_DEFAULT_REFILL_COST_MS
+        else:
+            average_cost_ms = max(self.total_measured_cost_ms / self.num_measured, 0)
+        ratio = (average_cost_ms + 1e-9) / (self.default_cost_ms + 1e-9)
+        if 1 / GDSF_REKEY_COST_RATIO <= ratio <= GDSF_REKEY_COST_RATIO:
+            return
+        self.default_cost_ms = average_cost_ms
+        for key, (age, size) in self.unmeasured.items():
+            record = self.priorities[key]
+            record[0] = age + record[1] * average_cost_ms / max(size, 1)
+        self.compact_heap()
+
+    def clear(self):
+        super().clear()
+        self.total_measured_cost_ms = 0
+        self.num_measured = 0
+        self.default_cost_ms = GDSF_DEFAULT_REFILL_COST_MS
+        self.unmeasured.clear()
+
+
+class ARCPolicy(EvictionPolicy):
+    """ Adaptive Replacement Cache. Entries seen once live in t1 and entries hit again in t2, ghost lists b1/b2
+    remember recently evicted keys and hits on them adapt the target size of t1, so a one-off scan only flushes t1.
+    Sizes are counted in entries with the current number of resident entries as the capacity. """
+    entry_overhead_bytes = 184  # Resident list slot plus on average one ghost list slot
+    t1: OrderedDict
+    t2: OrderedDict
+    b1: OrderedDict
+    b2: OrderedDict
+    target_t1: float
+
+    def __init__(self):
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+        self.target_t1 = 0
+
+    def get_capacity(self):
+        return max(len(self.t1) + len(self.t2), 1)
+
+    def on_insert(self, entry):
+        key = entry.key
+        if key in self.b1:
+            # Recency list was too small, grow its target
+            self.target_t1 = min(self.get_capacity(), self.target_t1 + max(len(self.b2) / len(self.b1), 1))
+            del self.b1[key]
+            self.t2[key] = None
+        elif key in self.b2:
+            # Frequency list was too small, shrink the recency target
+            self.target_t1 = max(0, self.target_t1 - max(len(self.b1) / len(self.b2), 1))
+            del self.b2[key]
+            self.t2[key] = None
+        else:
+            self.t1[key] = None
+        self.trim_ghosts()
+
+    def on_access(self, entry):
+        key = entry.key
+        if key in self.t1:
+            del self.t1[key]
+            self.t2[key] = None
+        else:
+            self.t2.move_to_end(key)
+
+    def on_remove(self, entry, evicted):
+        key = entry.key
+        if key in self.t1:
+            del self.t1[key]
+            if evicted:
+                self.b1[key] = None
+        elif key in self.t2:
+            del self.t2[key]
+            if evicted:
+                self.b2[key] = None
+        self.trim_ghosts()
+
+    def trim_ghosts(self):
+        capacity = self.get_capacity()
+        while self.b1 and len(self.t1) + len(self.b1) > capacity:
+            self.b1.popitem(last=False)
+        while self.b2 and len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2) > 2 * capacity:
+            self.b2.popitem(last=False)
+
+    def pick_victim(self, exclude_keys=()):
+        if self.t1 and len(self.t1) > self.target_t1:
+            lists = (self.t1, self.t2)
+        else:
+            lists = (self.t2, self.t1)
+        for ordered_keys in lists:
+            victim = first_key(ordered_keys, exclude_keys)
+            if victim is not None:
+                return victim
+        return None
+
+    def keys_in_eviction_order(self):
+        return list(self.t1) + list(self.t2)
+
+    def clear(self):
+        self.t1.clear()
+        self.t2.clear()
+        self.b1.clear()
+        self.b2.clear()
+        self.target_t1 = 0
+
+
+# Translation table mapping each counter value to half of it
+HALVE_COUNTS = bytes(count >> 1 for count in range(256))
+
+
+class CountMinSketch:
+    """ Approximate access frequency counter with small saturating counters that are halved periodically,
+    so the estimates reflect recent popularity. """
+    DEPTH = 4
+    MAX_COUNT = 15
+    width: int
+    counters: list
+    num_increments: int
+
+    def __init__(self, width):
+        self.resize(width)
+
+    def resize(self, width):
+        """ Reset the sketch with a new width (rounded up to a power of 2). """
+        self.width = 1 << max(width - 1, 1).bit_length()
+        self.counters = [bytearray(self.width) for i in range(self.DEPTH)]
+        self.num_increments = 0
+
+    def get_indexes(self, key):
+        key_hash = hash(key)
+        step = (key_hash >> 16) | 1
+        mask = self.width - 1
+        return [(key_hash + i * step) & mask for i in range(self.DEPTH)]
+
+    def increment(self, key):
+        for row, index in zip(self.counters, self.get_indexes(key)):
+            if row[index] < self.MAX_COUNT:
+                row[index] += 1
+        self.num_increments += 1
+        if self.num_increments >= 10 * self.width:
+            self.age()
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.counters, self.get_indexes(key)))
+
+    def age(self):
+        """ Halve all counters. """
+        for row in self.counters:
+            row[:] = row.translate(HALVE_COUNTS)
+        self.num_increments //= 2
+
+
+class WTinyLFUPolicy(EvictionPolicy):
+    """ Window TinyLFU. New entries land in a small LRU window, when it overflows its oldest entry only makes it
+    into the main segmented LRU (probation and protected lists) if a count-min sketch says it is accessed more often
+    than the entry it would push out, which keeps one-off scans from flushing popular entries. """
+    WINDOW_FRACTION = 0.01
+    PROTECTED_FRACTION = 0.8
+    MIN_SKETCH_WIDTH = 1024
+    entry_overhead_bytes = 112  # List slot plus sketch counters
+    window: OrderedDict
+    probation: OrderedDict
+    protected: OrderedDict
+    sketch: CountMinSketch
+
+    def __init__(self):
+        self.window = OrderedDict()
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.sketch = CountMinSketch(self.MIN_SKETCH_WIDTH)
+
+    def get_num_entries(self):
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+    def record_access(self, key):
+        if self.get_num_entries() > self.sketch.width:
+            # Keep roughly one counter per entry so estimates stay accurate as the cache grows
+            self.sketch.resize(2 * self.sketch.width)
+        self.sketch.increment(key)
+
+    def on_insert(self, entry):
+        self.record_access(entry.key)
+        self.window[entry.key] = None
+
+    def on_access(self, entry):
+        key = entry.key
+        self.record_access(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+        elif key in self.probation:
+            del self.probation[key]
+            self.protected[key] = None
+            if len(self.protected) > self.PROTECTED_FRACTION * (len(self.probation) + len(self.protected)):
+                # Demote the oldest protected entry back to probation
+                (demoted_key, value) = self.protected.popitem(last=False)
+                self.probation[demoted_key] = None
+        else:
+            self.protected.move_to_end(key)
+
+    def on_remove(self, entry, evicted):
+        key = entry.key
+        if key in self.window:
+            del self.window[key]
+        elif key in self.probation:
+            del self.probation[key]
+        else:
+            self.protected.pop(key, None)
+
+    def get_main_victim(self, exclude_keys):
+        victim = first_key(self.probation, exclude_keys)
+        if victim is None:
+            victim = first_key(self.protected, exclude_keys)
+        return victim
+
+    def pick_victim(self, exclude_keys=()):
+        window_target = max(1, int(self.WINDOW_FRACTION * self.get_num_entries()))
+        main_victim = self.get_main_victim(exclude_keys)
+        if main_victim is None:
+            # Main cache is still empty (e.g. right after a clear), admit the window overflow without a contest
+            while len(self.window) > window_target:
+                (admitted_key, value) = self.window.popitem(last=False)
+                self.probation[admitted_key] = None
+            main_victim = self.get_main_victim(exclude_keys)
+        if len(self.window) <= window_target and main_victim is not None:
+            return main_victim
+
+        candidate = first_key(self.window, exclude_keys)
+        if candidate is None or main_victim is None:
+            return main_victim if candidate is None else candidate
+        if self.sketch.estimate(candidate) > self.sketch.estimate(main_victim):
+            # Admit the window candidate into the main cache, pushing out the main victim instead
+            del self.window[candidate]
+            self.probation[candidate] = None
+            return main_victim
+        return candidate
+
+    def keys_in_eviction_order(self):
+        # The window holds the most recently added entries and protected the ones hit since they were admitted
+        return list(self.probation) + list(self.protected) + list(self.window)
+
+    def clear(self):
+        self.window.clear()
+        self.probation.clear()
+        self.protected.clear()
+        self.sketch.resize(self.MIN_SKETCH_WIDTH)
+
+
+POLICY_CLASSES = {
+    ReplacementPolicy.LRU: LRUPolicy,
+    ReplacementPolicy.RANDOM: RandomPolicy,
+    ReplacementPolicy.LFU: LFUPolicy,
+    ReplacementPolicy.ARC: ARCPolicy,
+    ReplacementPolicy.W_TINY_LFU: WTinyLFUPolicy,
+    ReplacementPolicy.GDSF: GDSFPolicy,
+}
+
+
+def create_eviction_policy(replacement_policy: ReplacementPolicy):
+    """ Create a new, empty eviction policy instance for the provided replacement policy. """
+    return POLICY_CLASSES[replacement_policy]()
@@ -0,0 +1,235 @@
+from app.memcache.entry_table import EntryTable, compute_entry_size
+from app.memcache.hot_keys import SpaceSavingSketch
+from app.memcache.policies import EvictionPolicy
+from app.rw_lock import ReadWriteLock
+
+
+class CacheSegment:
+    """ One independently locked slice of the cache with its own eviction order and byte budget.
+    If a LockStats is provided, the time spent waiting for and holding the segment lock is recorded in it.
+    Gets and puts are counted in a hot keys sketch of the segment's keys, inside the critical section they already
+    hold. """
+    table: EntryTable
+    rw_lock: ReadWriteLock
+    budget_bytes: int
+    hot_keys: SpaceSavingSketch
+
+    def __init__(self, policy: EvictionPolicy, lock_stats=None, hot_key_capacity=64):
+        self.table = EntryTable(policy)
+        self.rw_lock = ReadWriteLock(lock_stats)
+        self.budget_bytes = 0
+        self.hot_keys = SpaceSavingSketch(hot_key_capacity)
+
+    def get_size_bytes(self):
+        return self.table.size_bytes
+
+    def get_num_items(self):
+        return len(self.table)
+
+    def compute_entry_size(self, key, value):
+        """ Get the number of bytes a key/value pair is charged once stored in this segment, including the overhead of
+        the segment's eviction policy. """
+        return compute_entry_size(key, value, self.table.policy)
+
+    def get_overage(self):
+        """ Get by how much (in bytes) this segment is over its byte budget, negative if it is under. """
+        return self.table.size_bytes - self.budget_bytes
+
+    def get_and_promote(self, key, now):
+        """ Get the value stored for a key and record the access with the eviction policy in one critical section.
+        Returns None if the key isn't in this segment or has expired. """
+        with self.rw_lock.write_locked():
+            value = None
+            self.hot_keys.add(key)
+            entry = self.table.promote(key, now)
+            if entry is not None:
+                value = entry.value
+        return value
+
+    def get_many_and_promote(self, keys, now):
+        """ Batch variant of get_and_promote holding the lock once for all provided keys.
+        Returns a dict of key to value, with None for keys that aren't in this segment or have expired. """
+        values = {}
+        with self.rw_lock.write_locked():
+            for key in keys:
+                self.hot_keys.add(key)
+                entry = self.table.promote(key, now)
+                values[key] = None if entry is None else entry.value
+        return values
+
+    def add(self, key, value, refill_cost_ms=None, expires_at=None):
+        """ Store a key/value pair in this segment, replacing any existing entry for the key. """
+        with self.rw_lock.write_locked():
+            self.hot_keys.add(key)
+            entry = self.table.add(key, value, refill_cost_ms, expires_at)
+        return entry
+
+    def add_many(self, items):
+        """ Store a list of (key, value, refill_cost_ms, expires_at) tuples in one critical section. """
+        with self.rw_lock.write_locked():
+            for (key, value, refill_cost_ms, expires_at) in items:
+                self.hot_keys.add(key)
+                self.table.add(key, value, refill_cost_ms, expires_at)
+
+    def add_many_if_absent(self, items):
+        """ Store the (key, value, refill_cost_ms, expires_at) tuples whose key isn't in this segment yet, in one
+        critical section. Returns the items that were added. """
+        added_items = []
+        with self.rw_lock.write_locked():
+            for (key, value, refill_cost_ms, expires_at) in items:
+                if key not in self.table:
+                    self.table.add(key, value, refill_cost_ms, expires_at)
+                    added_items.append((key, value, refill_cost_ms, expires_at))
+        return added_items
+
+    def peek_many(self, keys, now):
+        """ Get the entries of the provided keys that are in this segment and haven't expired, without promoting them
+        or counting them as requests. """
+        entries = []
+        with self.rw_lock.read_locked():
+            for key in keys:
+                entry = self.table.get(key)
+                if entry is not None and not entry.is_expired(now):
+                    entries.append(entry)
+        return entries
+
+    def remove_expired(self, keys, now):
+        """ Remove the entries of the provided keys that have expired by now. Returns the number removed. """
+        num_removed = 0
+        with self.rw_lock.write_locked():
+            for key in keys:
+                entry = self.table.get(key)
+                if entry is not None and entry.is_expired(now):
+                    self.table.remove(key)
+                    num_removed += 1
+        return num_removed
+
+    def remove(self, key):
+        """ Remove the entry stored for a key. Returns the removed entry or None if it wasn't in this segment. """
+        with self.rw_lock.write_locked():
+            entry = self.table.remove(key)
+        return entry
+
+    def remove_entries(self, entries):
+        """ Remove the provided entries in one critical section, skipping keys that were put again since the entries
+        were read. Returns the number removed. """
+        num_removed = 0
+        with self.rw_lock.write_locked():
+            for entry in entries:
+                if self.table.get(entry.key) is entry:
+                    self.table.remove(entry.key)
+                    num_removed += 1
+        return num_removed
+
+    def remove_many(self, keys):
+        """ Remove the entries stored for the provided keys in one critical section. Returns the number removed. """
+        num_removed = 0
+        with self.rw_lock.write_locked():
+            for key in keys:
+                if self.table.remove(key) is not None:
+                    num_removed += 1
+        return num_removed
+
+    def evict(self, exclude_keys=()):
+        """ Remove and return the entry picked by the eviction policy, never removing one of exclude_keys. """
+        with self.rw_lock.write_locked():
+            entry = self.table.evict(exclude_keys)
+        return entry
+
+    def evict_many(self, max_count, min_bytes, min_count):
+        """ Evict entries picked by the eviction policy in one critical section, until at least min_bytes and
+        min_count entries were evicted or max_count entries were. Returns the evicted entries. """
+        entries = []
+        bytes_evicted = 0
+        with self.rw_lock.write_locked():
+            while len(entries) < max_count and (bytes_evicted < min_bytes or len(entries) < min_count):
+                entry = self.table.evict()
+                if entry is None:
+                    break
+                entries.append(entry)
+                bytes_evicted += entry.size
+        return entries
+
+    def set_policy(self, policy: EvictionPolicy):
+        """ Switch this segment to a new eviction policy. """
+        with self.rw_lock.write_locked():
+            self.table.set_policy(policy)
+
+    def keys(self):
+        """ Get a copy of all keys in this segment. """
+        with self.rw_lock.read_locked():
+            keys = self.table.keys()
+        return keys
+
+    def entries_in_eviction_order(self):
+        """ Get a copy of all entries of this segment in the order its policy would evict them. """
+        with self.rw_lock.read_locked():
+            entries = self.table.entries_in_eviction_order()
+        return entries
+
+    def scan_keys(self, after_seq, count):
+        """ Get a page of up to count keys of this segment added after sequence number after_seq, along with the
+        sequence number the next page starts after, None once the segment is done. """
+        with self.rw_lock.read_locked():
+            keys, next_seq = self.table.scan_keys(after_seq, count)
+        return keys, next_seq
+
+    def get_hot_keys(self, k):
+        """ Get the (key, count, error) of the k most requested keys of this segment and the number of requests the
+        sketch has counted. """
+        with self.rw_lock.read_locked():
+            hot_keys = self.hot_keys.top(k)
+            total = self.hot_keys.total
+        return hot_keys, total
+
+    def decay_hot_keys(self):
+        with self.rw_lock.write_locked():
+            self.hot_keys.decay()
+
+    def clear(self):
+        with self.rw_lock.write_locked():
+            self.table.clear()
+
+
+class BudgetCoordinator:
+    """ Splits the global byte and item budget of the cache across its segments and picks where to evict from.
+    Segments may grow past their share while the cache as a whole has room, so large entries still fit. """
+    segments: list
+    max_size_bytes: int
+    max_num_items: int
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.max_size_bytes = 0
+        self.max_num_items = 0
+
+    def set_limits(self, max_size_bytes, max_num_items):
+        """ Set the global budget and split the byte budget evenly across all segments. """
+        self.max_size_bytes = max_size_bytes
+        self.max_num_items = max_num_items
+        for segment in self.segments:
+            segment.budget_bytes = max_size_bytes // len(self.segments)
+
+    def get_size_bytes(self):
+        return sum(segment.get_size_bytes() for segment in self.segments)
+
+    def get_num_items(self):
+        return sum(segment.get_num_items() for segment in self.segments)
+
+    def is_over_budget(self):
+        return self.get_size_bytes() > self.max_size_bytes or self.get_num_items() > self.max_num_items
+
+    def pick_segment_to_evict(self, exclude_keys=()):
+        """ Get the segment furthest over its budget that still has an entry not in exclude_keys to evict.
+        Returns None if there is nothing left to evict. """
+        best_segment = None
+        for segment in self.segments:
+            num_evictable = segment.get_num_items()
+            # Only count the excluded keys of segments they could leave without evictable entries
+            if num_evictable <= len(exclude_keys):
+                num_evictable -= sum(1 for key in exclude_keys if key in segment.table)
+            if num_evictable <= 0:
+                continue
+            if best_segment is None or segment.get_overage() > best_segment.get_overage():
+                best_segment = segment
+        return best_segment
@@ -0,0 +1,131 @@
+import io
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+from app.memcache.compression import CompressedValue
+
+logger = logging.getLogger(__name__)
+
+# Snapshot file layout: header | value region | key index
+# The value region holds every value back to back. The index has one record per entry, ordered from the entry that
+# would be evicted first to the one that would be evicted last, followed by its utf-8 key.
+MAGIC = b'MCSNAP01'
+HEADER = struct.Struct('!8sQQd')  # magic, number of entries, offset of the index, creation time
+INDEX_RECORD = struct.Struct('!HBQQdd')  # key length, flags, value offset, value length, expires_at, refill_cost_ms
+FLAG_VALUE_IS_TEXT = 0x01
+FLAG_VALUE_IS_COMPRESSED = 0x02
+
+
+class SnapshotRecord:
+    """ Location and metadata of one entry of a snapshot. """
+    __slots__ = ('key', 'flags', 'value_offset', 'value_length', 'expires_at', 'refill_cost_ms')
+
+    def __init__(self, key, flags, value_offset, value_length, expires_at, refill_cost_ms):
+        self.key = key
+        self.flags = flags
+        self.value_offset = value_offset
+        self.value_length = value_length
+        self.expires_at = expires_at
+        self.refill_cost_ms = refill_cost_ms
+
+
+def encode_optional_float(value):
+    return math.nan if value is None else float(value)
+
+
+def decode_optional_float(value):
+    return None if math.isnan(value) else value
+
+
+def write_entries(snapshot_file, entries):
+    """ Write a list of CacheEntry to a seekable binary file in the snapshot layout. Returns the number written. """
+    snapshot_file.write(HEADER.pack(MAGIC, 0, 0, 0))
+    records = []
+    offset = HEADER.size
+    for entry in entries:
+        if isinstance(entry.value, str):
+            data, flags = entry.value.encode('utf-8'), FLAG_VALUE_IS_TEXT
+        elif isinstance(entry.value, CompressedValue):
+            data = entry.value.data
+            flags = FLAG_VALUE_IS_COMPRESSED | (FLAG_VALUE_IS_TEXT if entry.value.is_text else 0)
+        else:
+            data, flags = entry.value, 0
+        snapshot_file.write(data)
+        records.append((entry.key.encode('utf-8'), flags, offset, len(data), entry.expires_at,
+                        entry.refill_cost_ms))
+        offset += len(data)
+
+    index_offset = offset
+    for (key, flags, value_offset, value_length, expires_at, refill_cost_ms) in records:
+        snapshot_file.write(INDEX_RECORD.pack(len(key), flags, value_offset, value_length,
+                                              encode_optional_float(expires_at),
+                                              encode_optional_float(refill_cost_ms)))
+        snapshot_file.write(key)
+
+    snapshot_file.seek(0)
+    snapshot_file.write(HEADER.pack(MAGIC, len(records), index_offset, time.time()))
+    return len(records)
+
+
+def write_snapshot(path, entries):
+    """ Write a list of CacheEntry, ordered from first to last to be evicted, to a snapshot file.
+    The snapshot is written next to path and moved over it once complete, so a crash never leaves a torn file. """
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as snapshot_file:
+        num_entries = write_entries(snapshot_file, entries)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temp_path, path)
+    return num_entries
+
+
+def encode_entries(entries):
+    """ Get a list of CacheEntry in the snapshot layout as bytes, the format nodes transfer entries to each other
+    in. """
+    buffer = io.BytesIO()
+    write_entries(buffer, entries)
+    return buffer.getvalue()
+
+
+class SnapshotReader:
+    """ Memory-maps a snapshot file and reads its index. Values are only paged in from the file once they are read,
+    binary values are returned as memoryview slices of the mapping, so they are never copied into the heap. """
+    created_at: float
+    records: list
+
+    def __init__(self, path, data=None):
+        """ If data is provided, entries are read from these bytes instead, like the body of an /import request, and
+        path only names them in errors. """
+        if data is None:
+            with open(path, 'rb') as snapshot_file:
+                self.buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buffer = data
+        self.view = memoryview(self.buffer)
+        magic, num_entries, index_offset, self.created_at = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a memcache snapshot: " + path)
+
+        self.records = []
+        offset = index_offset
+        for i in range(num_entries):
+            key_length, flags, value_offset, value_length, expires_at, refill_cost_ms = \
+                INDEX_RECORD.unpack_from(self.buffer, offset)
+            key_start = offset + INDEX_RECORD.size
+            offset = key_start + key_length
+            if value_offset + value_length > index_offset or offset > len(self.buffer):
+                raise ValueError("Corrupt memcache snapshot: " + path)
+            self.records.append(SnapshotRecord(bytes(self.view[key_start:offset]).decode('utf-8'), flags,
+                                               value_offset, value_length, decode_optional_float(expires_at),
+                                               decode_optional_float(refill_cost_ms)))
+
+    def get_value(self, record):
+        value = self.view[record.value_offset:record.value_offset + record.value_length]
+        if record.flags & FLAG_VALUE_IS_COMPRESSED:
+            return CompressedValue(value, bool(record.flags & FLAG_VALUE_IS_TEXT))
+        if record.flags & FLAG_VALUE_IS_TEXT:
+            return str(value, 'utf-8')
+        return value
@@ -1,44 +1,255 @@
 from app.common import TimeBoxedCacheStats
 from app.boto_utils import save_time_boxed_cache_stats
+from app.metrics import MetricFamily, DEFAULT_LATENCY_BUCKETS
+import math
+import threading
 import time
 
+# Number of independently locked cells a counter or histogram is split into. Threads are spread across the cells by
+# their native id, so concurrent updates rarely wait on each other and reads merge all cells.
+NUM_STRIPES = 16
+
+
+def get_stripe_index():
+    return threading.get_native_id() % NUM_STRIPES
+
+
+class StripedCounter:
+    """ Thread safe counter made of striped cells that are summed on read. """
+
+    def __init__(self):
+        self.locks = [threading.Lock() for i in range(NUM_STRIPES)]
+        self.cells = [0] * NUM_STRIPES
+
+    def add(self, amount=1):
+        stripe = get_stripe_index()
+        with self.locks[stripe]:
+            self.cells[stripe] += amount
+
+    def get(self):
+        return sum(self.cells)
+
+    def reset(self):
+        for stripe in range(NUM_STRIPES):
+            with self.locks[stripe]:
+                self.cells[stripe] = 0
+
+
+class LatencyHistogram:
+    """ Thread safe histogram of durations with log-scaled buckets: every power of two of microseconds is split into
+    SUB_BUCKETS buckets, so percentiles are accurate to within 1/SUB_BUCKETS of the true value from 1us to ~2 hours.
+    Recording is O(1) and only locks one stripe, percentiles are computed from the merged stripes on read. """
+    SUB_BUCKETS = 4
+    MAX_EXPONENT = 33
+    NUM_BUCKETS = 1 + MAX_EXPONENT * SUB_BUCKETS
+
+    def __init__(self):
+        self.locks = [threading.Lock() for i in range(NUM_STRIPES)]
+        self.stripes = [None] * NUM_STRIPES
+        self.reset()
+
+    def reset(self):
+        for stripe in range(NUM_STRIPES):
+            with self.locks[stripe]:
+                # count, total seconds, max seconds and the bucket counts
+                self.stripes[stripe] = [0, 0.0, 0.0] + [0] * self.NUM_BUCKETS
+
+    @classmethod
+    def get_bucket_index(cls, seconds):
+        micros = seconds * 1e6
+        if micros < 1:
+            return 0
+        mantissa, exponent = math.frexp(micros)
+        index = 1 + (exponent - 1) * cls.SUB_BUCKETS + int((mantissa * 2 - 1) * cls.SUB_BUCKETS)
+        return min(index, cls.NUM_BUCKETS - 1)
+
+    @classmethod
+    def get_bucket_upper_bound(cls, index):
+        """ Get the largest duration (in seconds) recorded in a bucket. """
+        if index == 0:
+            return 1e-6
+        exponent, sub_bucket = divmod(index - 1, cls.SUB_BUCKETS)
+        return (2 ** exponent) * (1 + (sub_bucket + 1) / cls.SUB_BUCKETS) / 1e6
+
+    def record(self, seconds):
+        stripe = get_stripe_index()
+        with self.locks[stripe]:
+            cells = self.stripes[stripe]
+            cells[0] += 1
+            cells[1] += seconds
+            if seconds > cells[2]:
+                cells[2] = seconds
+            cells[3 + self.get_bucket_index(seconds)] += 1
+
+    def merge(self):
+        merged = [0, 0.0, 0.0] + [0] * self.NUM_BUCKETS
+        for stripe in range(NUM_STRIPES):
+            with self.locks[stripe]:
+                cells = list(self.stripes[stripe])
+            merged[0] += cells[0]
+            merged[1] += cells[1]
+            merged[2] = max(merged[2], cells[2])
+            for i in range(3, len(cells)):
+                merged[i] += cells[i]
+        return merged
+
+    def get_count(self):
+        return sum(self.stripes[stripe][0] for stripe in range(NUM_STRIPES))
+
+    def get_summary(self, percentiles=(50, 90, 99, 99.9)):
+        """ Get the count, total, mean, max and requested percentiles of all recorded durations in milliseconds. """
+        merged = self.merge()
+        count, total, maximum, buckets = merged[0], merged[1], merged[2], merged[3:]
+        summary = {"count": count,
+                   "total_ms": total * 1000,
+                   "mean_ms": total * 1000 / count if count > 0 else None,
+                   "max_ms": maximum * 1000}
+        for percentile in percentiles:
+            summary["p" + format(percentile, 'g') + "_ms"] = self.get_percentile(buckets, count, maximum, percentile)
+        return summary
+
+    def get_cumulative_counts(self, upper_bounds):
+        """ Get the number of recorded durations at most each of the provided upper bounds (in seconds), along with
+        the count and total (in seconds) of all of them. A log bucket is only counted under a bound it fits below
+        entirely, so the counts never overstate how fast requests were. """
+        merged = self.merge()
+        cumulative_counts = []
+        index = 0
+        cumulative_count = 0
+        buckets = merged[3:]
+        for bound in upper_bounds:
+            while index < len(buckets) and self.get_bucket_upper_bound(index) <= bound:
+                cumulative_count += buckets[index]
+                index += 1
+            cumulative_counts.append(cumulative_count)
+        return cumulative_counts, merged[0], merged[1]
+
+    def get_percentile(self, buckets, count, maximum, percentile):
+        if count == 0:
+            return None
+        rank = math.ceil(count * percentile / 100)
+        cumulative = 0
+        for index, bucket_count in enumerate(buckets):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return min(self.get_bucket_upper_bound(index), maximum) * 1000
+        return maximum * 1000
+
+
+class LockStats:
+    """ Histograms of the time spent waiting for and holding a ReadWriteLock, by read or write mode. """
+    read_wait: LatencyHistogram
+    write_wait: LatencyHistogram
+    read_hold: LatencyHistogram
+    write_hold: LatencyHistogram
+
+    def __init__(self):
+        self.read_wait = LatencyHistogram()
+        self.write_wait = LatencyHistogram()
+        self.read_hold = LatencyHistogram()
+        self.write_hold = LatencyHistogram()
+
+    def get_histograms(self):
+        """ Get a dict of (kind, mode) to histogram, kind being wait or hold and mode read or write. """
+        return {("wait", "read"): self.read_wait,
+                ("wait", "write"): self.write_wait,
+                ("hold", "read"): self.read_hold,
+                ("hold", "write"): self.write_hold}
+
+    def reset(self):
+        for histogram in self.get_histograms().values():
+            histogram.reset()
+
+    def to_dict(self):
+        return {"read_wait": self.read_wait.get_summary(),
+                "write_wait": self.write_wait.get_summary(),
+                "read_hold": self.read_hold.get_summary(),
+                "write_hold": self.write_hold.get_summary()}
+
+
+def lock_stats_to_metric_families(prefix, lock_stats: LockStats):
+    """ Get the wait and hold time histograms of a LockStats as <prefix>_wait_seconds and <prefix>_hold_seconds
+    metric families, labelled by lock mode. """
+    families = {"wait": MetricFamily(prefix + "_wait_seconds", "histogram", "Time spent waiting to acquire the lock."),
+                "hold": MetricFamily(prefix + "_hold_seconds", "histogram", "Time the lock was held once acquired.")}
+    for ((kind, mode), histogram) in lock_stats.get_histograms().items():
+        families[kind].add_histogram({"mode": mode}, DEFAULT_LATENCY_BUCKETS,
+                                     *histogram.get_cumulative_counts(DEFAULT_LATENCY_BUCKETS))
+    return list(families.values())
+
 
 class RunningCacheStats:
-    """  Class to keep track of incremental cache stats from some start time to the present.  """
+    """  Class to keep track of incremental cache stats from some start time to the present.
+    All counters and histograms are thread safe, they are updated concurrently by every request thread. """
     start_time: int
-    num_req_served: int
-    num_get_req: int
-    num_misses: int
-    num_hits: int
+    num_req_served: StripedCounter
+    num_get_req: StripedCounter
+    num_misses: StripedCounter
+    num_hits: StripedCounter
+    num_evictions: StripedCounter
+    get_latency: LatencyHistogram
+    put_latency: LatencyHistogram
+    eviction_latency: LatencyHistogram
+    segment_locks: LockStats
 
     def __init__(self):
+        self.num_req_served = StripedCounter()
+        self.num_get_req = StripedCounter()
+        self.num_misses = StripedCounter()
+        self.num_hits = StripedCounter()
+        self.num_evictions = StripedCounter()
+        self.get_latency = LatencyHistogram()
+        self.put_latency = LatencyHistogram()
+        self.eviction_latency = LatencyHistogram()
+        self.segment_locks = LockStats()
         self.reset(int(time.time()))
 
     def reset(self, new_start_time):
         self.start_time = new_start_time
-        self.num_req_served = 0
-        self.num_get_req = 0
-        self.num_misses = 0
-        self.num_hits = 0
+        for counter in (self.num_req_served, self.num_get_req, self.num_misses, self.num_hits, self.num_evictions):
+            counter.reset()
+        for histogram in (self.get_latency, self.put_latency, self.eviction_latency):
+            histogram.reset()
+        self.segment_locks.reset()
 
     def add_req_served(self, is_get, is_miss):
-        self.num_req_served += 1
+        self.num_req_served.add()
         if is_get:
-            self.num_get_req += 1
+            self.num_get_req.add()
             if is_miss:
-                self.num_misses += 1
+                self.num_misses.add()
             else:
-                self.num_hits += 1
+                self.num_hits.add()
+
+    def add_eviction(self, seconds):
+        self.num_evictions.add()
+        self.eviction_latency.record(seconds)
 
     def create_time_boxed_stat(self, end_time, num_items_in_cache, cache_size_bytes):
         return TimeBoxedCacheStats(start_time=self.start_time,
                                    end_time=end_time,
                                    num_items_in_cache=num_items_in_cache,
                                    cache_size_bytes=cache_size_bytes,
-                                   num_req_served=self.num_req_served,
-                                   num_get_req=self.num_get_req,
-                                   num_misses=self.num_misses,
-                                   num_hits=self.num_hits)
+                                   num_req_served=self.num_req_served.get(),
+                                   num_get_req=self.num_get_req.get(),
+                                   num_misses=self.num_misses.get(),
+                                   num_hits=self.num_hits.get())
+
+    def to_dict(self):
+        """ Get all counters and latency summaries, ready to be returned as JSON. """
+        num_get_req = self.num_get_req.get()
+        num_misses = self.num_misses.get()
+        return {"start_time": self.start_time,
+                "num_req_served": self.num_req_served.get(),
+                "num_get_req": num_get_req,
+                "num_hits": self.num_hits.get(),
+                "num_misses": num_misses,
+                "miss_rate": num_misses / num_get_req if num_get_req > 0 else None,
+                "num_evictions": self.num_evictions.get(),
+                "get_latency": self.get_latency.get_summary(),
+                "put_latency": self.put_latency.get_summary(),
+                "eviction_latency": self.eviction_latency.get_summary(),
+                "segment_locks": self.segment_locks.to_dict()}
 
     def save_time_boxed_stat(self, node_name, num_items_in_cache, cache_size_bytes):
         end_time = int(time.time())
@@ -0,0 +1,126 @@
+import json
+import logging
+import random
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from app.boto_utils import get_shared_cloudwatch_client, build_cache_stat_metric_data, put_cache_stat_metric_data
+
+logger = logging.getLogger(__name__)
+
+
+class StatsSink(ABC):
+    """ Destination of flushed cache stats. write receives a list of (node_name, TimeBoxedCacheStats) samples and
+    raises if they couldn't be stored, in which case they are retried on the next flush. """
+
+    @abstractmethod
+    def write(self, samples):
+        pass
+
+
+class CloudWatchSink(StatsSink):
+    """ Publishes samples to CloudWatch, all metrics of a flush in a single put_metric_data call when they fit. """
+
+    def __init__(self, cw_client=None):
+        self.cw_client = cw_client
+
+    def write(self, samples):
+        if self.cw_client is None:
+            self.cw_client = get_shared_cloudwatch_client()
+        metric_data = []
+        for (node_name, tb_stat) in samples:
+            metric_data.extend(build_cache_stat_metric_data(node_name, tb_stat))
+        put_cache_stat_metric_data(self.cw_client, metric_data)
+
+
+class FileSink(StatsSink):
+    """ Appends samples to a local file, one JSON object per line. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, samples):
+        with open(self.path, 'a') as stats_file:
+            for (node_name, tb_stat) in samples:
+                stats_file.write(json.dumps(dict(vars(tb_stat), node_name=node_name)) + "\n")
+
+
+class InMemorySink(StatsSink):
+    """ Keeps every sample in a list, as a stand-in for CloudWatch in tests. """
+
+    def __init__(self):
+        self.samples = []
+
+    def write(self, samples):
+        self.samples.extend(samples)
+
+
+class StatsFlusher:
+    """ Collects a cache stats sample about every interval_seconds and flushes buffered samples to a sink, all from
+    one background thread. The interval is jittered so a pool of nodes started together doesn't flush in lockstep.
+    The buffer holds at most max_buffered_samples, the oldest samples are dropped while the sink is failing. """
+    sink: StatsSink
+    interval_seconds: float
+    jitter_fraction: float
+
+    def __init__(self, sink, collect_sample, interval_seconds=5, jitter_fraction=0.2, max_buffered_samples=720):
+        """ collect_sample is called without arguments and returns a (node_name, TimeBoxedCacheStats) sample, or None
+        if there is nothing to report. """
+        self.sink = sink
+        self.collect_sample = collect_sample
+        self.interval_seconds = interval_seconds
+        self.jitter_fraction = jitter_fraction
+        self.buffer = deque(maxlen=max_buffered_samples)
+        self.flush_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the background thread and flush what is left in the buffer. """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self.flush()
+
+    def get_next_delay(self):
+        return self.interval_seconds * random.uniform(1 - self.jitter_fraction, 1 + self.jitter_fraction)
+
+    def run(self):
+        while not self.stop_event.wait(self.get_next_delay()):
+            self.collect()
+            self.flush()
+
+    def collect(self):
+        """ Take a sample now and add it to the buffer. """
+        try:
+            sample = self.collect_sample()
+        except Exception as e:
+            logger.error("Failed to collect cache stats: " + str(e))
+            return
+        if sample is not None:
+            self.buffer.append(sample)
+
+    def flush(self):
+        """ Write all buffered samples to the sink in one call. Returns False if the sink failed, the samples are then
+        put back in the buffer to be retried. """
+        with self.flush_lock:
+            samples = []
+            while self.buffer:
+                samples.append(self.buffer.popleft())
+            if not samples:
+                return True
+            try:
+                self.sink.write(samples)
+                return True
+            except Exception as e:
+                logger.error("Failed to flush " + str(len(samples)) + " cache stats sample(s): " + str(e))
+                # Put them back in front of anything collected meanwhile, the bounded buffer drops the oldest first
+                for sample in reversed(samples):
+                    if len(self.buffer) == self.buffer.maxlen:
+                        break
+                    self.buffer.appendleft(sample)
+                return False
@@ -0,0 +1,83 @@
+import threading
+
+
+class HierarchicalTimerWheel:
+    """ Hierarchical timer wheel tracking when cache keys expire.
+    Level 0 has one bucket per tick, every higher level has buckets covering a whole revolution of the level below
+    it. Timers far in the future sit in a coarse bucket and are cascaded down as their time approaches, so
+    scheduling a timer and advancing by one tick are both O(1) amortized, no matter how many timers are pending.
+    Timers are never cancelled, callers must check a fired key still expires at or before the current time. """
+    BUCKET_BITS = 6
+    NUM_LEVELS = 4
+    tick_seconds: float
+    current_tick: int
+    levels: list
+    due: list
+
+    def __init__(self, tick_seconds, start_time):
+        self.tick_seconds = tick_seconds
+        self.wheel_size = 1 << self.BUCKET_BITS
+        self.mask = self.wheel_size - 1
+        self.max_delta = (1 << (self.BUCKET_BITS * self.NUM_LEVELS)) - 1
+        self.current_tick = self.get_tick(start_time)
+        self.levels = [[[] for i in range(self.wheel_size)] for level in range(self.NUM_LEVELS)]
+        self.due = []
+        self.lock = threading.Lock()
+
+    def get_tick(self, timestamp):
+        return int(timestamp // self.tick_seconds)
+
+    def schedule(self, key, expires_at):
+        """ Schedule key to be returned by advance once expires_at (a unix timestamp) has passed. """
+        # Round up so a timer never fires before its expiry time
+        expire_tick = -int(-expires_at // self.tick_seconds)
+        with self.lock:
+            self.add_timer(key, expire_tick)
+
+    def add_timer(self, key, expire_tick):
+        delta = expire_tick - self.current_tick
+        if delta <= 0:
+            self.due.append(key)
+            return
+        # Timers beyond the range of the top level wait in its furthest bucket and get re-added when cascaded
+        bucket_tick = expire_tick if delta <= self.max_delta else self.current_tick + self.max_delta
+        level = 0
+        while delta >= 1 << (self.BUCKET_BITS * (level + 1)) and level < self.NUM_LEVELS - 1:
+            level += 1
+        bucket_idx = (bucket_tick >> (self.BUCKET_BITS * level)) & self.mask
+        self.levels[level][bucket_idx].append((key, expire_tick))
+
+    def advance(self, now):
+        """ Advance the wheel up to the provided unix timestamp and return the keys whose timers fired. """
+        with self.lock:
+            fired = self.due
+            self.due = []
+            target_tick = self.get_tick(now)
+            while self.current_tick < target_tick:
+                self.current_tick += 1
+                self.cascade()
+                bucket = self.levels[0][self.current_tick & self.mask]
+                fired.extend(key for (key, expire_tick) in bucket)
+                bucket.clear()
+            # Timers cascaded down on the tick they expire at land in due
+            fired.extend(self.due)
+            self.due = []
+        return fired
+
+    def cascade(self):
+        """ Move the timers of higher level buckets whose time range starts at the current tick down a level. """
+        level = 1
+        while level < self.NUM_LEVELS and (self.current_tick & ((1 << (self.BUCKET_BITS * level)) - 1)) == 0:
+            bucket_idx = (self.current_tick >> (self.BUCKET_BITS * level)) & self.mask
+            timers = self.levels[level][bucket_idx]
+            self.levels[level][bucket_idx] = []
+            for (key, expire_tick) in timers:
+                self.add_timer(key, expire_tick)
+            level += 1
+
+    def clear(self):
+        with self.lock:
+            for level in self.levels:
+                for bucket in level:
+                    bucket.clear()
+            self.due = []
@@ -0,0 +1,204 @@
+# Metrics exposed by every Flask app on /metrics in the Prometheus text format, so they can be scraped locally
+# instead of round tripping through CloudWatch
+import threading
+import time
+from flask import Response, g, request
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Upper bounds (in seconds) of the buckets of latency histograms
+DEFAULT_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                           5, 10)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricFamily:
+    """ All samples of one metric, rendered as a block of the text format. """
+    name: str
+    metric_type: str
+    help_text: str
+    samples: list
+
+    def __init__(self, name, metric_type, help_text):
+        self.name = name
+        self.metric_type = metric_type
+        self.help_text = help_text
+        self.samples = []  # (name suffix, labels dict, value)
+
+    def add_sample(self, labels, value, suffix=""):
+        self.samples.append((suffix, labels, value))
+        return self
+
+    def add_histogram(self, labels, bucket_bounds, cumulative_counts, count, total):
+        """ Add the samples of one histogram from the cumulative count of each bucket upper bound. """
+        for (bound, cumulative_count) in zip(bucket_bounds, cumulative_counts):
+            self.add_sample(dict(labels, le=format_value(float(bound))), cumulative_count, "_bucket")
+        self.add_sample(dict(labels, le="+Inf"), count, "_bucket")
+        self.add_sample(labels, count, "_count")
+        self.add_sample(labels, total, "_sum")
+        return self
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.help_text, "# TYPE " + self.name + " " + self.metric_type]
+        for (suffix, labels, value) in self.samples:
+            label_text = ",".join(name + "=\"" + escape_label_value(label_value) + "\""
+                                  for (name, label_value) in labels.items())
+            lines.append(self.name + suffix + ("{" + label_text + "}" if label_text else "") + " "
+                         + format_value(value))
+        return "\n".join(lines)
+
+
+class Counter:
+    """ Thread safe counter per combination of label values. """
+    name: str
+    help_text: str
+    label_names: tuple
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}  # tuple of label values -> count
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def collect(self):
+        family = MetricFamily(self.name, "counter", self.help_text)
+        with self.lock:
+            values = list(self.values.items())
+        for (label_values, value) in values:
+            family.add_sample(dict(zip(self.label_names, label_values)), value)
+        return [family]
+
+
+class Histogram:
+    """ Thread safe histogram with fixed buckets per combination of label values. """
+    name: str
+    help_text: str
+    label_names: tuple
+    buckets: tuple
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}  # tuple of label values -> [count per bucket..., count, sum]
+
+    def observe(self, value, *label_values):
+        bucket_index = len(self.buckets)
+        for (i, bound) in enumerate(self.buckets):
+            if value <= bound:
+                bucket_index = i
+                break
+        with self.lock:
+            cells = self.values.get(label_values)
+            if cells is None:
+                cells = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0]
+            if bucket_index < len(self.buckets):
+                cells[bucket_index] += 1
+            cells[-2] += 1
+            cells[-1] += value
+
+    def collect(self):
+        family = MetricFamily(self.name, "histogram", self.help_text)
+        with self.lock:
+            values = [(label_values, list(cells)) for (label_values, cells) in self.values.items()]
+        for (label_values, cells) in values:
+            cumulative_counts = []
+            cumulative_count = 0
+            for bucket_count in cells[:len(self.buckets)]:
+                cumulative_count += bucket_count
+                cumulative_counts.append(cumulative_count)
+            family.add_histogram(dict(zip(self.label_names, label_values)), self.buckets, cumulative_counts,
+                                 cells[-2], cells[-1])
+        return [family]
+
+
+class MetricsRegistry:
+    """ Metrics of one process. Besides counters and histograms updated as things happen, collector functions can be
+    registered to report values that are read when scraped, like the size of a cache. A collector takes no arguments
+    and returns a list of MetricFamily. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.collectors = []
+
+    def register(self, collector):
+        with self.lock:
+            self.collectors.append(collector)
+        return collector
+
+    def counter(self, name, help_text, label_names=()):
+        counter = Counter(name, help_text, label_names)
+        self.register(counter.collect)
+        return counter
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        histogram = Histogram(name, help_text, label_names, buckets)
+        self.register(histogram.collect)
+        return histogram
+
+    def render(self):
+        with self.lock:
+            collectors = list(self.collectors)
+        families = []
+        for collector in collectors:
+            families.extend(collector())
+        return "\n".join(family.render() for family in families) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUESTS = REGISTRY.counter("http_requests_total", "HTTP requests served.",
+                                 ("method", "endpoint", "status"))
+HTTP_REQUEST_DURATION = REGISTRY.histogram("http_request_duration_seconds",
+                                           "Time to produce the response of an HTTP request.", ("method", "endpoint"))
+OUTBOUND_REQUESTS = REGISTRY.counter("outbound_requests_total",
+                                     "HTTP requests sent to other services, by response status or error.",
+                                     ("target", "path", "status"))
+OUTBOUND_REQUEST_DURATION = REGISTRY.histogram("outbound_request_duration_seconds",
+                                               "Time until the response headers of an HTTP request sent to another "
+                                               "service were received.", ("target", "path"))
+
+
+def record_outbound_request(target, path, status, seconds):
+    OUTBOUND_REQUESTS.inc(target, path, str(status))
+    OUTBOUND_REQUEST_DURATION.observe(seconds, target, path)
+
+
+def instrument_app(flask_app, registry=REGISTRY):
+    """ Count and time every request served by a Flask app, and serve the registry on its /metrics endpoint. """
+
+    @flask_app.before_request
+    def start_request_timer():
+        g.request_start_time = time.perf_counter()
+
+    @flask_app.after_request
+    def record_request(response):
+        start_time = g.pop('request_start_time', None)
+        # Label by route rule rather than path, so keys in paths can't blow up the number of series
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        HTTP_REQUESTS.inc(request.method, endpoint, str(response.status_code))
+        if start_time is not None:
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - start_time, request.method, endpoint)
+        return response
+
+    def metrics():
+        return Response(registry.render(), content_type=CONTENT_TYPE)
+
+    flask_app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
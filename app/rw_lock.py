@@ -1,43 +1,104 @@
 import threading
+import time
+
+
+class LockTimeoutError(Exception):
+    """ Raised when a ReadWriteLock couldn't be acquired within the requested timeout. """
+    pass
+
+
+class LockGuard:
+    """ Context manager holding a ReadWriteLock for the duration of a with block. """
+
+    def __init__(self, acquire, release, timeout):
+        self.acquire = acquire
+        self.release = release
+        self.timeout = timeout
+
+    def __enter__(self):
+        self.acquire(self.timeout)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
 
 
 class ReadWriteLock:
-    """ A lock object that allows for simultaneous reads but only 1 write """
+    """ A lock object that allows for simultaneous reads but only 1 write.
+    Writers are preferred: once a writer is waiting, new readers wait behind it, so a steady stream of readers can't
+    starve writers. Neither side is reentrant, a thread holding the lock must not acquire it again.
+    If a stats object is provided, the time spent waiting for and holding the lock is recorded in its read_wait,
+    write_wait, read_hold and write_hold histograms, which can be shared by several locks. """
 
-    def __init__(self):
-        self.read_cond = threading.Condition(threading.Lock())
+    def __init__(self, stats=None):
+        self.cond = threading.Condition(threading.Lock())
         self.readers = 0
+        self.is_writing = False
+        self.waiting_writers = 0
+        self.stats = stats
+        self.local = threading.local()
+        self.write_acquired_at = None
+
+    def wait_for(self, predicate, timeout):
+        """ Wait on the condition until predicate is true, raising LockTimeoutError after timeout seconds. """
+        if not self.cond.wait_for(predicate, timeout):
+            raise LockTimeoutError("Couldn't acquire lock within " + str(timeout) + " seconds")
 
-    def acquire_write(self):
-        """ Acquire write lock. Blocks until there are no acquired read or write locks. """
-        self.read_cond.acquire()
-        while self.readers > 0:
-            # Wait for current reads to finish before writing
-            self.read_cond.wait()
+    def acquire_write(self, timeout=None):
+        """ Acquire write lock. Blocks until there are no acquired read or write locks.
+        Raises LockTimeoutError if it couldn't be acquired within timeout seconds. """
+        start_time = time.perf_counter()
+        with self.cond:
+            if self.is_writing or self.readers > 0:
+                self.waiting_writers += 1
+                try:
+                    self.wait_for(lambda: not self.is_writing and self.readers == 0, timeout)
+                except LockTimeoutError:
+                    # Readers held back by this writer can go now
+                    self.waiting_writers -= 1
+                    self.cond.notify_all()
+                    raise
+                self.waiting_writers -= 1
+            self.is_writing = True
+        if self.stats is not None:
+            self.write_acquired_at = time.perf_counter()
+            self.stats.write_wait.record(self.write_acquired_at - start_time)
 
     def release_write(self):
         """ Release write lock. """
-        self.read_cond.release()
-
-    def acquire_read(self):
-        """ Acquire a read lock. Blocks only if another thread has acquired write lock. """
-        # Acquire the read cond lock, so we can add to the number of readers
-        # If a write operation is occurring this lock will be acquired until the write is done
-        self.read_cond.acquire()
-        try:
+        if self.stats is not None:
+            self.stats.write_hold.record(time.perf_counter() - self.write_acquired_at)
+        with self.cond:
+            self.is_writing = False
+            self.cond.notify_all()
+
+    def acquire_read(self, timeout=None):
+        """ Acquire a read lock. Blocks while another thread holds or waits for the write lock.
+        Raises LockTimeoutError if it couldn't be acquired within timeout seconds. """
+        start_time = time.perf_counter()
+        with self.cond:
+            if self.is_writing or self.waiting_writers > 0:
+                self.wait_for(lambda: not self.is_writing and self.waiting_writers == 0, timeout)
             self.readers += 1
-        finally:
-            # Release read lock so other reads can occur
-            self.read_cond.release()
+        if self.stats is not None:
+            self.local.read_acquired_at = time.perf_counter()
+            self.stats.read_wait.record(self.local.read_acquired_at - start_time)
 
     def release_read(self):
         """ Release a read lock. """
-        # Acquire the read cond lock, so we can subtract the number of readers
-        self.read_cond.acquire()
-        try:
+        if self.stats is not None:
+            self.stats.read_hold.record(time.perf_counter() - self.local.read_acquired_at)
+        with self.cond:
             self.readers -= 1
             if not self.readers:
                 # Notify all threads there are no readers (can write)
-                self.read_cond.notifyAll()
-        finally:
-            self.read_cond.release()
+                self.cond.notify_all()
+
+    def read_locked(self, timeout=None):
+        """ Get a context manager holding a read lock, e.g. with lock.read_locked(): """
+        return LockGuard(self.acquire_read, self.release_read, timeout)
+
+    def write_locked(self, timeout=None):
+        """ Get a context manager holding the write lock, e.g. with lock.write_locked(): """
+        return LockGuard(self.acquire_write, self.release_write, timeout)
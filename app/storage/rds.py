@@ -27,9 +27,12 @@ class RDS:
             "CREATE TABLE IF NOT EXISTS`MemcacheConfig` ("
             "  `mem_id` int(11) NOT NULL AUTO_INCREMENT,"
             "  `timestamp` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,"
-            "  `policy` enum('RANDOM','LRU') NOT NULL,"
+            "  `policy` enum('RANDOM','LRU','LFU','ARC','W_TINY_LFU','GDSF') NOT NULL,"
             "  `capacity_mb` int(11) NOT NULL,"
             "  `max_num_items` int(11) NULL,"
+            "  `default_ttl_seconds` int(11) NULL,"
+            "  `compression_level` int(11) NULL,"
+            "  `compression_threshold_bytes` int(11) NULL,"
             "  PRIMARY KEY (`mem_id`)"
             ")"),
         'Hash': (
@@ -39,6 +42,16 @@ class RDS:
             "  PRIMARY KEY (`hash_key`)"
             ")")}
 
+    # Statements bringing tables created by older versions up to date, CREATE TABLE IF NOT EXISTS won't alter them
+    MIGRATIONS = [
+        "ALTER TABLE `MemcacheConfig` MODIFY `policy` enum('RANDOM','LRU','LFU','ARC','W_TINY_LFU','GDSF') NOT NULL",
+        "ALTER TABLE `MemcacheConfig` ADD COLUMN `default_ttl_seconds` int(11) NULL",
+        "ALTER TABLE `MemcacheConfig` ADD COLUMN `compression_level` int(11) NULL",
+        "ALTER TABLE `MemcacheConfig` ADD COLUMN `compression_threshold_bytes` int(11) NULL",
+    ]
+    # MySQL error raised by migrations that were already applied
+    ER_DUP_FIELDNAME = 1060
+
     def __init__(self):
         self.cnx = pymysql.connect(host=self.RDS_HOST, port=self.RDS_PORT, user=self.DB_USER, passwd=self.DB_PASSWORD)
         self.cnx.cursor().execute(f"CREATE DATABASE IF NOT EXISTS {self.DB_NAME}")
@@ -53,6 +66,12 @@ class RDS:
             table_description = self.TABLES[table_name]
             print("Creating table {}: ".format(table_name), end='')
             self.cnx.cursor().execute(table_description)
+        for migration in self.MIGRATIONS:
+            try:
+                self.cnx.cursor().execute(migration)
+            except pymysql.err.OperationalError as e:
+                if e.args[0] != self.ER_DUP_FIELDNAME:
+                    raise
 
     def query(self, query, data):
         cursor = self.cnx.cursor()
@@ -131,32 +150,40 @@ class RDS:
         self.query(del_query, ())
 
     def get_most_recent_cache_config(self):
-        get_config_query = "SELECT policy, capacity_mb, max_num_items FROM MemcacheConfig ORDER BY timestamp DESC LIMIT 1;"
+        get_config_query = ("SELECT policy, capacity_mb, max_num_items, default_ttl_seconds, compression_level, "
+                            "compression_threshold_bytes FROM MemcacheConfig ORDER BY timestamp DESC LIMIT 1;")
         result = self.fetch(get_config_query, ())
         if result is None or len(result) == 0:
             return None
 
         config_entry = result[0]
-        if config_entry[0] == 'RANDOM':
-            replacement_policy = ReplacementPolicy.RANDOM
+        if config_entry[0] in ReplacementPolicy.__members__:
+            replacement_policy = ReplacementPolicy[config_entry[0]]
         else:
             replacement_policy = ReplacementPolicy.LRU
         max_size_mb = config_entry[1]
         max_num_items = config_entry[2]
-        return CacheConfig(replacement_policy, max_size_mb, max_num_items)
+        default_ttl_seconds = config_entry[3]
+        compression_level = config_entry[4]
+        compression_threshold_bytes = config_entry[5]
+        return CacheConfig(replacement_policy, max_size_mb, max_num_items, default_ttl_seconds, compression_level,
+                           compression_threshold_bytes)
 
     def add_cache_config(self, cache_config: CacheConfig):
-        if cache_config.replacement_policy == ReplacementPolicy.LRU:
-            replacement_policy = 'LRU'
-        else:
-            replacement_policy = 'RANDOM'
+        # Policies are stored by enum member name, e.g. 'LRU' or 'W_TINY_LFU'
+        replacement_policy = cache_config.replacement_policy.name
 
-        add_config_query = ("INSERT INTO MemcacheConfig (policy, capacity_mb, max_num_items) "
-                            "VALUES(%(replacement_policy)s, %(capacity_mb)s, %(max_num_items)s);")
+        add_config_query = ("INSERT INTO MemcacheConfig (policy, capacity_mb, max_num_items, default_ttl_seconds, "
+                            "compression_level, compression_threshold_bytes) "
+                            "VALUES(%(replacement_policy)s, %(capacity_mb)s, %(max_num_items)s, "
+                            "%(default_ttl_seconds)s, %(compression_level)s, %(compression_threshold_bytes)s);")
         add_config_data = {
             'replacement_policy': replacement_policy,
             'capacity_mb': cache_config.max_size_mb,
-            'max_num_items': cache_config.max_num_items
+            'max_num_items': cache_config.max_num_items,
+            'default_ttl_seconds': cache_config.default_ttl_seconds,
+            'compression_level': cache_config.compression_level,
+            'compression_threshold_bytes': cache_config.compression_threshold_bytes
         }
         self.insert(add_config_query, add_config_data)
 
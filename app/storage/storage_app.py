@@ -6,10 +6,12 @@ import io
 import base64
 
 from app.common import ReplacementPolicy, CacheConfig
+from app.metrics import instrument_app
 import logging
 
 # Configure Flask APP
 storageapp = Flask(__name__)
+instrument_app(storageapp)
 rds = RDS()
 s3 = S3()
 rds.create_tables()
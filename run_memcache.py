@@ -1,4 +1,21 @@
 #!../venv/bin/python
-from app.memcache.memcache_app import memcacheapp
-memcacheapp.run('0.0.0.0', 5004, debug=True)
+import os
+from app.apis import MEMCACHE_BINARY_PORT
+from app.memcache.memcache_app import memcacheapp, memcache, is_loop_path
+from app.memcache.binary_server import start_binary_server
+from app.memcache.async_server import run_async_server
 
+# Serve the binary protocol next to the HTTP API, from the same Memcache instance
+ENABLE_BINARY_PROTOCOL = True
+# Serve the HTTP API from an asyncio event loop instead of the thread per connection development server
+USE_ASYNC_SERVER = False
+
+if USE_ASYNC_SERVER:
+    if ENABLE_BINARY_PROTOCOL:
+        start_binary_server(memcache, '0.0.0.0', int(MEMCACHE_BINARY_PORT))
+    run_async_server(memcacheapp.wsgi_app, '0.0.0.0', 5004, is_loop_path)
+else:
+    # In debug mode the reloader runs the app in a child process, only that one should bind the binary port
+    if ENABLE_BINARY_PROTOCOL and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_binary_server(memcache, '0.0.0.0', int(MEMCACHE_BINARY_PORT))
+    memcacheapp.run('0.0.0.0', 5004, debug=True)
@@ -0,0 +1,78 @@
+import pytest
+
+from app.memcache.binary_protocol import BinaryProtocolClient, ProtocolError, REQUEST_MAGIC, RESPONSE_MAGIC, \
+    OP_GET, STATUS_NOT_FOUND, encode_frame, decode_frame, encode_batch_items, decode_batch_items, encode_value, \
+    decode_value
+from app.memcache.binary_server import start_binary_server
+from app.memcache.memcache import Memcache
+from app.memcache.stats_flusher import InMemorySink
+
+
+def test_frames_round_trip():
+    frame = encode_frame(REQUEST_MAGIC, OP_GET, b"key", b"value", b"extras", flags=3, status=STATUS_NOT_FOUND,
+                         opaque=42)
+    decoded, frame_end = decode_frame(frame + b"next", 0, REQUEST_MAGIC)
+    assert decoded == (OP_GET, 3, STATUS_NOT_FOUND, 42, b"extras", b"key", b"value")
+    assert frame_end == len(frame)
+
+
+def test_incomplete_frames_wait_for_more_data():
+    frame = encode_frame(REQUEST_MAGIC, OP_GET, b"key")
+    assert decode_frame(frame[:5], 0, REQUEST_MAGIC) is None
+    assert decode_frame(frame[:-1], 0, REQUEST_MAGIC) is None
+
+
+def test_rejects_frames_with_the_wrong_magic():
+    with pytest.raises(ProtocolError):
+        decode_frame(encode_frame(RESPONSE_MAGIC, OP_GET, b"key"), 0, REQUEST_MAGIC)
+
+
+def test_batch_items_round_trip():
+    items = [("a", b"1", 0), ("héllo", b"", 1), ("c", b"\x00" * 1000, 2)]
+    assert decode_batch_items(encode_batch_items(items)) == items
+
+
+def test_rejects_truncated_batch_items():
+    body = encode_batch_items([("a", b"123", 0)])
+    with pytest.raises(ProtocolError):
+        decode_batch_items(body[:-1])
+    with pytest.raises(ProtocolError):
+        decode_batch_items(body[:3])
+
+
+def test_values_keep_their_type():
+    assert decode_value(*encode_value("héllo")) == "héllo"
+    assert decode_value(*encode_value(b"\x00\x01")) == b"\x00\x01"
+    assert decode_value(*encode_value(memoryview(b"\x02"))) == b"\x02"
+
+
+@pytest.fixture
+def client():
+    server = start_binary_server(Memcache(stats_sink=InMemorySink()), "127.0.0.1", 0)
+    client = BinaryProtocolClient("127.0.0.1", server.server_address[1])
+    yield client
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_client_talks_to_a_node(client):
+    assert client.get("a") is None
+    assert client.put("a", "text")
+    assert client.put("b", b"\x00binary")
+    assert client.get("a") == "text"
+    assert client.get("b") == b"\x00binary"
+    assert client.delete("a")
+    assert client.get("a") is None
+
+
+def test_pipelined_requests_get_their_own_responses(client):
+    results = client.pipeline().put("a", "1").put("b", "2").get("a").get("missing").get("b").execute()
+    assert results == [True, True, "1", None, "2"]
+
+
+def test_batch_requests(client):
+    assert client.put_many({"a": "1", "b": b"2"}) == {"a": True, "b": True}
+    assert client.get_many(["a", "b", "missing"]) == {"a": "1", "b": b"2", "missing": None}
+    assert client.delete_many(["a", "b"])
+    assert client.get_many(["a", "b"]) == {"a": None, "b": None}
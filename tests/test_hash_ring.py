@@ -0,0 +1,54 @@
+from app.hash_ring import HashRing, hash_to_token, is_token_in_range
+
+KEYS = ["key" + str(i) for i in range(20000)]
+
+
+def build_ring(node_ids, weight=10):
+    return HashRing([(node_id, node_id, weight) for node_id in node_ids])
+
+
+def test_empty_ring_has_no_owner():
+    assert HashRing([]).get_node("a") is None
+
+
+def test_rings_built_in_any_order_agree():
+    ring = build_ring(["n1", "n2", "n3"])
+    other_ring = build_ring(["n3", "n1", "n2"])
+    assert all(ring.get_node(key) == other_ring.get_node(key) for key in KEYS)
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    ring = build_ring(["n1", "n2", "n3", "n4"])
+    grown_ring = build_ring(["n1", "n2", "n3", "n4", "n5"])
+    moved = [key for key in KEYS if ring.get_node(key) != grown_ring.get_node(key)]
+    assert all(grown_ring.get_node(key) == "n5" for key in moved)
+    # About 1/5 of the keys move to the new node
+    assert 0.1 < len(moved) / len(KEYS) < 0.3
+
+
+def test_keys_spread_in_proportion_to_weight():
+    ring = HashRing([("light", "light", 10), ("heavy", "heavy", 30)])
+    num_heavy = sum(ring.get_node(key) == "heavy" for key in KEYS)
+    assert 0.65 < num_heavy / len(KEYS) < 0.85
+
+
+def test_routing_table_rebuilds_the_same_ring():
+    ring = HashRing([("n1", object(), 10), ("n2", object(), 20)])
+    rebuilt_ring = HashRing.from_routing_table(ring.get_routing_table())
+    node_ids = {id(node): node_id for (node_id, node) in zip(["n1", "n2"], ring.nodes)}
+    assert all(node_ids[id(ring.get_node(key))] == rebuilt_ring.get_node(key) for key in KEYS)
+
+
+def test_hash_to_token_is_stable():
+    assert hash_to_token("a") == hash_to_token("a")
+    assert hash_to_token("a") != hash_to_token("b")
+    assert 0 <= hash_to_token("a") < 2 ** 64
+
+
+def test_token_ranges_wrap_around():
+    assert is_token_in_range(5, 1, 10)
+    assert is_token_in_range(10, 1, 10)
+    assert not is_token_in_range(1, 1, 10)
+    assert is_token_in_range(15, 10, 1)
+    assert is_token_in_range(0, 10, 1)
+    assert not is_token_in_range(5, 10, 1)
@@ -0,0 +1,153 @@
+import pytest
+
+from app.memcache.entry_table import EntryTable
+from app.memcache.policies import LRUPolicy, RandomPolicy, LFUPolicy, GDSFPolicy, ARCPolicy, WTinyLFUPolicy
+
+ALL_POLICIES = (LRUPolicy, RandomPolicy, LFUPolicy, GDSFPolicy, ARCPolicy, WTinyLFUPolicy)
+
+
+def evict_all(table):
+    keys = []
+    while True:
+        entry = table.evict()
+        if entry is None:
+            return keys
+        keys.append(entry.key)
+
+
+def test_lru_evicts_least_recently_used():
+    table = EntryTable(LRUPolicy())
+    for key in ("a", "b", "c"):
+        table.add(key, "v")
+    table.promote("a", 0)
+    assert evict_all(table) == ["b", "c", "a"]
+
+
+def test_lfu_evicts_least_frequently_used():
+    table = EntryTable(LFUPolicy())
+    for key in ("a", "b", "c"):
+        table.add(key, "v")
+    for i in range(3):
+        table.promote("a", 0)
+    table.promote("c", 0)
+    assert evict_all(table) == ["b", "c", "a"]
+
+
+def test_lfu_ages_out_formerly_popular_entries():
+    table = EntryTable(LFUPolicy())
+    table.add("old", "v")
+    for i in range(3):
+        table.promote("old", 0)
+    # Every eviction raises the age new entries start from, until they outrank the old hits
+    for i in range(6):
+        table.add("new" + str(i), "v")
+        table.promote("new" + str(i), 0)
+        table.evict(exclude_keys=("new" + str(i),))
+    assert "old" not in table
+
+
+def test_gdsf_evicts_large_entries_first_before_costs_are_measured():
+    table = EntryTable(GDSFPolicy())
+    for i in range(20):
+        table.add("small" + str(i), "x" * 1000)
+    table.add("big", b"x" * 3000000)
+    assert table.evict().key == "big"
+
+
+def test_gdsf_prefers_expensive_small_entries():
+    table = EntryTable(GDSFPolicy())
+    table.add("cheap", "x" * 1000, refill_cost_ms=1)
+    table.add("expensive", "x" * 1000, refill_cost_ms=500)
+    assert evict_all(table) == ["cheap", "expensive"]
+
+
+def test_gdsf_ranks_unmeasured_entries_on_the_measured_scale():
+    table = EntryTable(GDSFPolicy())
+    for i in range(5):
+        table.add("unmeasured" + str(i), "x" * 1000)
+    for i in range(20):
+        table.add("measured" + str(i), "x" * 1000, refill_cost_ms=50)
+    # Once measured costs arrive, entries without one are charged their average instead of being pinned
+    assert table.policy.default_cost_ms == 50
+    order = table.policy.keys_in_eviction_order()
+    assert max(order.index("unmeasured" + str(i)) for i in range(5)) < len(order) - 1
+    for i in range(20):
+        table.add("measured_big" + str(i), b"x" * 100000, refill_cost_ms=50)
+    assert table.evict().key.startswith("measured_big")
+
+
+def test_arc_keeps_frequently_used_entries_through_a_scan():
+    table = EntryTable(ARCPolicy())
+    for key in ("a", "b", "c", "d"):
+        table.add(key, "v")
+    table.promote("a", 0)
+    table.promote("b", 0)
+    for i in range(20):
+        table.add("scan" + str(i), "v")
+        table.evict(exclude_keys=("scan" + str(i),))
+    assert "a" in table and "b" in table
+
+
+def test_arc_adapts_to_hits_on_recently_evicted_keys():
+    policy = ARCPolicy()
+    table = EntryTable(policy)
+    for key in ("a", "b", "c", "d"):
+        table.add(key, "v")
+    table.promote("a", 0)
+    table.promote("b", 0)
+    evicted = table.evict().key
+    assert evicted == "c"
+    assert evicted in policy.b1
+    table.add(evicted, "v")
+    assert policy.target_t1 > 0
+    assert evicted in policy.t2
+
+
+def test_w_tiny_lfu_admits_only_more_popular_window_entries():
+    table = EntryTable(WTinyLFUPolicy())
+    for i in range(200):
+        table.add("popular" + str(i), "v")
+        for j in range(3):
+            table.promote("popular" + str(i), 0)
+    # One-off keys lose the admission contest against the popular ones and are evicted from the window
+    for i in range(50):
+        table.add("oneoff" + str(i), "v")
+        table.evict(exclude_keys=("oneoff" + str(i),))
+    assert sum(("popular" + str(i)) in table for i in range(200)) >= 195
+
+
+def test_random_never_picks_excluded_keys():
+    table = EntryTable(RandomPolicy())
+    for i in range(10):
+        table.add(str(i), "v")
+    excluded = {str(i) for i in range(9)}
+    for i in range(50):
+        assert table.policy.pick_victim(excluded) == "9"
+
+
+@pytest.mark.parametrize("policy_class", ALL_POLICIES)
+def test_evicts_every_entry_but_the_excluded_ones(policy_class):
+    table = EntryTable(policy_class())
+    for i in range(50):
+        table.add(str(i), "v")
+    excluded = {str(i) for i in range(0, 50, 5)}
+    evicted = []
+    while True:
+        entry = table.evict(exclude_keys=excluded)
+        if entry is None:
+            break
+        evicted.append(entry.key)
+    assert sorted(evicted) == sorted(str(i) for i in range(50) if str(i) not in excluded)
+    assert set(table.keys()) == excluded
+
+
+@pytest.mark.parametrize("policy_class", ALL_POLICIES)
+def test_keys_in_eviction_order_lists_tracked_keys(policy_class):
+    table = EntryTable(policy_class())
+    for i in range(20):
+        table.add(str(i), "v")
+    table.remove("3")
+    assert sorted(table.policy.keys_in_eviction_order()) == sorted(str(i) for i in range(20) if i != 3)
+    table.clear()
+    assert table.policy.keys_in_eviction_order() == []
+    assert table.evict() is None
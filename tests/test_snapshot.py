@@ -0,0 +1,52 @@
+import pytest
+
+from app.memcache.compression import CompressedValue
+from app.memcache.entry_table import CacheEntry
+from app.memcache.snapshot import HEADER, SnapshotReader, encode_entries, write_snapshot
+
+
+def build_entries():
+    return [CacheEntry("text", "héllo", 0, refill_cost_ms=12.5, expires_at=2000000000.0),
+            CacheEntry("binary", b"\x00\x01\x02", 0),
+            CacheEntry("compressed", CompressedValue(b"zlib data", True), 0, expires_at=1.5)]
+
+
+def assert_round_trips(reader):
+    records = {record.key: record for record in reader.records}
+    assert [record.key for record in reader.records] == ["text", "binary", "compressed"]
+    assert reader.get_value(records["text"]) == "héllo"
+    assert records["text"].refill_cost_ms == 12.5
+    assert records["text"].expires_at == 2000000000.0
+    assert bytes(reader.get_value(records["binary"])) == b"\x00\x01\x02"
+    assert records["binary"].refill_cost_ms is None
+    assert records["binary"].expires_at is None
+    compressed = reader.get_value(records["compressed"])
+    assert isinstance(compressed, CompressedValue)
+    assert bytes(compressed.data) == b"zlib data"
+    assert compressed.is_text
+
+
+def test_encoded_entries_round_trip():
+    assert_round_trips(SnapshotReader("import", encode_entries(build_entries())))
+
+
+def test_snapshot_file_round_trips(tmp_path):
+    path = str(tmp_path / "memcache.snapshot")
+    assert write_snapshot(path, build_entries()) == 3
+    assert not (tmp_path / "memcache.snapshot.tmp").exists()
+    assert_round_trips(SnapshotReader(path))
+
+
+def test_empty_snapshot_has_no_records():
+    assert SnapshotReader("import", encode_entries([])).records == []
+
+
+def test_rejects_data_that_is_not_a_snapshot():
+    with pytest.raises(ValueError):
+        SnapshotReader("import", b"x" * HEADER.size)
+
+
+def test_rejects_a_truncated_snapshot():
+    data = encode_entries(build_entries())
+    with pytest.raises(ValueError):
+        SnapshotReader("import", data[:-4])
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+from app.common import TimeBoxedCacheStats
+from app.memcache.stats_flusher import StatsSink, InMemorySink, FileSink, StatsFlusher
+
+
+def build_sample(name, start_time=0):
+    return name, TimeBoxedCacheStats(start_time, start_time + 5, 1, 100, 10, 8, 2, 6)
+
+
+class FailingSink(StatsSink):
+    """ Fails a given number of writes, then stores samples in memory. """
+
+    def __init__(self, num_failures):
+        self.num_failures = num_failures
+        self.samples = []
+
+    def write(self, samples):
+        if self.num_failures > 0:
+            self.num_failures -= 1
+            raise IOError("Sink unavailable")
+        self.samples.extend(samples)
+
+
+def test_sinks_must_implement_write():
+    with pytest.raises(TypeError):
+        StatsSink()
+
+
+def test_flushes_collected_samples_in_one_write():
+    sink = InMemorySink()
+    samples = iter([build_sample("a"), None, build_sample("b")])
+    flusher = StatsFlusher(sink, lambda: next(samples))
+    for i in range(3):
+        flusher.collect()
+    assert flusher.flush()
+    assert [name for (name, tb_stat) in sink.samples] == ["a", "b"]
+    assert flusher.flush()
+    assert len(sink.samples) == 2
+
+
+def test_keeps_samples_while_the_sink_fails():
+    sink = FailingSink(2)
+    flusher = StatsFlusher(sink, lambda: build_sample("a"))
+    flusher.collect()
+    assert not flusher.flush()
+    flusher.collect()
+    assert not flusher.flush()
+    assert flusher.flush()
+    assert len(sink.samples) == 2
+
+
+def test_drops_the_oldest_samples_once_the_buffer_is_full():
+    start_times = iter(range(10))
+    sink = FailingSink(1)
+    flusher = StatsFlusher(sink, lambda: build_sample("a", next(start_times)), max_buffered_samples=3)
+    for i in range(5):
+        flusher.collect()
+    assert not flusher.flush()
+    flusher.collect()
+    assert flusher.flush()
+    assert [tb_stat.start_time for (name, tb_stat) in sink.samples] == [3, 4, 5]
+
+
+def test_ignores_failed_collections():
+    def collect_sample():
+        raise ValueError("No stats")
+
+    sink = InMemorySink()
+    flusher = StatsFlusher(sink, collect_sample)
+    flusher.collect()
+    assert flusher.flush()
+    assert sink.samples == []
+
+
+def test_stop_flushes_what_is_left():
+    sink = InMemorySink()
+    flusher = StatsFlusher(sink, lambda: build_sample("a"), interval_seconds=3600)
+    flusher.start()
+    flusher.collect()
+    assert flusher.stop()
+    assert len(sink.samples) == 1
+
+
+def test_file_sink_writes_one_json_line_per_sample(tmp_path):
+    path = tmp_path / "stats.jsonl"
+    FileSink(str(path)).write([build_sample("a"), build_sample("b")])
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [line["node_name"] for line in lines] == ["a", "b"]
+    assert lines[0]["num_misses"] == 2
+    assert lines[0]["miss_rate"] == 0.25
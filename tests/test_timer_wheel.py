@@ -0,0 +1,60 @@
+from app.memcache.timer_wheel import HierarchicalTimerWheel
+
+START_TIME = 1000000
+
+
+def test_fires_timers_once_their_time_has_passed():
+    wheel = HierarchicalTimerWheel(1, START_TIME)
+    wheel.schedule("a", START_TIME + 3)
+    wheel.schedule("b", START_TIME + 5)
+    assert wheel.advance(START_TIME + 2) == []
+    assert wheel.advance(START_TIME + 3) == ["a"]
+    assert wheel.advance(START_TIME + 10) == ["b"]
+    assert wheel.advance(START_TIME + 20) == []
+
+
+def test_never_fires_before_expiry_within_a_tick():
+    wheel = HierarchicalTimerWheel(1, START_TIME)
+    wheel.schedule("a", START_TIME + 2.5)
+    assert wheel.advance(START_TIME + 2.9) == []
+    assert wheel.advance(START_TIME + 3) == ["a"]
+
+
+def test_past_expiry_is_due_on_the_next_advance():
+    wheel = HierarchicalTimerWheel(1, START_TIME)
+    wheel.schedule("a", START_TIME - 10)
+    assert wheel.advance(START_TIME) == ["a"]
+
+
+def test_cascades_far_timers_down_the_levels():
+    wheel = HierarchicalTimerWheel(1, START_TIME)
+    delays = [1, 63, 64, 65, 4095, 4096, 4097, 20000]
+    for delay in delays:
+        wheel.schedule(str(delay), START_TIME + delay)
+    fired_at = {}
+    for now in range(START_TIME, START_TIME + 20007, 7):
+        for key in wheel.advance(now):
+            fired_at[key] = now
+    for delay in delays:
+        # Fired at the first advance at or after the expiry time
+        assert START_TIME + delay <= fired_at[str(delay)] < START_TIME + delay + 7
+
+
+class TwoLevelTimerWheel(HierarchicalTimerWheel):
+    NUM_LEVELS = 2
+
+
+def test_timers_beyond_the_top_level_still_fire():
+    wheel = TwoLevelTimerWheel(1, START_TIME)
+    delay = wheel.max_delta + 1000
+    wheel.schedule("far", START_TIME + delay)
+    assert wheel.advance(START_TIME + delay - 1) == []
+    assert wheel.advance(START_TIME + delay) == ["far"]
+
+
+def test_clear_drops_pending_timers():
+    wheel = HierarchicalTimerWheel(1, START_TIME)
+    wheel.schedule("a", START_TIME + 5)
+    wheel.schedule("b", START_TIME - 5)
+    wheel.clear()
+    assert wheel.advance(START_TIME + 100) == []